@@ -1,6 +1,6 @@
 import json
 import numpy as np
-from models.data_loader import *
+from models.manifest import Manifest, manifest_path
 import argparse
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,30 +10,15 @@ def plot_data_statistics():
     parser = argparse.ArgumentParser()
     parser.add_argument("-bert_data_path", default='../bert_data')
     args = parser.parse_args()
-    print('start loading data::::')
-    article_tokens = []
-    article_sentences = []
-    slide_tokens = []
-    morethan5000 = 0
-    sent_sizes = []
-    for pt_file in load_dataset(args, 'train', shuffle=True):
-        # print('pt_file size:', len(pt_file))
-        for ex in pt_file:
-            src = ex['src']
-            np_src = np.array(src)
-            cls_indices = np.argwhere(np_src==101)
-            prev_cls = cls_indices[0][0]
-            for index in cls_indices[1:]:
-                sent_sizes.append(index[0]-prev_cls)
-                prev_cls = index[0]
-            tgt = ex['tgt']
-            src_sent_labels = ex['src_sent_labels']
-            if len(tgt) > 5000:
-                morethan5000 += 1
-            # print('NUMBER OF POS labels:::::', len(src), len(src_sent_labels), sum(src_sent_labels))
-            slide_tokens.append(len(tgt))
-            article_tokens.append(len(src))
-            article_sentences.append(len(src_sent_labels))
+    print('start loading the manifest::::')
+    # written by format_to_bert (or preprocess.py -mode build_manifest), no shard is loaded
+    manifest = Manifest.load(manifest_path(args.bert_data_path, 'train'))
+    print(manifest)
+    sent_sizes = manifest['sent_tokens']
+    slide_tokens = manifest['n_tgt_tokens']
+    article_tokens = manifest['n_tokens']
+    article_sentences = manifest['n_sents']
+    morethan5000 = int((slide_tokens > 5000).sum())
     sent_size_np = np.array(sent_sizes)
     big_sents = np.argwhere(sent_size_np > 200).size
     print('---- number of sents greater than 100: {}, total sentences: {}, ration:{}'.format(big_sents, sent_size_np.size,
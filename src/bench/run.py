@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+    Benchmarks of the hot paths on a synthetic corpus, on the cpu by default:
+        python -m bench.run -output ../bench/baseline.json
+        python -m bench.run -baseline ../bench/baseline.json
+    Every benchmark runs -warmup times, then -repeat times, and reports the p50/mean/min time of one run.
+    With -baseline the p50 times are compared against a previous -output, and the run fails when one of them is
+    more than -tolerance slower.
+"""
+from __future__ import division
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from bench.synthetic import SyntheticCorpus, bert_documents, write_shards
+from models.data_loader import DataIterator
+from models.longExtractiveFormerAttention import LongformerSelfAttention
+from models.model_builder import ExtSummarizer
+from models.modeling_bert import BertConfig
+from models.trainer_ext import build_trainer
+from others.log import init_logger, logger
+from others.tokenization import BertTokenizer
+from others.utils import test_rouge
+from prepro.data_builder import BertData, greedy_selection
+
+# the train.py / preprocess.py options the benchmarked code reads
+MODEL_ARGS = dict(
+    large=False, finetune_bert=False, max_pos=10240, chunk_size=512, chunk_packing='greedy', chunk_context=0,
+    chunk_buckets='', bert_batch_size=8, cascade_ratio=0, use_interval=True, max_tgt_len=5000,
+    ext_dropout=0.2, ext_layers=2, ext_heads=4, ext_ff_size=2048, param_init=0, param_init_glorot=True,
+    global_attention=1, global_attention_ratio=0.2, precision='fp32', debug=False, student_layers=0,
+    visible_gpus='-1', gpu_ranks=[0], world_size=1, accum_count=1, prefetch=0, save_checkpoint_steps=5, report_every=1,
+    recall_eval=False, report_rouge=False, block_trigram=True, profile_steps='', profile_test_batches='',
+    min_src_nsents=1, max_src_nsents=500, min_src_ntokens_per_sent=5, max_src_ntokens_per_sent=50,
+    min_tgt_ntokens=0, max_tgt_ntokens=5000, seed=666)
+
+
+class Context(object):
+    """ The corpus, tokenizer and model shared by the benchmarks, built on first use """
+
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.corpus = SyntheticCorpus(args.sections, args.sents_per_section, args.words_per_sent,
+                                      layout=args.layout, seed=args.seed)
+        self.papers = self.corpus.papers(args.docs)
+        vocab = args.vocab or self.corpus.write_vocab(work_dir)
+        self.tokenizer = BertTokenizer(vocab, do_lower_case=True)
+        self.model_args = argparse.Namespace(temp_dir=work_dir, result_path=os.path.join(work_dir, 'result'),
+                                             tensorboard_log_path=os.path.join(work_dir, 'tensorboard'),
+                                             bert_data_path=work_dir, **MODEL_ARGS)
+        self.bert_data = BertData(self.model_args, self.tokenizer)
+        self._docs, self._test_docs, self._model, self._student = None, None, None, None
+
+    def docs(self, is_test=False):
+        if is_test:
+            if self._test_docs is None:
+                self._test_docs = bert_documents(self.bert_data, self.papers, seed=self.args.seed, is_test=True)
+            return self._test_docs
+        if self._docs is None:
+            self._docs = bert_documents(self.bert_data, self.papers, seed=self.args.seed)
+        return self._docs
+
+    def model(self):
+        if self._model is None:
+            torch.manual_seed(self.args.seed)
+            config = BertConfig(len(self.tokenizer.vocab), hidden_size=self.args.bert_hidden_size,
+                                num_hidden_layers=self.args.bert_layers,
+                                num_attention_heads=self.args.bert_heads,
+                                intermediate_size=4 * self.args.bert_hidden_size)
+            self._model = ExtSummarizer(self.model_args, 'cpu', None, bert_config=config)
+            self._model.eval()
+        return self._model
+
+    def student(self):
+        """ A distillation student half as wide as the benchmark BERT, projected to its width """
+        if self._student is None:
+            torch.manual_seed(self.args.seed)
+            hidden_size = self.args.bert_hidden_size // 2
+            config = BertConfig(len(self.tokenizer.vocab), hidden_size=hidden_size, num_hidden_layers=1,
+                                num_attention_heads=max(1, self.args.bert_heads // 2),
+                                intermediate_size=4 * hidden_size)
+            self._student = ExtSummarizer(self.model_args, 'cpu', None, bert_config=config,
+                                          hidden_size=self.args.bert_hidden_size)
+            self._student.eval()
+        return self._student
+
+    def batches(self, is_test=False):
+        return list(DataIterator(self.model_args, list(self.docs(is_test)), 1, 'cpu', is_test=is_test,
+                                 shuffle=False))
+
+
+def bench_tokenize(ctx):
+    wordpiece = ctx.tokenizer.wordpiece_tokenizer
+    texts = [' '.join(sent) for paper in ctx.papers for sent in paper['src']]
+    n_words = sum(len(text.split()) for text in texts)
+    return (lambda: [wordpiece.tokenize(text) for text in texts]), n_words, 'words'
+
+
+def bench_greedy_selection(ctx):
+    papers = ctx.papers[:ctx.args.greedy_docs]
+    max_src_nsents = ctx.model_args.max_src_nsents
+    return (lambda: [greedy_selection(paper['src'][:max_src_nsents], paper['tgt'], int(0.2 * len(paper['src'])))
+                     for paper in papers]), len(papers), 'docs'
+
+
+def bench_bert_preprocess(ctx):
+    return (lambda: bert_documents(ctx.bert_data, ctx.papers, seed=ctx.args.seed)), len(ctx.papers), 'docs'
+
+
+def bench_batches(ctx):
+    docs = ctx.docs()
+    return (lambda: list(DataIterator(ctx.model_args, list(docs), 1, 'cpu', is_test=False, shuffle=False))), \
+        len(docs), 'docs'
+
+
+def bench_chunked_sent_vectors(ctx):
+    model, batches = ctx.model(), ctx.batches()
+
+    def run():
+        with torch.no_grad():
+            for batch in batches:
+                model.sent_vectors(batch.src, batch.token_sections, batch.segs, batch.clss, batch.mask_src,
+                                   batch.chunk_plans)
+    return run, len(batches), 'docs'
+
+
+def bench_student_forward(ctx):
+    """ Forward of a narrow student, on documents whose sentences are padded to the attention window """
+    model, batches = ctx.student(), ctx.batches()
+    window = max(model.config.attention_window)
+    if all(batch.mask_cls.size(1) % window == 0 for batch in batches):
+        raise ValueError('no document is padded to the attention window of %d sentences' % window)
+
+    def run():
+        random.seed(ctx.args.seed)
+        with torch.no_grad():
+            for batch in batches:
+                model(batch.src, batch.sections, batch.token_sections, batch.segs, batch.clss, batch.mask_src,
+                      batch.mask_cls, batch.chunk_plans)
+    return run, len(batches), 'docs'
+
+
+def bench_longformer_attention(global_attention):
+    """ Time spent in LongformerSelfAttention.forward while scoring the sentence vectors of every document """
+    def setup(ctx):
+        model, batches = ctx.model(), ctx.batches()
+        with torch.no_grad():
+            sents_vecs = [model.sent_vectors(batch.src, batch.token_sections, batch.segs, batch.clss,
+                                             batch.mask_src, batch.chunk_plans) for batch in batches]
+        spent = []
+
+        def pre_hook(module, inputs):
+            module._bench_start = time.perf_counter()
+
+        def hook(module, inputs, output):
+            spent.append(time.perf_counter() - module._bench_start)
+
+        def run():
+            handles = []
+            for module in model.modules():
+                if isinstance(module, LongformerSelfAttention):
+                    handles.append(module.register_forward_pre_hook(pre_hook))
+                    handles.append(module.register_forward_hook(hook))
+            saved, model.args.global_attention = model.args.global_attention, global_attention
+            random.seed(ctx.args.seed)
+            del spent[:]
+            try:
+                with torch.no_grad():
+                    for batch, sents_vec in zip(batches, sents_vecs):
+                        model.score_sent_vectors(sents_vec, batch.sections, batch.mask_cls)
+            finally:
+                model.args.global_attention = saved
+                for handle in handles:
+                    handle.remove()
+            return sum(spent)
+        return run, len(batches), 'docs'
+    return setup
+
+
+def bench_trainer_test(ctx):
+    model, batches = ctx.model(), ctx.batches(is_test=True)
+    trainer = build_trainer(ctx.model_args, -1, model, None)
+
+    def run():
+        random.seed(ctx.args.seed)
+        # Trainer.test prints a line per document
+        with contextlib.redirect_stdout(io.StringIO()):
+            trainer.test(batches, 0)
+    return run, len(batches), 'docs'
+
+
+def bench_test_rouge(ctx):
+    can_path = os.path.join(ctx.work_dir, 'rouge.candidate')
+    gold_path = os.path.join(ctx.work_dir, 'rouge.gold')
+    rng = random.Random(ctx.args.seed)
+    with open(can_path, 'w') as can, open(gold_path, 'w') as gold:
+        for paper in ctx.papers:
+            sents = [' '.join(sent) for sent in paper['src']]
+            can.write(' '.join(rng.sample(sents, max(1, len(sents) // 5))) + '\n')
+            gold.write('<q>'.join(' '.join(sent) for sent in paper['tgt']) + '\n')
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            test_rouge(can_path, gold_path)
+    return run, len(ctx.papers), 'docs'
+
+
+BENCHMARKS = OrderedDict([
+    ('tokenize', bench_tokenize),
+    ('greedy_selection', bench_greedy_selection),
+    ('bert_preprocess', bench_bert_preprocess),
+    ('batches', bench_batches),
+    ('chunked_sent_vectors', bench_chunked_sent_vectors),
+    ('student_forward', bench_student_forward),
+    ('longformer_attention', bench_longformer_attention(0)),
+    ('longformer_attention_global', bench_longformer_attention(1)),
+    ('trainer_test', bench_trainer_test),
+    ('test_rouge', bench_test_rouge),
+])
+
+
+def measure(run, warmup, repeat):
+    """ Seconds of every timed run; a run returning a number reports that time instead of its own """
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        spent = run()
+        times.append(spent if isinstance(spent, float) else time.perf_counter() - start)
+    return np.array(times)
+
+
+def run_benchmarks(args, names):
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as work_dir:
+        ctx = Context(args, work_dir)
+        for name in names:
+            try:
+                run, n_items, unit = BENCHMARKS[name](ctx)
+                times = measure(run, args.warmup, args.repeat)
+            except Exception as e:
+                logger.info('%s failed: %r' % (name, e))
+                results[name] = {'error': repr(e)}
+                continue
+            p50 = float(np.percentile(times, 50))
+            results[name] = {'p50_ms': 1000 * p50, 'mean_ms': 1000 * float(times.mean()),
+                             'min_ms': 1000 * float(times.min()), 'max_ms': 1000 * float(times.max()),
+                             'repeat': len(times), 'items': n_items, 'unit': unit,
+                             'items_per_s': n_items / max(p50, 1e-9)}
+            logger.info('%-28s p50 %10.2fms  mean %10.2fms  %10.1f %s/s' % (
+                name, results[name]['p50_ms'], results[name]['mean_ms'], results[name]['items_per_s'], unit))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Logs the p50 of every benchmark against the baseline and returns the names of the regressions """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if 'p50_ms' not in result or base is None or 'p50_ms' not in base:
+            continue
+        ratio = result['p50_ms'] / max(base['p50_ms'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        logger.info('%-28s %10.2fms vs %10.2fms  %.2fx%s' % (name, result['p50_ms'], base['p50_ms'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-only", default='', help="comma separated benchmarks, all by default: " +
+                                                   ','.join(BENCHMARKS))
+    parser.add_argument("-output", default='', help="write the results to this json file")
+    parser.add_argument("-baseline", default='', help="compare against the results of a previous -output")
+    parser.add_argument("-tolerance", default=0.1, type=float, help="allowed p50 slowdown against the baseline")
+    parser.add_argument("-warmup", default=1, type=int)
+    parser.add_argument("-repeat", default=5, type=int)
+    parser.add_argument("-threads", default=0, type=int, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument("-seed", default=666, type=int)
+
+    parser.add_argument("-docs", default=8, type=int, help="synthetic papers")
+    parser.add_argument("-sections", default=8, type=int)
+    parser.add_argument("-sents_per_section", default='5:20', help="MIN:MAX sentences per section")
+    parser.add_argument("-words_per_sent", default='8:40', help="MIN:MAX words per sentence")
+    parser.add_argument("-layout", default='uniform', choices=['uniform', 'skewed'],
+                        help="skewed: one long section, the others as short as possible")
+    parser.add_argument("-greedy_docs", default=2, type=int, help="papers labeled by greedy_selection")
+    parser.add_argument("-vocab", default='', help="bert vocab.txt to use instead of the synthetic vocabulary")
+    parser.add_argument("-bert_layers", default=2, type=int, help="layers of the randomly initialized BERT")
+    parser.add_argument("-bert_hidden_size", default=256, type=int)
+    parser.add_argument("-bert_heads", default=4, type=int)
+    parser.add_argument("-write_shards", default='',
+                        help="only write the synthetic papers as train/valid/test .bert.pt shards to this directory")
+    parser.add_argument('-log_file', default='')
+    args = parser.parse_args()
+
+    init_logger(args.log_file)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    if args.write_shards:
+        with tempfile.TemporaryDirectory() as work_dir:
+            ctx = Context(args, work_dir)
+            for corpus_type in ['train', 'valid', 'test']:
+                paths = write_shards(ctx.docs(is_test=corpus_type == 'test'), args.write_shards, corpus_type)
+                logger.info('Wrote %s' % ', '.join(paths))
+        sys.exit(0)
+
+    names = [name.strip() for name in args.only.split(',') if name.strip()] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks %s' % ', '.join(unknown))
+
+    results = run_benchmarks(args, names)
+    failed = [name for name, result in results.items() if 'error' in result]
+    if args.output:
+        meta = {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(),
+                'threads': torch.get_num_threads(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'args': vars(args)}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        logger.info('Wrote %s' % args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logger.info('%d regressions: %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+    if failed:
+        logger.info('%d benchmarks failed: %s' % (len(failed), ', '.join(failed)))
+        sys.exit(1)
@@ -0,0 +1,119 @@
+"""
+    Synthetic corpus for the benchmarks: papers with a controllable number of sections, sentences per section and
+    words per sentence, a word piece vocabulary laid out like bert-base-uncased ([CLS] 101, [SEP] 102, whole words
+    from 1996) and .bert.pt-compatible documents built with BertData.
+"""
+import os
+import random
+import string
+
+import torch
+
+SPECIAL = ['[PAD]'] + ['[unused%d]' % i for i in range(99)] + ['[UNK]', '[CLS]', '[SEP]', '[MASK]']
+# bert-base-uncased starts its whole words here, see models.cascade.CONTENT_ID
+FIRST_WORD = 1996
+SUFFIXES = ['s', 'ed', 'ing', 'er', 'ers', 'ly', 'tion', 'ment', 'al', 'ity', 'ize', 'ness', 'ive', 'able']
+
+
+def parse_range(value):
+    """ '5:20' -> (5, 20), '8' -> (8, 8) """
+    bounds = [int(x) for x in str(value).split(':')]
+    return bounds[0], bounds[-1]
+
+
+class SyntheticCorpus(object):
+    """
+    Papers as clean_paper_jsons writes them ({'src': sentences of words, 'sections': section id of every sentence,
+    'tgt': slide sentences}). Words follow a Zipf distribution over `n_stems` stems, a third of them with a suffix
+    that the tokenizer splits into a second word piece. The slides reuse about `label_ratio` of the sentences.
+    layout: 'uniform' draws the sentences of every section from `sents_per_section`, 'skewed' gives one long
+    section three times the maximum and the others the minimum.
+    """
+
+    def __init__(self, sections=8, sents_per_section='5:20', words_per_sent='8:40', n_stems=3000,
+                 layout='uniform', label_ratio=0.2, seed=666):
+        self.sections = sections
+        self.sents_per_section = parse_range(sents_per_section)
+        self.words_per_sent = parse_range(words_per_sent)
+        self.layout = layout
+        self.label_ratio = label_ratio
+        self.rng = random.Random(seed)
+        stems = set()
+        while len(stems) < n_stems:
+            stems.add(''.join(self.rng.choice(string.ascii_lowercase) for _ in range(self.rng.randint(3, 8))))
+        self.stems = sorted(stems)
+        self.weights = [1. / (rank + 1) for rank in range(n_stems)]
+
+    def vocab(self):
+        fillers = ['[unused%d]' % i for i in range(99, 99 + FIRST_WORD - len(SPECIAL))]
+        return SPECIAL + fillers + self.stems + ['##' + suffix for suffix in SUFFIXES]
+
+    def write_vocab(self, directory):
+        path = os.path.join(directory, 'vocab.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.vocab()) + '\n')
+        return path
+
+    def sentence(self):
+        n_words = self.rng.randint(*self.words_per_sent)
+        words = self.rng.choices(self.stems, self.weights, k=n_words)
+        return [w + self.rng.choice(SUFFIXES) if self.rng.random() < 1. / 3 else w for w in words]
+
+    def paper(self):
+        if self.layout == 'skewed':
+            long_section = self.rng.randrange(self.sections)
+            counts = [3 * self.sents_per_section[1] if i == long_section else self.sents_per_section[0]
+                      for i in range(self.sections)]
+        else:
+            counts = [self.rng.randint(*self.sents_per_section) for _ in range(self.sections)]
+        src, sections = [], []
+        for section, count in enumerate(counts):
+            for _ in range(count):
+                src.append(self.sentence())
+                sections.append(section)
+        picked = sorted(self.rng.sample(range(len(src)), max(1, int(self.label_ratio * len(src)))))
+        # slides paraphrase the paper: the picked sentences with a few words dropped
+        tgt = [[w for w in src[i] if self.rng.random() > 0.2] or src[i][:1] for i in picked]
+        return {'src': src, 'sections': sections, 'tgt': tgt}
+
+    def papers(self, n):
+        return [self.paper() for _ in range(n)]
+
+
+def bert_document(bert, paper, sent_labels, is_test=False):
+    """ The .bert.pt record of a paper as _format_to_bert builds it, None when BertData drops it """
+    b_data = bert.preprocess(paper['src'], paper['sections'], paper['tgt'], sent_labels, is_test=is_test)
+    if b_data is None:
+        return None
+    src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, sections, \
+        token_sections = b_data
+    return {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
+            "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
+            'src_txt': src_txt, "tgt_txt": tgt_txt, "sections": sections, "token_sections": token_sections}
+
+
+def bert_documents(bert, papers, label_ratio=0.2, seed=666, is_test=False):
+    """
+    .bert.pt records of the papers. The oracle labels are drawn at random (label_ratio of the sentences) instead
+    of running greedy_selection, which is benchmarked on its own.
+    """
+    rng = random.Random(seed)
+    docs = []
+    for paper in papers:
+        n_sents = len(paper['src'])
+        labels = rng.sample(range(n_sents), max(1, int(label_ratio * n_sents)))
+        doc = bert_document(bert, paper, labels, is_test=is_test)
+        if doc is not None:
+            docs.append(doc)
+    return docs
+
+
+def write_shards(docs, save_path, corpus_type, shard_size=50):
+    """ Saves the records as <corpus_type>.<i>.bert.pt shards that load_dataset reads """
+    os.makedirs(save_path, exist_ok=True)
+    paths = []
+    for i in range(0, len(docs), shard_size):
+        path = os.path.join(save_path, '%s.%d.bert.pt' % (corpus_type, i // shard_size))
+        torch.save(docs[i:i + shard_size], path)
+        paths.append(path)
+    return paths
@@ -6,7 +6,9 @@
 from __future__ import print_function
 
 import math
+import os
 import pickle
+import socket
 
 import torch.distributed
 
@@ -17,17 +19,47 @@ def is_master(gpu_ranks, device_id):
     return gpu_ranks[device_id] == 0
 
 
-def multi_init(device_id, world_size, gpu_ranks):
+def resolve_init_method(init_method, port=-1):
+    """
+    Sets the port of a ``tcp://host:port`` init method. ``port=0`` picks a
+    free local port, which only works when all processes run on this node.
+    ``env://`` and ``file://`` init methods are returned unchanged.
+    """
+    if not init_method.startswith('tcp://') or port < 0:
+        return init_method
+    host = init_method[len('tcp://'):].rsplit(':', 1)[0]
+    if port == 0:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('', 0))
+            port = sock.getsockname()[1]
+    return 'tcp://%s:%d' % (host, port)
+
+
+def set_cpu_threads(n_local_procs, threads=0):
+    """
+    Splits the cores of the node between its cpu processes, otherwise
+    every process starts one intra-op thread per core.
+    """
+    if threads <= 0:
+        threads = max(1, (os.cpu_count() or 1) // max(n_local_procs, 1))
+    torch.set_num_threads(threads)
+    return threads
+
+
+def multi_init(device_id, world_size, gpu_ranks, backend='nccl', init_method='tcp://localhost:10000'):
     """
     Rank is a unique identifier assigned to each process within a distributed
     process group. They are always consecutive integers ranging from 0 to
     ``world_size``.
+    Use ``backend='gloo'`` for multi-process training on cpu. ``init_method``
+    is a ``tcp://host:port``, ``env://`` (MASTER_ADDR and MASTER_PORT) or
+    ``file:///shared/path`` rendezvous.
     """
     print('GPU ranks: ', gpu_ranks)
-    dist_init_method = 'tcp://localhost:10000'
+    dist_init_method = init_method
     dist_world_size = world_size
     torch.distributed.init_process_group(
-        backend='nccl', init_method=dist_init_method,
+        backend=backend, init_method=dist_init_method,
         world_size=dist_world_size, rank=gpu_ranks[device_id])
     gpu_rank = torch.distributed.get_rank()
     if not is_master(gpu_ranks, device_id):
@@ -47,8 +79,13 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom,
         buffer_size: all-reduce chunk size in bytes
     """
     # buffer size in bytes, determine equiv. # of elements based on data type
-    buffer_t = tensors[0].new(
-        math.ceil(buffer_size / tensors[0].element_size())).zero_()
+    # the buffer is allocated once and reused by the following calls
+    buffer_t = getattr(all_reduce_and_rescale_tensors, '_buffer', None)
+    numel = math.ceil(buffer_size / tensors[0].element_size())
+    if buffer_t is None or buffer_t.numel() != numel or buffer_t.dtype != tensors[0].dtype \
+            or buffer_t.device != tensors[0].device:
+        buffer_t = tensors[0].new(numel).zero_()
+        all_reduce_and_rescale_tensors._buffer = buffer_t
     buffer = []
 
     def all_reduce_buffer():
@@ -61,7 +98,7 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom,
 
         # all-reduce and rescale
         torch.distributed.all_reduce(buffer_t[:offset])
-        buffer_t.div_(rescale_denom)
+        buffer_t[:offset].div_(rescale_denom)
 
         # copy all-reduced buffer back into tensors
         offset = 0
@@ -91,14 +128,25 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom,
         all_reduce_buffer()
 
 
+def all_reduce_max(value):
+    """The largest integer `value` over all processes"""
+    # nccl only reduces cuda tensors, gloo works on cpu tensors
+    device = 'cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu'
+    t = torch.tensor([value], dtype=torch.long, device=device)
+    torch.distributed.all_reduce(t, op=torch.distributed.ReduceOp.MAX)
+    return int(t.item())
+
+
 def all_gather_list(data, max_size=4096):
     """Gathers arbitrary data from all nodes into a list."""
     world_size = torch.distributed.get_world_size()
+    # nccl only gathers cuda tensors, gloo works on cpu tensors
+    device = 'cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu'
     if not hasattr(all_gather_list, '_in_buffer') or \
-            max_size != all_gather_list._in_buffer.size():
-        all_gather_list._in_buffer = torch.cuda.ByteTensor(max_size)
+            max_size != all_gather_list._in_buffer.size(0):
+        all_gather_list._in_buffer = torch.zeros(max_size, dtype=torch.uint8, device=device)
         all_gather_list._out_buffers = [
-            torch.cuda.ByteTensor(max_size)
+            torch.zeros(max_size, dtype=torch.uint8, device=device)
             for i in range(world_size)
         ]
     in_buffer = all_gather_list._in_buffer
@@ -114,7 +162,7 @@ def all_gather_list(data, max_size=4096):
     in_buffer[1] = enc_size % 255  # reminder
     in_buffer[2:enc_size + 2] = torch.ByteTensor(list(enc))
 
-    torch.distributed.all_gather(out_buffers, in_buffer.cuda())
+    torch.distributed.all_gather(out_buffers, in_buffer)
 
     results = []
     for i in range(world_size):
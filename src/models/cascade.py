@@ -0,0 +1,83 @@
+"""
+    Cheap first stage of the -cascade_ratio inference: ranks the sentences of a document from their word pieces
+    and positions, so that BERT only encodes the chunks holding candidate sentences.
+"""
+import math
+from collections import Counter
+
+# bert-base-uncased ids up to here are special tokens, [unused*] and single characters, the whole words after
+# it are roughly sorted by frequency ('the' is 1996), so a high id is a rare word
+CONTENT_ID = 1996
+
+
+def prefilter_scores(src, clss, sections):
+    """
+    Lexical and positional score of every sentence of a document given as python lists.
+    Lexical: the sentences made of rare words that the document repeats are central.
+    Positional: the first sentences of every section are boosted, as in the lead baselines.
+    """
+    counts = Counter(t for t in src if t > CONTENT_ID)
+    bounds = list(clss) + [len(src)]
+    lexical = []
+    for i in range(len(clss)):
+        tokens = set(t for t in src[bounds[i]:bounds[i + 1]] if t > CONTENT_ID)
+        lexical.append(sum(math.log(counts[t]) * math.log(t - CONTENT_ID) for t in tokens) / max(len(tokens), 1))
+    top = max(lexical + [1e-6])
+
+    scores = []
+    rank = 0
+    for i in range(len(clss)):
+        rank = rank + 1 if i > 0 and sections[i] == sections[i - 1] else 0
+        scores.append(lexical[i] / top + 0.5 / (1 + rank))
+    return scores
+
+
+class Cascade(object):
+    """
+    Keeps the `ratio` best sentences of the prefilter as candidates and the chunks of a chunk plan holding at
+    least one of them. Every sentence of a kept chunk is scored by the model, the others are masked.
+    """
+
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def __call__(self, src, clss, sections, labels, chunk_plan):
+        """ Returns the pruned chunk plan, the 0/1 mask of the scored sentences and the pruning statistics """
+        bucket, spans = chunk_plan
+        n_sents = len(clss)
+        scores = prefilter_scores(src, clss, sections)
+        n_candidates = min(n_sents, max(1, int(math.ceil(self.ratio * n_sents))))
+        candidates = set(sorted(range(n_sents), key=lambda i: -scores[i])[:n_candidates])
+
+        kept = [span for span in spans if any(j in candidates for j in range(span[2], span[3]))]
+        sent_mask = [0] * n_sents
+        for _, _, start_sent_id, end_sent_id in kept:
+            sent_mask[start_sent_id:end_sent_id] = [1] * (end_sent_id - start_sent_id)
+        stats = CascadeStats(n_sents, n_candidates, sum(sent_mask), len(spans), len(kept), sum(labels),
+                             sum(l for l, m in zip(labels, sent_mask) if m))
+        return (bucket, kept), sent_mask, stats
+
+
+class CascadeStats(object):
+    """ How much of the documents the cascade pruned and how many oracle sentences survived it """
+
+    def __init__(self, n_sents=0, n_candidates=0, n_scored=0, n_chunks=0, n_encoded=0, n_oracle=0,
+                 n_oracle_kept=0):
+        self.n_sents = n_sents
+        self.n_candidates = n_candidates
+        self.n_scored = n_scored
+        self.n_chunks = n_chunks
+        self.n_encoded = n_encoded
+        self.n_oracle = n_oracle
+        self.n_oracle_kept = n_oracle_kept
+
+    def update(self, stat):
+        for k in vars(self):
+            setattr(self, k, getattr(self, k) + getattr(stat, k))
+
+    def __str__(self):
+        return ('cascade: %d/%d sentences candidates, %d scored, %d/%d chunks encoded (%.1f%% pruned), '
+                '%.1f%% of the oracle sentences kept' % (
+                    self.n_candidates, self.n_sents, self.n_scored, self.n_encoded, self.n_chunks,
+                    100 * (1 - self.n_encoded / max(self.n_chunks, 1)),
+                    100 * self.n_oracle_kept / max(self.n_oracle, 1)))
@@ -0,0 +1,110 @@
+"""
+    Pools the BERT chunks of concurrent documents into shared batches, see ExtSummarizer.encode_chunks.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from models.chunking import ChunkStats, pack_chunks, pad_chunks
+from others.utils import autocast
+
+
+class ChunkScheduler(object):
+    """
+    Collects chunks from all in-flight documents for up to `max_wait_ms` after the oldest one arrived (or until
+    `batch_size` chunks are waiting), runs them through BERT as one batch and hands every document back its own
+    token vectors. The chunks are padded to the longest one, or with `pack` bin-packed into rows of `width` tokens.
+    """
+
+    def __init__(self, bert, batch_size, max_wait_ms, width, pack=False, precision='fp32', device='cpu'):
+        self.bert = bert
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.width = width
+        self.pack = pack
+        self.precision = precision
+        self.device = device
+        self.chunks = queue.Queue()
+        self.chunk_stats = ChunkStats(bert.model.config.hidden_size, width)
+
+        self._lock = threading.Lock()
+        self.n_batches = 0
+        self.n_chunks = 0
+        self.total_wait = 0.
+        self.max_wait_seen = 0.
+        self.total_depth = 0
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def encode(self, chunks):
+        """ Blocks until all the chunks of a document are encoded, returns their token vectors in order """
+        futures = [self.submit(chunk) for chunk in chunks]
+        return [f.result() for f in futures]
+
+    def submit(self, chunk):
+        future = Future()
+        self.chunks.put((time.time(), chunk, future))
+        return future
+
+    def _loop(self):
+        while True:
+            pending = [self.chunks.get()]
+            deadline = pending[0][0] + self.max_wait
+            while len(pending) < self.batch_size:
+                timeout = deadline - time.time()
+                try:
+                    pending.append(self.chunks.get(timeout=timeout) if timeout > 0 else self.chunks.get_nowait())
+                except queue.Empty:
+                    break
+            self._run(pending)
+
+    def _run(self, pending):
+        start = time.time()
+        waits = [start - enqueued for enqueued, _, _ in pending]
+        with self._lock:
+            self.n_batches += 1
+            self.n_chunks += len(pending)
+            self.total_wait += sum(waits)
+            self.max_wait_seen = max(self.max_wait_seen, max(waits))
+            self.total_depth += self.chunks.qsize()
+
+        chunks = [chunk for _, chunk, _ in pending]
+        try:
+            with torch.no_grad():
+                with autocast(self.precision, self.device):
+                    if self.pack:
+                        inputs, mask, position_ids, places = pack_chunks(chunks, self.width)
+                        top_vec = self.bert(*inputs, mask, position_ids)
+                        results = [top_vec[row, offset:offset + chunk[0].shape[0]]
+                                   for chunk, (row, offset) in zip(chunks, places)]
+                    else:
+                        inputs, _ = pad_chunks(chunks, self.width)
+                        top_vec = self.bert(*inputs)
+                        results = list(top_vec)
+        except Exception as e:
+            for _, _, future in pending:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.chunk_stats.update(len(chunks), sum(chunk[0].shape[0] for chunk in chunks),
+                                    top_vec.shape[0], top_vec.shape[1])
+        for (_, _, future), result in zip(pending, results):
+            future.set_result(result)
+
+    def metrics(self):
+        with self._lock:
+            n_batches = max(self.n_batches, 1)
+            return {'queue_depth': self.chunks.qsize(),
+                    'batches': self.n_batches,
+                    'chunks': self.n_chunks,
+                    'mean_queue_depth': self.total_depth / n_batches,
+                    'batch_fill_ratio': self.n_chunks / (n_batches * self.batch_size),
+                    'mean_wait_ms': 1000 * self.total_wait / max(self.n_chunks, 1),
+                    'max_wait_ms': 1000 * self.max_wait_seen,
+                    'tokens': self.chunk_stats.tokens,
+                    'padding_ratio': self.chunk_stats.padding_ratio(),
+                    'cost_ratio': self.chunk_stats.cost_ratio()}
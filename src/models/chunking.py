@@ -0,0 +1,299 @@
+"""
+    Cuts a document into BERT chunks at sentence boundaries and pads or bin-packs the chunks for encoding,
+    see ExtSummarizer.chunked_sent_vectors.
+"""
+import bisect
+from collections import Counter
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+CLS_ID = 101
+SEP_ID = 102
+
+
+def plan_chunks(clss, n_tokens, chunk_size, packing='greedy', context=0):
+    """
+    Returns the chunks of a document as (start_index, end_index, start_sent_id, end_sent_id) tuples: BERT
+    encodes the tokens start_index:end_index and the chunk gives the vectors of the sentences
+    start_sent_id:end_sent_id.
+    clss: the token position of every sentence ([CLS]). A chunk holds whole sentences and less than `chunk_size`
+    tokens, except a sentence longer than that, which gets a chunk of its own.
+    'greedy' fills every chunk as far as it goes and cuts the last one at `chunk_size` - 1 tokens,
+    as the original chunking did.
+    'balanced' splits the document into as many chunks as needed without cutting, with the longest chunk (the
+    padded width of the BERT batch) as short as possible.
+    With `context` > 0 the sentences are split into chunks of `chunk_size` - 2 * `context` tokens and every
+    chunk also encodes up to `context` tokens of whole sentences on each side, whose vectors come from the chunk
+    where they are in the middle.
+    """
+    if context > 0:
+        spans = plan_chunks(clss, n_tokens, chunk_size - 2 * context, packing)
+        return _add_context(spans, clss, n_tokens, chunk_size, context)
+    if packing == 'balanced':
+        spans = _balanced_plan(clss, n_tokens, chunk_size - 1)
+        if spans is not None:
+            return spans
+    spans = []
+    start_index, start_sent_id = 0, 0
+    for i, cls in enumerate(clss):
+        if cls - start_index >= chunk_size:
+            # the sentence starting the chunk is too long by itself: it is not left behind as an empty chunk
+            cut = max(i - 1, start_sent_id + 1)
+            end_index = clss[cut]
+            spans.append((start_index, end_index, start_sent_id, cut))
+            start_index, start_sent_id = end_index, cut
+    spans.append((start_index, min(n_tokens, start_index + chunk_size - 1), start_sent_id, len(clss)))
+    return spans
+
+
+def _add_context(spans, clss, n_tokens, chunk_size, context):
+    """ Extends every chunk by the whole sentences within `context` tokens, keeping it under `chunk_size` """
+    bounds = [0] + list(clss[1:]) + [n_tokens]
+    n_sents = len(clss)
+    extended = []
+    for start_index, end_index, start_sent_id, end_sent_id in spans:
+        first = start_sent_id
+        while first > 0 and start_index - bounds[first - 1] <= context \
+                and end_index - bounds[first - 1] < chunk_size:
+            first -= 1
+        last = end_sent_id
+        # a cut chunk does not end on a sentence boundary and gets no right context
+        while last < n_sents and end_index == bounds[end_sent_id] and bounds[last + 1] - end_index <= context \
+                and bounds[last + 1] - bounds[first] < chunk_size:
+            last += 1
+        if last > end_sent_id:
+            end_index = bounds[last]
+        elif end_sent_id == n_sents and end_index < n_tokens:
+            # the cut last chunk keeps as many tokens as fit
+            end_index = min(n_tokens, bounds[first] + chunk_size - 1)
+        extended.append((bounds[first], end_index, start_sent_id, end_sent_id))
+    return extended
+
+
+def parse_buckets(buckets):
+    """ '128,256,384,512' -> [128, 256, 384, 512], '' -> [] """
+    return sorted(int(b) for b in buckets.split(',') if b.strip())
+
+
+def bert_cost(n_chunks, length, hidden_size):
+    """
+    Cost of running BERT over n_chunks chunks of `length` tokens, up to a constant: per layer the projections and
+    the feed forward take 12 * L * h^2 and the attention 2 * L^2 * h multiply-adds, i.e. 2 * L * h * (6h + L).
+    """
+    return n_chunks * length * (6 * hidden_size + length)
+
+
+def choose_bucket(clss, n_tokens, buckets, packing='greedy', context=0, hidden_size=768):
+    """
+    Picks the chunk length of a document from `buckets`: among the plans that keep the most tokens, the one with
+    the lowest bert_cost, its chunks padded as pad_chunks does. A 600 token document gets 3 x 256 rather than
+    2 x 512. A bucket that one of the sentences does not fit in is skipped, the largest bucket is the fallback.
+    Returns the bucket and its plan.
+    """
+    bounds = [0] + list(clss[1:]) + [n_tokens]
+    longest = max(bounds[i + 1] - bounds[i] for i in range(len(bounds) - 1))
+    best = None
+    for length in buckets:
+        if length <= 2 * context + 1 or longest > length - 2 * context - 1:
+            continue
+        spans = plan_chunks(clss, n_tokens, length, packing, context)
+        width = padded_width(max(end_index - start_index for start_index, end_index, _, _ in spans), length)
+        key = (-spans[-1][1], bert_cost(len(spans), width, hidden_size), length)
+        if best is None or key < best[0]:
+            best = (key, length, spans)
+    if best is None:
+        length = max(buckets)
+        return length, plan_chunks(clss, n_tokens, length, packing, context)
+    return best[1], best[2]
+
+
+def truncated_size(src, clss, max_pos):
+    """ The number of tokens and sentences of a document DataIterator.preprocess keeps with `max_pos` """
+    n_tokens = min(len(src) - 1, max_pos - 1) + 1
+    n_sents = bisect.bisect_left(clss, max_pos)
+    # the last kept token is replaced by [SEP], a sentence starting there is dropped
+    if len(src) > max_pos - 1 and src[max_pos - 1] == CLS_ID:
+        n_sents -= 1
+    return n_tokens, n_sents
+
+
+class ChunkPlanner(object):
+    """
+    Plans the BERT chunks of a document with the -chunk_size, -chunk_packing, -chunk_context and -chunk_buckets
+    options. Returns the bucket (None without buckets) and the (start_index, end_index, start_sent_id,
+    end_sent_id) chunks, computed on the cpu from the token positions of the sentences.
+    """
+
+    def __init__(self, chunk_size, packing='greedy', context=0, buckets=''):
+        self.chunk_size = chunk_size
+        self.packing = packing
+        self.context = context
+        self.buckets = [b for b in parse_buckets(buckets) if 2 * context + 1 < b <= chunk_size]
+
+    def __call__(self, clss, n_tokens):
+        if self.buckets:
+            return choose_bucket(clss, n_tokens, self.buckets, self.packing, self.context)
+        return None, plan_chunks(clss, n_tokens, self.chunk_size, self.packing, self.context)
+
+    def key(self, max_pos):
+        """ Names the plans of this configuration in a BERT shard """
+        return '%d:%d:%s:%d:%s' % (self.chunk_size, max_pos, self.packing, self.context,
+                                   ','.join(str(b) for b in self.buckets))
+
+    def precompute(self, src, clss, max_pos):
+        """ The plan of a document after the `max_pos` truncation, as format_to_bert stores it """
+        n_tokens, n_sents = truncated_size(src, clss, max_pos)
+        bucket, spans = self(clss[:n_sents], n_tokens)
+        return {'n_tokens': n_tokens, 'n_sents': n_sents, 'bucket': -1 if bucket is None else bucket,
+                'spans': np.array(spans, dtype=np.int32).reshape(-1, 4)}
+
+    @staticmethod
+    def load(plan):
+        """ The (bucket, spans) of a stored plan """
+        return (None if plan['bucket'] < 0 else int(plan['bucket'])), [tuple(span) for span in plan['spans'].tolist()]
+
+
+def _split(bounds, width):
+    """ Greedy split of the sentences into chunks of at most `width` tokens """
+    spans = []
+    start_sent_id = 0
+    for i in range(1, len(bounds) - 1):
+        if bounds[i + 1] - bounds[start_sent_id] > width:
+            spans.append((bounds[start_sent_id], bounds[i], start_sent_id, i))
+            start_sent_id = i
+    spans.append((bounds[start_sent_id], bounds[-1], start_sent_id, len(bounds) - 1))
+    return spans
+
+
+def _balanced_plan(clss, n_tokens, max_width):
+    # sentence i covers the tokens bounds[i]:bounds[i + 1], the first chunk also takes anything before clss[0]
+    bounds = [0] + list(clss[1:]) + [n_tokens]
+    longest = max(bounds[i + 1] - bounds[i] for i in range(len(bounds) - 1))
+    if longest > max_width:
+        return None
+    n_chunks = len(_split(bounds, max_width))
+    lo, hi = max(longest, -(-n_tokens // n_chunks)), max_width
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if len(_split(bounds, mid)) <= n_chunks:
+            hi = mid
+        else:
+            lo = mid + 1
+    return _split(bounds, lo)
+
+
+def plan_sent_mask(chunk_plan, n_sents):
+    """
+    The sentences a chunk plan encodes as a (1, n_sents) cpu bool mask. For the single document batches it is the
+    mask_cls of the batch, the cascade masks exactly the sentences of the chunks it pruned.
+    """
+    mask = torch.zeros((1, n_sents), dtype=torch.bool)
+    for _, _, start_sent_id, end_sent_id in chunk_plan[1]:
+        mask[0, start_sent_id:end_sent_id] = True
+    return mask
+
+
+def slice_chunks(src, token_sections, segs, mask_src, spans):
+    """
+    Slices the (src, token_sections, segs, mask_src) of every chunk out of the document. A chunk that is cut
+    before the end of its last sentence gets a copy of src ending with [SEP]; the document is never modified.
+    """
+    chunks = []
+    for i, (start_index, end_index, _, _) in enumerate(spans):
+        cur_src = src[start_index:end_index]
+        # only the last chunk of a plan can stop inside a sentence
+        if i == len(spans) - 1 and end_index < src.shape[0]:
+            cur_src = torch.cat([cur_src[:-1], torch.full_like(cur_src[-1:], SEP_ID)])
+        chunks.append((cur_src, token_sections[start_index:end_index], segs[start_index:end_index],
+                       mask_src[start_index:end_index]))
+    return chunks
+
+
+def padded_width(width, max_width, multiple=8):
+    """ `width` rounded up to `multiple`, at most `max_width` unless `width` is already larger """
+    return max(width, min(-(-width // multiple) * multiple, max_width))
+
+
+def pad_chunks(chunks, max_width, multiple=8):
+    """
+    Pads the chunks to their longest length rounded up to `multiple` (at most `max_width`) and stacks them.
+    Returns the (src, token_sections, segs, mask_src) batch tensors and the padded width.
+    """
+    width = padded_width(max(chunk[0].shape[0] for chunk in chunks), max_width, multiple)
+    return [torch.stack([F.pad(chunk[i], (0, width - chunk[i].shape[0])) for chunk in chunks])
+            for i in range(4)], width
+
+
+def pack_chunks(chunks, width):
+    """
+    Bin-packs short chunks into rows of `width` tokens (first fit decreasing) so one BERT row can hold the tail
+    chunks of several documents. Every chunk only attends to itself through a block diagonal
+    (rows, width, width) mask and its position ids restart at 0.
+    Returns the (src, token_sections, segs) row tensors, the 3D mask, the position ids and the (row, offset)
+    of every chunk.
+    """
+    order = sorted(range(len(chunks)), key=lambda i: -chunks[i][0].shape[0])
+    fill, places = [], [None] * len(chunks)
+    for i in order:
+        length = chunks[i][0].shape[0]
+        row = next((r for r in range(len(fill)) if fill[r] + length <= width), None)
+        if row is None:
+            row = len(fill)
+            fill.append(0)
+        places[i] = (row, fill[row])
+        fill[row] += length
+
+    device = chunks[0][0].device
+    inputs = [torch.zeros((len(fill), width), dtype=torch.long, device=device) for _ in range(3)]
+    mask = torch.zeros((len(fill), width, width), dtype=torch.long, device=device)
+    position_ids = torch.zeros((len(fill), width), dtype=torch.long, device=device)
+    for chunk, (row, offset) in zip(chunks, places):
+        end = offset + chunk[0].shape[0]
+        for k in range(3):
+            inputs[k][row, offset:end] = chunk[k]
+        mask[row, offset:end, offset:end] = chunk[3][None, :]
+        position_ids[row, offset:end] = torch.arange(end - offset, device=device)
+    return inputs, mask, position_ids, places
+
+
+class ChunkStats(object):
+    """
+    Counts the tokens given to BERT against the padded slots they were encoded in, the chunk length buckets
+    and the estimated BERT cost against padding every chunk to `max_width`.
+    """
+
+    def __init__(self, hidden_size, max_width):
+        self.hidden_size = hidden_size
+        self.max_width = max_width
+        self.reset()
+
+    def update(self, chunks, tokens, rows, width, bucket=None):
+        self.chunks += chunks
+        self.tokens += tokens
+        self.slots += rows * width
+        self.cost += bert_cost(rows, width, self.hidden_size)
+        self.full_cost += bert_cost(chunks, self.max_width, self.hidden_size)
+        if bucket is not None:
+            self.buckets[bucket] += chunks
+
+    def padding_ratio(self):
+        return 1 - self.tokens / max(self.slots, 1)
+
+    def cost_ratio(self):
+        return self.cost / max(self.full_cost, 1)
+
+    def reset(self):
+        self.chunks, self.tokens, self.slots = 0, 0, 0
+        self.cost, self.full_cost = 0, 0
+        self.buckets = Counter()
+
+    def __str__(self):
+        msg = 'chunks %d, tokens %d, padded slots %d, padding %.1f%%, estimated cost %.1f%% of %d token chunks' % (
+            self.chunks, self.tokens, self.slots, 100 * self.padding_ratio(), 100 * self.cost_ratio(),
+            self.max_width)
+        if self.buckets:
+            msg += ', buckets ' + ' '.join('%d: %.1f%%' % (b, 100 * n / self.chunks)
+                                           for b, n in sorted(self.buckets.items()))
+        return msg
@@ -1,11 +1,20 @@
-import bisect
 import gc
 import glob
+import queue
 import random
+import threading
 
 import torch
+from torch.utils.data.distributed import DistributedSampler
 
+from models.cascade import Cascade
+from models.chunking import ChunkPlanner, truncated_size
 from others.log import logger
+from others.timing import timer
+
+# the fields of the .bert.pt records the extractive model reads, the test adds the text of the summaries
+TRAIN_FIELDS = ('src', 'src_sent_labels', 'segs', 'clss', 'sections', 'token_sections', 'chunk_plans')
+TEST_FIELDS = TRAIN_FIELDS + ('src_txt', 'tgt_txt')
 
 
 class Batch(object):
@@ -16,66 +25,194 @@ class Batch(object):
         rtn_data = [d + [pad_id] * (width - len(d)) for d in data]
         return rtn_data
 
-    def __init__(self, data=None, device=None, is_test=False):
-        """Create a Batch from a list of examples."""
+    def __init__(self, data=None, device=None, texts=None, chunk_planner=None, cascade=None):
+        """Create a Batch from a list of examples.
+            texts: doc id -> (src_txt, tgt_txt) of the document, read on the first use of src_str or tgt_str.
+            chunk_planner: plans the BERT chunks of every document here on the cpu, see ChunkPlanner.
+            cascade: prunes the chunk plans and masks the sentences of the pruned chunks, see Cascade.
+        """
         if data is not None:
             self.batch_size = len(data)
             pre_src = [x[0] for x in data]
             pre_sections = [x[1] for x in data]
             pre_token_sections = [x[2] for x in data]
-            pre_tgt = [x[3] for x in data]
-            pre_segs = [x[4] for x in data]
-            pre_clss = [x[5] for x in data]
-            pre_src_sent_labels = [x[6] for x in data]
+            pre_segs = [x[3] for x in data]
+            pre_clss = [x[4] for x in data]
+            pre_src_sent_labels = [x[5] for x in data]
+            doc_ids = [x[6] for x in data]
 
             src = torch.tensor(self._pad(pre_src, 0)).to(int)
-            tgt = torch.tensor(self._pad(pre_tgt, 0)).to(int)
             segs = torch.tensor(self._pad(pre_segs, 0)).to(int)
             token_sections = torch.tensor(self._pad(pre_token_sections, 0)).to(int)
-            mask_src = ~ (src == 0).to(int)
-            mask_tgt = ~ (tgt == 0)
+            # 1 on the tokens and 0 on the padding, as BertModel expects
+            mask_src = (src != 0).to(int)
 
             clss = torch.tensor(self._pad(pre_clss, -1)).to(int)
             src_sent_labels = torch.tensor(self._pad(pre_src_sent_labels, 0)).to(int)
             sections = torch.tensor(self._pad(pre_sections, 0)).to(int)
             mask_cls = ~ (clss == -1)
             clss[clss == -1] = 0
+
+            chunk_plans, cascade_stats = None, None
+            if chunk_planner is not None:
+                # plans stored in the shard come with the example, the others are planned here
+                chunk_plans = [x[7] if x[7] is not None else chunk_planner(x[4], len(x[0])) for x in data]
+                if cascade is not None:
+                    chunk_plans, sent_masks, cascade_stats = zip(*[cascade(x[0], x[4], x[1], x[5], plan)
+                                                                   for x, plan in zip(data, chunk_plans)])
+                    chunk_plans = list(chunk_plans)
+                    mask_cls = mask_cls & torch.tensor(self._pad(list(sent_masks), 0)).bool()
             setattr(self, 'clss', clss.to(device))
             setattr(self, 'mask_cls', mask_cls.to(device))
             setattr(self, 'src_sent_labels', src_sent_labels.to(device))
             setattr(self, 'sections', sections.to(device))
 
             setattr(self, 'src', src.to(device))
-            setattr(self, 'tgt', tgt.to(device))
             setattr(self, 'segs', segs.to(device))
             setattr(self, 'token_sections', token_sections.to(device))
             setattr(self, 'mask_src', mask_src.to(device))
-            setattr(self, 'mask_tgt', mask_tgt.to(device))
-
-            if is_test:
-                src_str = [x[-2] for x in data]
-                setattr(self, 'src_str', src_str)
-                tgt_str = [x[-1] for x in data]
-                setattr(self, 'tgt_str', tgt_str)
+            setattr(self, 'doc_ids', doc_ids)
+            setattr(self, 'chunk_plans', chunk_plans)
+            setattr(self, 'cascade_stats', cascade_stats)
+            # counted on the host for the Statistics, without reading the device tensors back
+            setattr(self, 'n_tokens', sum(len(x) for x in pre_src))
+            setattr(self, 'n_chunks', sum(len(plan[1]) for plan in chunk_plans) if chunk_plans is not None else 0)
+            setattr(self, 'n_positives', sum(sum(x) for x in pre_src_sent_labels))
+            setattr(self, 'texts', texts)
+            setattr(self, '_text', None)
 
     def __len__(self):
         return self.batch_size
 
+    @property
+    def src_str(self):
+        return self._load_text()[0]
+
+    @property
+    def tgt_str(self):
+        return self._load_text()[1]
+
+    def _load_text(self):
+        if self._text is None:
+            texts = [self.texts(doc_id) for doc_id in self.doc_ids]
+            self._text = [t[0] for t in texts], [t[1] for t in texts]
+        return self._text
+
+    def record_stream(self, stream):
+        """ Marks the device tensors of the batch as used by `stream`, see Prefetcher """
+        for value in vars(self).values():
+            if torch.is_tensor(value) and value.is_cuda:
+                value.record_stream(stream)
+
+
+class Prefetcher(object):
+    """
+    Runs a batch iterator `depth` batches ahead in a background thread, so that shard loading, Batch building and
+    the host to device copies of the next batches overlap with the forward/backward of the current one.
+    On cuda the copies run on a side stream that the consuming stream waits for. `depth` 0 iterates in place.
+    The thread stops when the consumer closes or drops the iterator before the end.
+    """
+
+    def __init__(self, iterable, depth=2):
+        self.iterable = iterable
+        self.depth = depth
+
+    def __iter__(self):
+        if self.depth <= 0:
+            yield from self.iterable
+            return
+        items = queue.Queue(self.depth)
+        stop = threading.Event()
+        cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        device = torch.cuda.current_device() if cuda else None
+
+        def put(item):
+            # gives up once the consumer has stopped, instead of blocking on the full queue forever
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                if cuda:
+                    torch.cuda.set_device(device)
+                    stream = torch.cuda.Stream()
+                    for batch in _iterate_on_stream(self.iterable, stream):
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                        if not put((batch, event, None)):
+                            return
+                else:
+                    for batch in self.iterable:
+                        if not put((batch, None, None)):
+                            return
+            except Exception as e:
+                put((None, None, e))
+                return
+            put((None, None, StopIteration()))
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                batch, event, error = items.get()
+                if isinstance(error, StopIteration):
+                    return
+                if error is not None:
+                    raise error
+                if event is not None:
+                    current = torch.cuda.current_stream()
+                    current.wait_event(event)
+                    # the tensors were allocated on the side stream
+                    batch.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+
 
-def load_dataset(args, corpus_type, shuffle):
+def _iterate_on_stream(iterable, stream):
+    """ Produces every item of `iterable` with `stream` as the current cuda stream """
+    it = iter(iterable)
+    while True:
+        with torch.cuda.stream(stream):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def load_dataset(args, corpus_type, shuffle, num_replicas=1, rank=0, epoch=0, fields=None, rng=random):
     """
     Dataset generator. Don't do extra stuff here, like printing,
     because they will be postponed to the first loading time.
 
     Args:
         corpus_type: 'train' or 'valid'
+        num_replicas, rank, epoch: with num_replicas > 1 only the shards of
+            this rank are loaded (`DistributedSampler` over the shard index,
+            reshuffled by epoch).
+        fields: the keys of the records to keep (TRAIN_FIELDS, TEST_FIELDS), all of them when None.
+            torch.load still reads and unpickles whole shards, the other keys
+            are dropped after it, so this saves memory, not loading time.
+        rng: the random.Random shuffling the shards, see Dataloader.
     Returns:
         A list of dataset, the dataset(s) are lazily loaded.
     """
     assert corpus_type in ["train", "valid", "test"]
 
     def _lazy_dataset_loader(pt_file, corpus_type):
-        dataset = torch.load(pt_file)
+        with timer.span('shard_load'):
+            dataset = torch.load(pt_file)
+            if fields is not None:
+                # the whole records were unpickled, the other fields are freed now instead of living as long as
+                # the shard
+                for ex in dataset:
+                    for k in [k for k in ex if k not in fields]:
+                        del ex[k]
         # logger.info('Loading %s dataset from %s, number of examples: %d' %
         #             (corpus_type, pt_file, len(dataset)))
         return dataset
@@ -83,8 +220,12 @@ def load_dataset(args, corpus_type, shuffle):
     # Sort the glob output by file name (by increasing indexes).
     pts = sorted(glob.glob(args.bert_data_path + '/' + corpus_type + '.[0-9]*.bert.pt'))
     if pts:
-        if shuffle:
-            random.shuffle(pts)
+        if num_replicas > 1:
+            sampler = DistributedSampler(pts, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=args.seed)
+            sampler.set_epoch(epoch)
+            pts = [pts[i] for i in sampler]
+        elif shuffle:
+            rng.shuffle(pts)
 
         for pt in pts:
             yield _lazy_dataset_loader(pt, corpus_type)
@@ -97,7 +238,7 @@ def load_dataset(args, corpus_type, shuffle):
 def ext_batch_size_fn(new, count):
     if len(new) == 4:
         pass
-    src, labels = new[0], new[4]
+    src, labels = new[0], new[5]
     global max_n_sents, max_n_tokens, max_size
     if count == 1:
         max_size = 0
@@ -111,7 +252,14 @@ def ext_batch_size_fn(new, count):
 
 class Dataloader(object):
     def __init__(self, args, datasets, batch_size,
-                 device, shuffle, is_test):
+                 device, shuffle, is_test, num_shards=1, shard_rank=0, rng=random):
+        """
+        num_shards, shard_rank: only yield the documents whose doc id (position in the loaded shards)
+            is shard_rank modulo num_shards, so that parallel workers get disjoint documents.
+        rng: the random.Random shuffling the documents and the batches. The training batches are built in the
+            Prefetcher thread while the model draws its global attention from the global random state, so they
+            get their own generator to stay reproducible with -seed.
+        """
         # I think datasets contains train.0 train.1 .... and dataset_iter iterates over the indices of the train
         self.args = args
         self.datasets = datasets
@@ -119,6 +267,10 @@ class Dataloader(object):
         self.device = device
         self.shuffle = shuffle
         self.is_test = is_test
+        self.num_shards = num_shards
+        self.shard_rank = shard_rank
+        self.rng = rng
+        self.doc_offset = 0
         self.cur_iter = self._next_dataset_iterator(datasets)
         assert self.cur_iter is not None
 
@@ -133,6 +285,8 @@ class Dataloader(object):
         try:
             # Drop the current dataset for decreasing memory
             if hasattr(self, "cur_dataset"):
+                if self.cur_dataset is not None:
+                    self.doc_offset += len(self.cur_dataset)
                 self.cur_dataset = None
                 gc.collect()
                 del self.cur_dataset
@@ -144,70 +298,82 @@ class Dataloader(object):
 
         return DataIterator(args=self.args,
                             dataset=self.cur_dataset, batch_size=self.batch_size,
-                            device=self.device, shuffle=self.shuffle, is_test=self.is_test)
+                            device=self.device, shuffle=self.shuffle, is_test=self.is_test,
+                            doc_offset=self.doc_offset, num_shards=self.num_shards, shard_rank=self.shard_rank,
+                            rng=self.rng)
 
 
 class DataIterator(object):
     def __init__(self, args, dataset, batch_size, device=None, is_test=False,
-                 shuffle=True):
+                 shuffle=True, doc_offset=0, num_shards=1, shard_rank=0, rng=random):
         self.args = args
+        self.rng = rng
         self.batch_size, self.is_test, self.dataset = batch_size, is_test, dataset
+        self.doc_offset, self.num_shards, self.shard_rank = doc_offset, num_shards, shard_rank
         self.iterations = 0
         self.device = device
         self.shuffle = shuffle
 
         self.sort_key = lambda x: len(x[1])
+        self.chunk_planner = ChunkPlanner(args.chunk_size, args.chunk_packing, args.chunk_context, args.chunk_buckets)
+        self.plan_key = self.chunk_planner.key(args.max_pos)
+        self.cascade = Cascade(args.cascade_ratio) if is_test and args.cascade_ratio > 0 else None
 
         self._iterations_this_epoch = 0
         self.batch_size_fn = ext_batch_size_fn
 
     def data(self):
         if self.shuffle:
-            random.shuffle(self.dataset)
+            self.rng.shuffle(self.dataset)
         xs = self.dataset
         return xs
 
-    def preprocess(self, ex, is_test):
+    def preprocess(self, ex, doc_id=0):
         src = ex['src']
-        tgt = ex['tgt'][:self.args.max_tgt_len][:-1] + [2]
         src_sent_labels = ex['src_sent_labels']
 
         segs = ex['segs']
         if not self.args.use_interval:
             segs = [0] * len(segs)
         clss = ex['clss']
-        src_txt = ex['src_txt']
-        tgt_txt = ex['tgt_txt']
         sections = ex['sections']
         token_sections = ex['token_sections']
         end_id = [src[-1]]
-        lastIsCls = False
-        if len(src) > self.args.max_pos-1 and src[self.args.max_pos-1] == 101:
-            lastIsCls = True
-        src = src[:-1][:self.args.max_pos - 1] + end_id
-        segs = segs[:self.args.max_pos]
-        token_sections = token_sections[:self.args.max_pos]
-        max_sent_id = bisect.bisect_left(clss, self.args.max_pos)
+        plan = ex.get('chunk_plans', {}).get(self.plan_key)
+        if plan is not None:
+            n_tokens, max_sent_id = plan['n_tokens'], plan['n_sents']
+            chunk_plan = self.chunk_planner.load(plan)
+        else:
+            n_tokens, max_sent_id = truncated_size(src, clss, self.args.max_pos)
+            chunk_plan = None
+        src = src[:n_tokens - 1] + end_id
+        segs = segs[:n_tokens]
+        token_sections = token_sections[:n_tokens]
         src_sent_labels = src_sent_labels[:max_sent_id]
         clss = clss[:max_sent_id]
         sections = sections[:max_sent_id]
-        if lastIsCls:
-            src_sent_labels = src_sent_labels[:max_sent_id-1]
-            clss = clss[:max_sent_id-1]
-            sections = sections[: max_sent_id-1]
-        # src_txt = src_txt[:max_sent_id]
-
-        if is_test:
-            return src, sections, token_sections, tgt, segs, clss, src_sent_labels, src_txt, tgt_txt,
-        else:
-            return src, sections, token_sections, tgt, segs, clss, src_sent_labels
+
+        # the text is only read by the test, by doc id, see text()
+        return src, sections, token_sections, segs, clss, src_sent_labels, doc_id, chunk_plan
+
+    def text(self, doc_id):
+        """ (src_txt, tgt_txt) of a document of the dataset """
+        ex = self.dataset[doc_id - self.doc_offset]
+        return ex['src_txt'], ex['tgt_txt']
+
+    def _bucket(self, ex):
+        chunk_plan = ex[7] if ex[7] is not None else self.chunk_planner(ex[4], len(ex[0]))
+        return chunk_plan[0]
 
     def batch_buffer(self, data, batch_size):
         minibatch, size_so_far = [], 0
-        for ex in data:
+        for idx, ex in enumerate(data):
+            doc_id = self.doc_offset + idx
+            if doc_id % self.num_shards != self.shard_rank:
+                continue
             if len(ex['src']) == 0:
                 continue
-            ex = self.preprocess(ex, self.is_test)
+            ex = self.preprocess(ex, doc_id)
             if ex is None:
                 continue
             minibatch.append(ex)
@@ -241,12 +407,16 @@ class DataIterator(object):
         data = self.data()  # just shuffles the dataset which is for example train.0
         for buffer in self.batch_buffer(data, self.batch_size * 300):
 
-            p_batch = sorted(buffer, key=lambda x: len(x[2]))
+            if self.chunk_planner.buckets:
+                # documents with the same BERT chunk length end up in the same batches
+                p_batch = sorted(buffer, key=lambda x: (self._bucket(x), len(x[2])))
+            else:
+                p_batch = sorted(buffer, key=lambda x: len(x[2]))
             p_batch = self.batch(p_batch, self.batch_size)
 
             p_batch = list(p_batch)
             if self.shuffle:
-                random.shuffle(p_batch)
+                self.rng.shuffle(p_batch)
             for b in p_batch:
                 if len(b) == 0:
                     continue
@@ -261,6 +431,8 @@ class DataIterator(object):
                     continue
                 self.iterations += 1
                 self._iterations_this_epoch += 1
-                batch = Batch(minibatch, self.device, self.is_test)
+                with timer.span('batch'):
+                    batch = Batch(minibatch, self.device, self.text if self.is_test else None, self.chunk_planner,
+                                  self.cascade)
                 yield batch
             return
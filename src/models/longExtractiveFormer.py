@@ -11,6 +11,8 @@ from models.longExtractiveFormerAttention import LongFormerAttention
 from pytorch_transformers import BertModel, BertConfig
 from typing import Union, List
 from models.neural import gelu
+from others.profiling import labeled
+from others.timing import timer
 
 
 class LongFormerConfig(BertConfig):
@@ -46,15 +48,27 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, emb, step=None):
+    def forward(self, emb, step=None, offset=0):
         emb = emb * math.sqrt(self.dim)
         if step:
             emb = emb + self.pe[:, step][:, None, :]
         else:
-            emb = emb + self.pe[:, :emb.size(1)]
+            emb = emb + self.encoding(offset, emb.size(1))
         emb = self.dropout(emb)
         return emb
 
+    def encoding(self, offset, length):
+        """ Encodings of the positions offset:offset + length, computed on the fly past the end of the table """
+        if offset + length <= self.pe.size(1):
+            return self.pe[:, offset:offset + length]
+        position = torch.arange(offset, offset + length, dtype=torch.float, device=self.pe.device).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, self.dim, 2, dtype=torch.float, device=self.pe.device) *
+                             -(math.log(10000.0) / self.dim))
+        pe = torch.zeros(length, self.dim, device=self.pe.device)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        return pe.unsqueeze(0)
+
     def get_emb(self, emb):
         return self.pe[:, :emb.size(1)]
 
@@ -79,6 +93,7 @@ class PositionwiseFeedForward(nn.Module):
         self.dropout_1 = nn.Dropout(self.config.hidden_dropout_prob)
         self.dropout_2 = nn.Dropout(self.config.hidden_dropout_prob)
 
+    @labeled('PositionwiseFeedForward')
     def forward(self, x):
         inter = self.dropout_1(self.actv(self.w_1(self.layer_norm(x))))
         output = self.dropout_2(self.w_2(inter))
@@ -99,7 +114,8 @@ class LongTransformerEncoderLayer(nn.Module):
                 layer_head_mask=None,
                 is_index_masked=None,
                 is_index_global_attn=None,
-                is_global_attn=None):
+                is_global_attn=None,
+                global_attn_indices=None):
         if iter != 0:
             input_norm = self.layer_norm(inputs)
         else:
@@ -110,7 +126,8 @@ class LongTransformerEncoderLayer(nn.Module):
                                 layer_head_mask,
                                 is_index_masked,
                                 is_index_global_attn,
-                                is_global_attn)
+                                is_global_attn,
+                                global_attn_indices=global_attn_indices)
         context = output[0]
         out = self.dropout(context) + inputs
         return self.feed_forward(out)
@@ -130,19 +147,26 @@ class LongExtTransformerEncoder(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.section_embedding = nn.Embedding(config.section_size, config.hidden_size)
 
-    def forward(self, top_vecs, sections, mask, extended_mask):
-        """ See :obj:`EncoderBase.forward()`"""
+    @timer.timed('encoder')
+    def forward(self, top_vecs, sections, mask, extended_mask, is_global_attn=None, global_attn_indices=None,
+                position_offset=0):
+        """ See :obj:`EncoderBase.forward()`
+            is_global_attn, global_attn_indices: computed on the cpu by the caller to avoid device syncs,
+                derived from extended_mask when not given.
+            position_offset: position of the first sentence, for windows of a longer document.
+        """
 
         # batch_size, n_sents = top_vecs.size(0), top_vecs.size(1)
         # pos_emb = self.pos_emb.pe[:, :n_sents]
         x = top_vecs * mask[:, :, None].float()
-        x = self.pos_emb(x)
+        x = self.pos_emb(x, offset=position_offset)
 
         x = x + self.section_embedding(sections)
 
         is_index_masked = extended_mask < 0  # masking tokens (-10000) are true in and local(0) or global(+1000) attentions are False
         is_index_global_attn = extended_mask > 0  # indices with global attention are True others False
-        is_global_attn = is_index_global_attn.flatten().any().item()  # True if at least one index with global attention
+        if is_global_attn is None:
+            is_global_attn = is_index_global_attn.flatten().any().item()  # True if at least one index with global attention
 
         for i in range(self.config.num_hidden_layers):
             x = self.transformer_inter[i](i, x,
@@ -150,7 +174,8 @@ class LongExtTransformerEncoder(nn.Module):
                                           layer_head_mask=None,
                                           is_index_masked=is_index_masked,
                                           is_index_global_attn=is_index_global_attn,
-                                          is_global_attn=is_global_attn)
+                                          is_global_attn=is_global_attn,
+                                          global_attn_indices=global_attn_indices)
 
         x = self.layer_norm(x)
         sent_scores = self.sigmoid(self.wo(x))
@@ -12,6 +12,8 @@ from pytorch_transformers import BertModel, BertConfig
 from typing import Union, List
 import numpy as np
 
+from others.profiling import labeled
+
 
 class LongformerEmbeddings(nn.Module):
     """
@@ -121,6 +123,7 @@ class LongformerSelfAttention(nn.Module):
 
         self.one_sided_attn_window_size = attention_window // 2
 
+    @labeled('LongformerSelfAttention')
     def forward(
         self,
         hidden_states,
@@ -130,6 +133,7 @@ class LongformerSelfAttention(nn.Module):
         is_index_global_attn=None,  # indices with global attention
         is_global_attn=None,  # True if at least one index with global attention
         output_attentions=False,
+        global_attn_indices=None,  # _get_global_attn_indices computed once for all layers
     ):
         """
         :class:`LongformerSelfAttention` expects `len(hidden_states)` to be multiple of `attention_window`. Padding to
@@ -194,7 +198,8 @@ class LongformerSelfAttention(nn.Module):
                 is_index_global_attn_nonzero,  # indices of global attention in tuple format
                 is_local_index_global_attn_nonzero,
                 is_local_index_no_global_attn_nonzero,
-            ) = self._get_global_attn_indices(is_index_global_attn)
+            ) = global_attn_indices if global_attn_indices is not None \
+                else self._get_global_attn_indices(is_index_global_attn)
             # calculate global attn probs from global key
 
             global_key_attn_scores = self._concat_with_global_key_attn_probs(
@@ -276,7 +281,8 @@ class LongformerSelfAttention(nn.Module):
             # The attention weights for tokens with global attention are
             # just filler values, they were never used to compute the output.
             # Fill with 0 now, the correct values are in 'global_attn_probs'.
-            attn_probs[is_index_global_attn_nonzero] = 0
+            # (out of place: the global value matmul saved attn_probs for the backward)
+            attn_probs = attn_probs.masked_fill(is_index_global_attn[:, :, None, None], 0)
 
         outputs = (attn_output.transpose(0, 1),)
 
@@ -534,17 +540,11 @@ class LongformerSelfAttention(nn.Module):
         # cut local attn probs to global only
         attn_probs_only_global = attn_probs.narrow(-1, 0, max_num_global_attn_indices)
         # get value vectors for global only
-        # value_vectors_only_global = value_vectors.new_zeros(
-        #     batch_size, max_num_global_attn_indices, self.num_heads, self.head_dim
-        # )
-        # value_vectors_only_global[is_local_index_global_attn_nonzero] = value_vectors[is_index_global_attn_nonzero]
-
-        value_vectors_only_global = np.zeros([batch_size, max_num_global_attn_indices, self.num_heads, self.head_dim])
-        value_vectors_only_global[is_local_index_global_attn_nonzero] = value_vectors[is_index_global_attn_nonzero].detach().numpy()
-        if value_vectors.get_device()>=0:
-            value_vectors_only_global = torch.Tensor(value_vectors_only_global).to(value_vectors.get_device())
-        else:
-            value_vectors_only_global = torch.Tensor(value_vectors_only_global)
+        # (built with new_zeros so it keeps the device and the autocast dtype of value_vectors)
+        value_vectors_only_global = value_vectors.new_zeros(
+            batch_size, max_num_global_attn_indices, self.num_heads, self.head_dim
+        )
+        value_vectors_only_global[is_local_index_global_attn_nonzero] = value_vectors[is_index_global_attn_nonzero]
         # use `matmul` because `einsum` crashes sometimes with fp16
         # attn = torch.einsum('blhs,bshd->blhd', (selected_attn_probs, selected_v))
         # compute attn output only global
@@ -710,6 +710,7 @@ class LongFormerAttention(nn.Module):
         is_index_global_attn=None,
         is_global_attn=None,
         output_attentions=False,
+        global_attn_indices=None,
     ):
         self_outputs = self.self(
             hidden_states,
@@ -719,6 +720,7 @@ class LongFormerAttention(nn.Module):
             is_index_global_attn=is_index_global_attn,
             is_global_attn=is_global_attn,
             output_attentions=output_attentions,
+            global_attn_indices=global_attn_indices,
         )
         attn_output = self.output(self_outputs[0], hidden_states)
         outputs = (attn_output,) + self_outputs[1:]
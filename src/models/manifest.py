@@ -0,0 +1,139 @@
+"""
+    Per-document index of the .bert.pt shards: format_to_bert writes <corpus_type>.manifest.npz next to them with
+    one column per document size, so that the statistics and capacity planning read a few arrays instead of
+    unpickling every shard.
+"""
+import os
+
+import numpy as np
+
+from models.chunking import ChunkPlanner
+
+# the chunk columns are computed for the -chunk_plans of format_to_bert, the train.py defaults without them
+DEFAULT_PLANS = '512:10240'
+
+# one value per document, in the order load_dataset reads the sorted shards
+DOC_COLUMNS = ('n_tokens', 'n_sents', 'n_sections', 'n_positives', 'n_tgt_tokens', 'src_truncated',
+               'tgt_truncated')
+
+
+def manifest_path(bert_data_path, corpus_type):
+    return os.path.join(bert_data_path, '%s.manifest.npz' % corpus_type)
+
+
+def parse_plans(plans, packing='greedy', context=0, buckets=''):
+    """ '512:10240,256:4096' -> [(ChunkPlanner(512), 10240), (ChunkPlanner(256), 4096)] """
+    planners = []
+    for plan in plans.split(','):
+        if plan.strip():
+            chunk_size, max_pos = map(int, plan.split(':'))
+            planners.append((ChunkPlanner(chunk_size, packing, context, buckets), max_pos))
+    return planners
+
+
+def shard_columns(docs, planners, max_src_nsents, max_tgt_ntokens):
+    """
+    The manifest columns of the records of one shard. The truncation flags mark the documents that reached the
+    -max_src_nsents / -max_tgt_ntokens caps of BertData.
+    """
+    columns = {name: [] for name in DOC_COLUMNS + ('n_chunks', 'pos_truncated', 'sent_tokens')}
+    for ex in docs:
+        src, clss = ex['src'], ex['clss']
+        columns['n_tokens'].append(len(src))
+        columns['n_sents'].append(len(clss))
+        columns['n_sections'].append(len(set(ex['sections'])))
+        columns['n_positives'].append(sum(ex['src_sent_labels']))
+        columns['n_tgt_tokens'].append(len(ex['tgt']))
+        columns['src_truncated'].append(len(clss) >= max_src_nsents)
+        columns['tgt_truncated'].append(len(ex['tgt']) >= max_tgt_ntokens)
+
+        n_chunks, pos_truncated = [], []
+        for planner, max_pos in planners:
+            plan = ex.get('chunk_plans', {}).get(planner.key(max_pos))
+            if plan is None:
+                plan = planner.precompute(src, clss, max_pos)
+            n_chunks.append(len(plan['spans']))
+            pos_truncated.append(plan['n_tokens'] < len(src))
+        columns['n_chunks'].append(n_chunks)
+        columns['pos_truncated'].append(pos_truncated)
+
+        bounds = list(clss) + [len(src)]
+        columns['sent_tokens'].extend(bounds[i + 1] - bounds[i] for i in range(len(clss)))
+    return columns
+
+
+class Manifest(object):
+    """
+    Columns of the documents of a corpus type:
+        doc_id, shard (index into `shards`), offset (position in the shard) and DOC_COLUMNS, one value per document;
+        shard_digests: per shard, the digest of the cache keys of its papers ('' when built without -cache_dir),
+            format_to_bert keeps the shards whose digest did not change;
+        n_chunks, pos_truncated: (documents, plans) for the chunk plans `plans` (ChunkPlanner keys), pos_truncated
+            marks the documents cut by the max_pos of the plan;
+        sent_tokens: the word pieces of every sentence, the sentences of document i start at sent_offsets[i].
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def build(cls, shards, plans):
+        """
+        shards: (shard file name, shard_columns with an optional 'digest') in any order, they are numbered as
+        load_dataset sorts them
+        """
+        shards = sorted(shards, key=lambda shard: shard[0])
+        n_docs = [len(c['n_tokens']) for _, c in shards]
+        columns = {
+            'shards': np.array([name for name, _ in shards]),
+            'shard_digests': np.array([c.get('digest', '') for _, c in shards]),
+            'plans': np.array([planner.key(max_pos) for planner, max_pos in plans]),
+            'doc_id': np.arange(sum(n_docs), dtype=np.int32),
+            'shard': np.repeat(np.arange(len(shards), dtype=np.int32), n_docs),
+            'offset': np.concatenate([np.arange(n, dtype=np.int32) for n in n_docs] or [np.zeros(0, np.int32)]),
+        }
+        for name in DOC_COLUMNS:
+            dtype = bool if name.endswith('truncated') else np.int32
+            columns[name] = np.array([v for _, c in shards for v in c[name]], dtype=dtype)
+        for name, dtype in (('n_chunks', np.int32), ('pos_truncated', bool)):
+            columns[name] = np.array([v for _, c in shards for v in c[name]], dtype=dtype).reshape(-1, len(plans))
+        columns['sent_tokens'] = np.array([v for _, c in shards for v in c['sent_tokens']], dtype=np.int32)
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls({name: f[name] for name in f.files})
+
+    def save(self, path):
+        np.savez_compressed(path, **self.columns)
+
+    def __len__(self):
+        return len(self.columns['doc_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def sent_offsets(self):
+        return np.concatenate([[0], np.cumsum(self.columns['n_sents'])[:-1]]).astype(np.int64)
+
+    def __str__(self):
+        lines = ['%d documents in %d shards' % (len(self), len(self.columns['shards']))]
+        for name in ('n_tokens', 'n_sents', 'n_sections', 'n_positives', 'n_tgt_tokens'):
+            lines.append(_describe(name, self.columns[name]))
+        lines.append(_describe('sent_tokens', self.columns['sent_tokens']))
+        lines.append('truncated: %d at max_src_nsents, %d at max_tgt_ntokens' % (
+            self.columns['src_truncated'].sum(), self.columns['tgt_truncated'].sum()))
+        for i, key in enumerate(self.columns['plans'].tolist()):
+            lines.append('%s (plan %s), %d cut by max_pos' % (_describe('n_chunks', self.columns['n_chunks'][:, i]),
+                                                             key, self.columns['pos_truncated'][:, i].sum()))
+        return '\n'.join(lines)
+
+
+def _describe(name, values):
+    if len(values) == 0:
+        return '%s: -' % name
+    p50, p95 = np.percentile(values, [50, 95])
+    return '%s: total %d, mean %.1f, p50 %d, p95 %d, max %d' % (name, values.sum(), values.mean(), p50, p95,
+                                                                 values.max())
@@ -3,9 +3,13 @@ import torch.nn as nn
 from models.modeling_bert import BertModel, BertConfig
 from torch.nn.init import xavier_uniform_
 from typing import Optional, Tuple
+from models.chunking import SEP_ID, ChunkPlanner, ChunkStats, pad_chunks, plan_sent_mask, slice_chunks
 from models.longExtractiveFormer import LongExtTransformerEncoder, LongFormerConfig
+from models.longExtractiveFormerAttention import LongformerSelfAttention
 from models.optimizers import Optimizer
 from others.log import logger
+from others.profiling import labeled
+from others.timing import timer
 from torch.nn import functional as F
 from torch import Tensor, device
 import random
@@ -41,35 +45,79 @@ def build_optim(args, model, checkpoint):
     return optim
 
 
+def build_student_config(args, teacher_config):
+    """
+    BertConfig of the chunk encoder distilled with -mode distill: -student_layers layers of -student_hidden_size
+    (0 keeps the teacher size) with the vocabulary, positions and sections of the teacher.
+    """
+    hidden_size = args.student_hidden_size or teacher_config.hidden_size
+    return BertConfig(teacher_config.vocab_size,
+                      hidden_size=hidden_size,
+                      num_hidden_layers=args.student_layers,
+                      num_attention_heads=args.student_heads or teacher_config.num_attention_heads,
+                      intermediate_size=args.student_ff_size or 4 * hidden_size,
+                      max_position_embeddings=teacher_config.max_position_embeddings,
+                      type_vocab_size=teacher_config.type_vocab_size,
+                      section_size=getattr(teacher_config, 'section_size', 100))
+
+
 class Bert(nn.Module):
-    def __init__(self, large, temp_dir, finetune=False):
+    """
+    The chunk encoder: the pretrained BERT or, with `config`, a randomly initialized BertModel (a distillation
+    student, the benchmarks) whose vectors are projected to `hidden_size` when it is narrower, so the extractive
+    encoder of the teacher fits.
+    """
+    def __init__(self, large, temp_dir, finetune=False, config=None, hidden_size=None):
         super(Bert, self).__init__()
-        if large:
+        self.proj = None
+        if config is not None:
+            self.model = BertModel(config)
+            if hidden_size is not None and config.hidden_size != hidden_size:
+                self.proj = nn.Linear(config.hidden_size, hidden_size)
+        elif large:
             self.model = BertModel.from_pretrained('bert-large-uncased', cache_dir=temp_dir)
         else:
             self.model = BertModel.from_pretrained('bert-base-uncased', cache_dir=temp_dir)
+        self.hidden_size = hidden_size or self.model.config.hidden_size
 
         self.finetune = finetune
 
-    def forward(self, x, token_sections, segs, mask):
+    @labeled('Bert')
+    def forward(self, x, token_sections, segs, mask, position_ids=None):
         if self.finetune:
-            top_vec, _ = self.model(x, token_sections, segs, attention_mask=mask)
+            top_vec, _ = self.model(x, token_sections, segs, attention_mask=mask, position_ids=position_ids)
         else:
             self.eval()
             with torch.no_grad():
-                top_vec, _ = self.model(x, token_sections, segs, attention_mask=mask)
+                top_vec, _ = self.model(x, token_sections, segs, attention_mask=mask, position_ids=position_ids)
+        if self.proj is not None:
+            top_vec = self.proj(top_vec)
         return top_vec
 
 
 class ExtSummarizer(nn.Module):
-    def __init__(self, args, device_id, checkpoint):
+    def __init__(self, args, device_id, checkpoint, bert_config=None, hidden_size=None):
+        """
+        bert_config: builds a randomly initialized chunk encoder instead of loading the pretrained BERT
+        hidden_size: the width its vectors are projected to when it differs from bert_config (a narrow student)
+        """
         super(ExtSummarizer, self).__init__()
         self.args = args
         self.device = device_id
-        self.bert = Bert(args.large, args.temp_dir, args.finetune_bert)
+        if bert_config is not None:
+            self.bert = Bert(args.large, args.temp_dir, args.finetune_bert, config=bert_config,
+                             hidden_size=hidden_size)
+        elif getattr(args, 'student_layers', 0) > 0:
+            teacher_config = BertConfig.from_pretrained('bert-large-uncased' if args.large else 'bert-base-uncased',
+                                                        cache_dir=args.temp_dir)
+            # the student is always trained
+            self.bert = Bert(args.large, args.temp_dir, True, config=build_student_config(args, teacher_config),
+                             hidden_size=teacher_config.hidden_size)
+        else:
+            self.bert = Bert(args.large, args.temp_dir, args.finetune_bert)
         self.doc_len = args.max_pos
         self.chunk_size = args.chunk_size
-        self.config = LongFormerConfig(hidden_size=self.bert.model.config.hidden_size,
+        self.config = LongFormerConfig(hidden_size=self.bert.hidden_size,
                                        intermediate_size=args.ext_ff_size,
                                        num_hidden_layers=args.ext_layers,
                                        num_attention_heads=args.ext_heads,
@@ -94,12 +142,49 @@ class ExtSummarizer(nn.Module):
                     if p.dim() > 1:
                         xavier_uniform_(p)
         self.sigmoid = nn.Sigmoid()
+        self.chunk_encoder = None
+        self.chunk_planner = ChunkPlanner(self.chunk_size, args.chunk_packing, args.chunk_context, args.chunk_buckets)
+        self.chunk_stats = ChunkStats(self.bert.model.config.hidden_size, self.chunk_size)
         self.to(device_id)
 
-    def forward(self, src, sections, token_sections, segs, clss, mask_src, mask_cls):
-
-        sents_vec = self.chunked_sent_vectors(src[0], clss[0], token_sections[0], segs[0], mask_src[0])
+    def init_from_teacher(self, teacher):
+        """
+        Starts a distilled student from the extractive encoder of the teacher and, when the student has the width
+        of the teacher, from its embeddings and every k-th BERT layer (as DistilBERT).
+        """
+        self.ext_layer.load_state_dict(teacher.ext_layer.state_dict())
+        student, bert = self.bert.model, teacher.bert.model
+        if student.config.hidden_size == bert.config.hidden_size:
+            student.embeddings.load_state_dict(bert.embeddings.state_dict())
+            n_layers = len(bert.encoder.layer)
+            for i, layer in enumerate(student.encoder.layer):
+                layer.load_state_dict(bert.encoder.layer[i * n_layers // len(student.encoder.layer)].state_dict())
+
+    def forward(self, src, sections, token_sections, segs, clss, mask_src, mask_cls, chunk_plans=None,
+                return_vectors=False):
+        """ Returns the sentence scores and the mask, followed by the BERT sentence vectors with `return_vectors` """
+        sents_vec = self.sent_vectors(src, token_sections, segs, clss, mask_src, chunk_plans)
+        host_mask_cls = plan_sent_mask(chunk_plans[0], clss.size(1)) if chunk_plans is not None else None
+        sent_scores, mask = self.score_sent_vectors(sents_vec, sections, mask_cls, host_mask_cls=host_mask_cls)
+        if return_vectors:
+            return sent_scores, mask, sents_vec
+        return sent_scores, mask
+
+    def sent_vectors(self, src, token_sections, segs, clss, mask_src, chunk_plans=None):
+        """
+        BERT vectors of the sentences of the document, (1, n_sents, hidden_size).
+        They only depend on the BERT weights, so they can be reused by checkpoints that share a frozen BERT.
+        chunk_plans: the chunk plans Batch computed on the cpu, planned here (with a device sync) when missing.
+        """
+        chunk_plan = chunk_plans[0] if chunk_plans is not None else None
+        return self.chunked_sent_vectors(src[0], clss[0], token_sections[0], segs[0], mask_src[0],
+                                         chunk_plan).unsqueeze(0)
 
+    def score_sent_vectors(self, sents_vec, sections, mask_cls, position_offset=0, host_mask_cls=None):
+        """
+        Runs the long extractive encoder over the sentence vectors and returns the sentence scores.
+        host_mask_cls: cpu copy of mask_cls for the global attention, copied from the device (a sync) when missing.
+        """
         sents_vec = sents_vec * mask_cls[:, :, None].float()
         # ###################################################################################
         # prepare sents_vec for long former
@@ -109,10 +194,16 @@ class ExtSummarizer(nn.Module):
 
         # todo generate global attention indices fix
         global_attention_mask = self.build_global_attention_mask(sections[0])
+        if global_attention_mask is not None:
+            # the masked sentences (pruned by the cascade) are never global
+            if host_mask_cls is None:
+                host_mask_cls = mask_cls.cpu()
+            global_attention_mask = global_attention_mask * host_mask_cls.float()
 
         # merge `global_attention_mask` and `attention_mask`
         if global_attention_mask is not None:
-            attention_mask = self._merge_to_attention_mask(attention_mask, global_attention_mask)
+            attention_mask = self._merge_to_attention_mask(
+                attention_mask, global_attention_mask.to(self.device, non_blocking=True))
 
         position_ids = None
         padding_len, inputs_embeds, attention_mask, sections, position_ids = \
@@ -131,7 +222,11 @@ class ExtSummarizer(nn.Module):
         extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(attention_mask, input_shape, device)[:,
                                                 0, 0, :]
 
-        sent_scores = self.ext_layer(inputs_embeds, sections, attention_mask, extended_attention_mask).squeeze(-1)
+        is_global_attn, global_attn_indices = self._global_attn_indices(global_attention_mask, inputs_embeds.shape[1])
+        sent_scores = self.ext_layer(inputs_embeds, sections, attention_mask, extended_attention_mask,
+                                     is_global_attn=is_global_attn,
+                                     global_attn_indices=global_attn_indices,
+                                     position_offset=position_offset).squeeze(-1)
         sent_scores = self.sigmoid(sent_scores)
         return sent_scores, extended_attention_mask
 
@@ -150,54 +245,136 @@ class ExtSummarizer(nn.Module):
                 attentions.append((sections == index).nonzero(as_tuple=True)[0])
         attentions_tensor = np.zeros(sections.shape)
         attentions_tensor[attentions]=1
-        attentions_tensor = torch.Tensor(attentions_tensor).to(self.device).unsqueeze(0)
+        # stays on the cpu, the global attention indices are computed from it without a device sync
+        attentions_tensor = torch.Tensor(attentions_tensor).unsqueeze(0)
         return attentions_tensor
 
-    def _pad_to(self, data, pad_id=0):
-
-        data = torch.cat((data, pad_id * torch.ones((self.chunk_size - data.shape[0]))
-                          .to(self.device).to(int)), 0)
-        return data
-
-    def chunked_sent_vectors(self, src, clss, token_sections, segs, mask_src):
+    def _global_attn_indices(self, global_attention_mask, seq_len):
         """
-        This function divides the document into chunks of size= self.chunk_size and generates the sentence vectors
+        Computes the global attention indices of LongformerSelfAttention._get_global_attn_indices once, on the cpu
+        copy of the global attention mask, instead of from the device mask in every layer.
+        score_sent_vectors already cleared the sentences masked by mask_cls from the global attention mask, so the
+        indices agree with the device mask the layers see.
+        """
+        if global_attention_mask is None:
+            return False, None
+        is_index_global_attn = F.pad(global_attention_mask, [0, seq_len - global_attention_mask.shape[1]]) > 0
+        if not is_index_global_attn.any():
+            return False, None
+        max_num_global_attn_indices, *indices = \
+            LongformerSelfAttention._get_global_attn_indices(is_index_global_attn)
+        indices = [tuple(t.to(self.device, non_blocking=True) for t in index) for index in indices]
+        return True, (int(max_num_global_attn_indices), *indices)
+
+    @timer.timed('bert')
+    def chunked_sent_vectors(self, src, clss, token_sections, segs, mask_src, chunk_plan=None):
+        """
+        This function divides the document into chunks of less than self.chunk_size tokens at sentence boundaries
+        and generates the sentence vectors.
         We assume the batch size is 1 here. Maybe need to update the code for larger batch sizes.
         """
-
-        def _chunked_sent_vectors(start_index, end_index, start_sent_id, end_sent_id):
-            assert end_index - start_index < self.chunk_size, f" The current chunk has size {end_index - start_index} which is bigger than the size {self.chunk_size}| start: {start_index}, end: {end_index}"
-            cur_src = src[start_index:end_index]
-            assert cur_src[0].item() == 101, f" The chunk does not start with 101"
-            assert cur_src[-1].item() == 102, f" The chunk doesn't end with 102"
-            cur_src = self._pad_to(cur_src)
-            cur_segs = self._pad_to(segs[start_index: end_index])
-            cur_token_sections = self._pad_to(token_sections[start_index: end_index])
-            cur_mask_src = self._pad_to(mask_src[start_index:end_index])
-            cur_clss = clss[start_sent_id: end_sent_id]
-            top_vec = self.bert(cur_src.unsqueeze(0), cur_token_sections.unsqueeze(0), cur_segs.unsqueeze(0),
-                                cur_mask_src.unsqueeze(0))[0]
-            sent_vectors = top_vec[cur_clss - start_index]
-            return sent_vectors
-
-        start_index = 0
-        start_sent_id = 0
+        if chunk_plan is None:
+            chunk_plan = self.chunk_planner(clss.tolist(), src.shape[0])
+        bucket, spans = chunk_plan
+        chunks = slice_chunks(src, token_sections, segs, mask_src, spans)
+        if self.args.debug:
+            for start_index, end_index, _, _ in spans:
+                assert end_index - start_index < self.chunk_size, f" The current chunk has size {end_index - start_index} which is bigger than the size {self.chunk_size}| start: {start_index}, end: {end_index}"
+            for chunk in chunks:
+                assert chunk[0][0].item() == 101, f" The chunk does not start with 101"
+                assert chunk[0][-1].item() == 102, f" The chunk doesn't end with 102"
+
+        top_vecs = self.encode_chunks(chunks, bucket)
         sentence_vectors = []
-        for i, cls in enumerate(clss):
-            if cls - start_index >= self.chunk_size:
-                end_index = clss[i - 1]
-                sent_vecs = _chunked_sent_vectors(start_index, end_index, start_sent_id, i - 1)
-                sentence_vectors.append(sent_vecs)
-                start_index = end_index
-                start_sent_id = i - 1
-        # handle the remaining items that do not fit in memory
-        end_index = src.shape[0]
-        if end_index - start_index >= self.chunk_size:  # trim the last
-            end_index = start_index + self.chunk_size-1
-            src[end_index - 1] = 102
-        sent_vecs = _chunked_sent_vectors(start_index, end_index, start_sent_id, clss.shape[0])
-        sentence_vectors.append(sent_vecs)
-        return torch.cat(sentence_vectors, 0)
+        for top_vec, (start_index, end_index, start_sent_id, end_sent_id) in zip(top_vecs, spans):
+            # sentences starting past the end of a cut chunk get the vector of its last [SEP]
+            sentence_vectors.append(top_vec[(clss[start_sent_id:end_sent_id] - start_index)
+                                    .clamp(max=end_index - start_index - 1)])
+        sentence_vectors = torch.cat(sentence_vectors, 0)
+        if sentence_vectors.shape[0] < clss.shape[0]:
+            # a cascade dropped chunks, their sentences are masked and get zero vectors
+            sent_ids = torch.cat([torch.arange(start_sent_id, end_sent_id, device=sentence_vectors.device)
+                                  for _, _, start_sent_id, end_sent_id in spans])
+            sentence_vectors = sentence_vectors.new_zeros((clss.shape[0], sentence_vectors.shape[1])) \
+                .index_copy(0, sent_ids, sentence_vectors)
+        return sentence_vectors
+
+    def stream_scores(self, src, token_sections, segs, clss, sections, window=256):
+        """
+        Scores an arbitrarily long document `window` sentences at a time and yields (sentence ids, scores) as
+        soon as they are final, with memory bound by the window instead of the document.
+        The inputs are the python lists of a BERT shard example, without the max_pos truncation.
+
+        Every window is encoded with the receptive field of the local attention on each side
+        (ext_layers * attention_window / 2 sentences), the BERT chunks are planned once for the whole document
+        and the chunks shared by consecutive windows are encoded once. Without global attention
+        (-global_attention 0) the scores are those of the full document; global attention only reaches the
+        sentences of the window.
+        """
+        context = self.config.num_hidden_layers * (max(self.config.attention_window) // 2)
+        max_section = self.config.section_size - 1
+        n_sents = len(clss)
+        bucket, spans = self.chunk_planner(clss, len(src))
+        # the chunk giving the vector of every sentence
+        sent_span = [0] * n_sents
+        for i, (_, _, start_sent_id, end_sent_id) in enumerate(spans):
+            for j in range(start_sent_id, end_sent_id):
+                sent_span[j] = i
+
+        cache = {}  # chunk id -> sentence vectors, kept while the next window needs them
+        for start in range(0, n_sents, window):
+            end = min(start + window, n_sents)
+            first, last = max(0, start - context), min(n_sents, end + context)
+            span_ids = list(range(sent_span[first], sent_span[last - 1] + 1))
+            missing = [i for i in span_ids if i not in cache]
+            if missing:
+                cache.update(zip(missing, self._span_sent_vectors(src, token_sections, segs, clss,
+                                                                  [spans[i] for i in missing], bucket)))
+            cache = {i: cache[i] for i in span_ids}
+            vectors = torch.cat([cache[i] for i in span_ids], 0)
+            offset = spans[span_ids[0]][2]
+            sents_vec = vectors[first - offset:last - offset].unsqueeze(0)
+
+            window_sections = torch.tensor([min(section, max_section) for section in sections[first:last]],
+                                           device=self.device).unsqueeze(0)
+            host_mask_cls = torch.ones((1, last - first), dtype=torch.bool)
+            sent_scores, _ = self.score_sent_vectors(sents_vec, window_sections, host_mask_cls.to(self.device),
+                                                     position_offset=first, host_mask_cls=host_mask_cls)
+            yield list(range(start, end)), sent_scores[0, start - first:end - first]
+
+    def _span_sent_vectors(self, src, token_sections, segs, clss, spans, bucket):
+        """ Sentence vectors of the chunks `spans` of a document given as python lists """
+        max_section = self.bert.model.embeddings.section_embedding.num_embeddings - 1
+        chunks = []
+        for start_index, end_index, _, _ in spans:
+            cur_src = src[start_index:end_index]
+            if end_index < len(src) and src[end_index - 1] != SEP_ID:
+                cur_src = cur_src[:-1] + [SEP_ID]
+            cur_token_sections = [min(section, max_section) for section in token_sections[start_index:end_index]]
+            chunks.append(tuple(torch.tensor(x, dtype=torch.long, device=self.device) for x in
+                                (cur_src, cur_token_sections, segs[start_index:end_index],
+                                 [1] * (end_index - start_index))))
+        top_vecs = self.encode_chunks(chunks, bucket)
+        return [top_vec[(torch.tensor(clss[start_sent_id:end_sent_id], device=self.device) - start_index)
+                        .clamp(max=end_index - start_index - 1)]
+                for top_vec, (start_index, end_index, start_sent_id, end_sent_id) in zip(top_vecs, spans)]
+
+    def encode_chunks(self, chunks, bucket=None):
+        """
+        Runs BERT over the chunks, a list of (src, token_sections, segs, mask_src) of any length, and returns
+        their token vectors, -bert_batch_size chunks at a time padded to the longest chunk (at most `bucket`).
+        A `chunk_encoder` (e.g. the server's ChunkScheduler) can batch them with the chunks of other documents.
+        """
+        if self.chunk_encoder is not None:
+            return self.chunk_encoder.encode(chunks)
+        top_vecs = []
+        for i in range(0, len(chunks), self.args.bert_batch_size):
+            batch = chunks[i:i + self.args.bert_batch_size]
+            inputs, width = pad_chunks(batch, bucket or self.chunk_size)
+            self.chunk_stats.update(len(batch), sum(chunk[0].shape[0] for chunk in batch), len(batch), width,
+                                    bucket)
+            top_vecs.extend(self.bert(*inputs))
+        return top_vecs
 
     @staticmethod
     def _merge_to_attention_mask(attention_mask: torch.Tensor, global_attention_mask: torch.Tensor):
@@ -243,6 +420,9 @@ class ExtSummarizer(nn.Module):
                     dtype=torch.long,
                 )
                 inputs_embeds_padding = self.bert.model.embeddings(input_ids_padding)
+                if self.bert.proj is not None:
+                    # the sentence vectors of a narrow student are projected to the width of the encoder
+                    inputs_embeds_padding = self.bert.proj(inputs_embeds_padding)
                 inputs_embeds = torch.cat([inputs_embeds, inputs_embeds_padding], dim=-2)
 
             attention_mask = F.pad(attention_mask, [0, padding_len], value=False)  # no attention on the padding tokens
@@ -178,11 +178,12 @@ class Optimizer(object):
             for op in self.optimizer.optimizers:
                 op.param_groups[0]['lr'] = self.learning_rate
 
-    def step(self):
+    def step(self, scaler=None):
         """Update the model parameters based on current gradients.
 
         Optionally, will employ gradient modification or update learning
-        rate.
+        rate. When a `torch.cuda.amp.GradScaler` is given the gradients are
+        unscaled before clipping and the step is skipped on inf/nan.
         """
         self._step += 1
 
@@ -205,6 +206,14 @@ class Optimizer(object):
         if self.method != 'sparseadam':
             self.optimizer.param_groups[0]['lr'] = self.learning_rate
 
+        if scaler is not None and scaler.is_enabled():
+            scaler.unscale_(self.optimizer)
+            if self.max_grad_norm:
+                clip_grad_norm_(self.params, self.max_grad_norm)
+            scaler.step(self.optimizer)
+            scaler.update()
+            return
+
         if self.max_grad_norm:
             clip_grad_norm_(self.params, self.max_grad_norm)
         self.optimizer.step()
@@ -6,6 +6,7 @@ import time
 from datetime import datetime
 
 from others.log import logger
+from others.timing import timer
 
 
 def build_report_manager(opt):
@@ -72,7 +73,7 @@ class ReportMgrBase(object):
         if step % self.report_every == 0:
             if multigpu:
                 report_stats = \
-                    Statistics.all_gather_stats(report_stats)
+                    Statistics.all_reduce_stats(report_stats)
             self._report_training(
                 step, num_steps, learning_rate, report_stats)
             self.progress_step += 1
@@ -132,10 +133,24 @@ class ReportMgr(ReportMgrBase):
                                    "progress",
                                    learning_rate,
                                    self.progress_step)
+        self._report_timing(step)
         report_stats = Statistics()
 
         return report_stats
 
+    def _report_timing(self, step):
+        """ Logs the p50/p95 time of every stage since the last report, see others.timing """
+        summary = timer.summary()
+        if not summary:
+            return
+        self.log('Step %d; time %s' % (step, timer))
+        if self.tensorboard_writer is not None:
+            for name, (count, p50, p95, total) in summary.items():
+                self.tensorboard_writer.add_scalar('time/%s_p50_ms' % name, 1000 * p50, step)
+                self.tensorboard_writer.add_scalar('time/%s_p95_ms' % name, 1000 * p95, step)
+                self.tensorboard_writer.add_scalar('time/%s_total_s' % name, total, step)
+        timer.reset()
+
     def _report_step(self, lr, step, train_stats=None, valid_stats=None):
         """
         See base class method `ReportMgrBase.report_step`.
@@ -156,59 +171,47 @@ class Statistics(object):
     Accumulator for loss statistics.
     Currently calculates:
 
-    * accuracy
-    * perplexity
+    * cross entropy per document
+    * documents, tokens, BERT chunks and positive sentences
     * elapsed time
+
+    The loss may be a device tensor: it is summed on the device and only copied to the host (a device sync) when
+    it is read, i.e. at report_every.
     """
 
-    def __init__(self, loss=0, n_docs=0, n_correct=0):
+    def __init__(self, loss=0, n_docs=0, n_correct=0, n_tokens=0, n_chunks=0, n_positives=0):
         self.loss = loss
         self.n_docs = n_docs
+        self.n_tokens = n_tokens
+        self.n_chunks = n_chunks
+        self.n_positives = n_positives
         self.start_time = time.time()
 
     @staticmethod
-    def all_gather_stats(stat, max_size=4096):
+    def all_reduce_stats(stat):
         """
-        Gather a `Statistics` object across multiple process/nodes
+        Sums a `Statistics` object over all processes/nodes with one tensor all-reduce
 
         Args:
-            stat(:obj:Statistics): the statistics object to gather
-                across all processes/nodes
-            max_size(int): max buffer size to use
+            stat(:obj:Statistics): the statistics object to reduce
 
         Returns:
             `Statistics`, the update stats object
         """
-        stats = Statistics.all_gather_stats_list([stat], max_size=max_size)
-        return stats[0]
-
-    @staticmethod
-    def all_gather_stats_list(stat_list, max_size=4096):
-        """
-        Gather a `Statistics` list across all processes/nodes
-
-        Args:
-            stat_list(list([`Statistics`])): list of statistics objects to
-                gather across all processes/nodes
-            max_size(int): max buffer size to use
-
-        Returns:
-            our_stats(list([`Statistics`])): list of updated stats
-        """
-        from torch.distributed import get_rank
-        from distributed import all_gather_list
-
-        # Get a list of world_size lists with len(stat_list) Statistics objects
-        all_stats = all_gather_list(stat_list, max_size=max_size)
-
-        our_rank = get_rank()
-        our_stats = all_stats[our_rank]
-        for other_rank, stats in enumerate(all_stats):
-            if other_rank == our_rank:
-                continue
-            for i, stat in enumerate(stats):
-                our_stats[i].update(stat, update_n_src_words=True)
-        return our_stats
+        import torch
+        # nccl only reduces cuda tensors, gloo works on cpu tensors
+        device = 'cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu'
+        loss = stat.loss.detach().double().to(device) if torch.is_tensor(stat.loss) \
+            else torch.tensor(float(stat.loss), dtype=torch.float64, device=device)
+        counts = torch.tensor([stat.n_docs, stat.n_tokens, stat.n_chunks, stat.n_positives], dtype=torch.float64,
+                              device=device)
+        values = torch.cat([loss.view(1), counts])
+        torch.distributed.all_reduce(values)
+        loss, n_docs, n_tokens, n_chunks, n_positives = values.tolist()
+        stat.loss = loss
+        stat.n_docs, stat.n_tokens, stat.n_chunks, stat.n_positives = \
+            int(n_docs), int(n_tokens), int(n_chunks), int(n_positives)
+        return stat
 
     def update(self, stat, update_n_src_words=False):
         """
@@ -220,14 +223,23 @@ class Statistics(object):
                 or not
 
         """
-        self.loss += stat.loss
+        self.loss = self.loss + stat.loss
         self.n_docs += stat.n_docs
+        self.n_tokens += stat.n_tokens
+        self.n_chunks += stat.n_chunks
+        self.n_positives += stat.n_positives
+
+    def sync(self):
+        """ Copies a device loss to the host """
+        if not isinstance(self.loss, (int, float)):
+            self.loss = float(self.loss)
+        return self
 
     def xent(self):
         """ compute cross entropy """
         if self.n_docs == 0:
             return 0
-        return self.loss / self.n_docs
+        return self.sync().loss / self.n_docs
 
     def elapsed_time(self):
         """ compute elapsed time """
@@ -247,11 +259,14 @@ class Statistics(object):
             step_fmt = "%s/%5d" % (step_fmt, num_steps)
         logger.info(
             ("Step %s; xent: %4.2f; " +
-             "lr: %7.7f; %3.0f docs/s; %6.0f sec")
+             "lr: %7.7f; %3.0f docs/s; %5.0f tok/s; %d chunks; %d positives; %6.0f sec")
             % (step_fmt,
                self.xent(),
                learning_rate,
                self.n_docs/ (t + 1e-5),
+               self.n_tokens / (t + 1e-5),
+               self.n_chunks,
+               self.n_positives,
                time.time() - start))
         sys.stdout.flush()
 
@@ -260,3 +275,6 @@ class Statistics(object):
         t = self.elapsed_time()
         writer.add_scalar(prefix + "/xent", self.xent(), step)
         writer.add_scalar(prefix + "/lr", learning_rate, step)
+        writer.add_scalar(prefix + "/tok_per_sec", self.n_tokens / (t + 1e-5), step)
+        writer.add_scalar(prefix + "/chunks", self.n_chunks, step)
+        writer.add_scalar(prefix + "/positives", self.n_positives, step)
@@ -1,13 +1,22 @@
+import contextlib
 import os
+import random
+import time
 
 import numpy as np
 import torch
 from tensorboardX import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
 
 import distributed
+from models.cascade import CascadeStats
+from models.chunking import plan_sent_mask
+from models.data_loader import Prefetcher
 from models.reporter_ext import ReportMgr, Statistics
 from others.log import logger
-from others.utils import test_rouge, rouge_results_to_str
+from others.profiling import ProfileWindow
+from others.timing import timer
+from others.utils import test_rouge, rouge_results_to_str, autocast
 
 
 def _tally_parameters(model):
@@ -15,7 +24,7 @@ def _tally_parameters(model):
     return n_params
 
 
-def build_trainer(args, device_id, model, optim):
+def build_trainer(args, device_id, model, optim, teacher=None):
     """
     Simplify `Trainer` creation based on user `opt`s*
     Args:
@@ -46,7 +55,7 @@ def build_trainer(args, device_id, model, optim):
 
     report_manager = ReportMgr(args.report_every, start_time=-1, tensorboard_writer=writer)
 
-    trainer = Trainer(args, model, optim, grad_accum_count, n_gpu, gpu_rank, report_manager)
+    trainer = Trainer(args, model, optim, grad_accum_count, n_gpu, gpu_rank, report_manager, teacher)
 
     if model:
         n_params = _tally_parameters(model)
@@ -55,6 +64,48 @@ def build_trainer(args, device_id, model, optim):
     return trainer
 
 
+def sharded_result_path(result_path, step, rank, suffix):
+    return '%s_step%d.rank%d.%s' % (result_path, step, rank, suffix)
+
+
+def report_rouge(args, can_path, gold_path, step):
+    if step != -1 and args.report_rouge:
+        rouges = test_rouge(can_path, gold_path)
+        logger.info('temp_dir is: {}'.format(args.temp_dir))
+        logger.info('Rouges at step %d \n%s' % (step, rouge_results_to_str(rouges)))
+
+
+def merge_sharded_results(args, step, world_size):
+    """
+    Merges the per-rank outputs of a sharded test run into
+    `%s_step%d.candidate` and `.gold`, ordered by doc id,
+    and reports ROUGE on the merged files.
+    """
+    docs = {}
+    for rank in range(world_size):
+        can_path = sharded_result_path(args.result_path, step, rank, 'candidate')
+        gold_path = sharded_result_path(args.result_path, step, rank, 'gold')
+        with open(can_path) as can_file, open(gold_path) as gold_file:
+            for can_line, gold_line in zip(can_file, gold_file):
+                doc_id, candidate = can_line.rstrip('\n').split('\t', 1)
+                _, gold = gold_line.rstrip('\n').split('\t', 1)
+                docs[int(doc_id)] = (candidate, gold)
+
+    can_path = '%s_step%d.candidate' % (args.result_path, step)
+    gold_path = '%s_step%d.gold' % (args.result_path, step)
+    with open(can_path, 'w') as save_pred, open(gold_path, 'w') as save_gold:
+        for doc_id in sorted(docs):
+            candidate, gold = docs[doc_id]
+            save_pred.write(candidate + '\n')
+            save_gold.write(gold + '\n')
+    logger.info('Merged %d documents of %d ranks into %s' % (len(docs), world_size, can_path))
+    for rank in range(world_size):
+        os.remove(sharded_result_path(args.result_path, step, rank, 'candidate'))
+        os.remove(sharded_result_path(args.result_path, step, rank, 'gold'))
+
+    report_rouge(args, can_path, gold_path, step)
+
+
 class Trainer(object):
     """
     Class that controls the training process.
@@ -67,12 +118,14 @@ class Trainer(object):
             grad_accum_count(int): accumulate gradients this many times.
             report_manager(:obj:`onmt.utils.ReportMgrBase`):
                 the object that creates reports, or None
+            teacher(:obj:`ExtSummarizer`): with -mode distill, the frozen model whose
+                sentence vectors or scores the student learns
 
     """
 
     def __init__(self, args, model, optim,
                  grad_accum_count=1, n_gpu=1, gpu_rank=1,
-                 report_manager=None):
+                 report_manager=None, teacher=None):
         # Basic attributes.
         self.args = args
         self.save_checkpoint_steps = args.save_checkpoint_steps
@@ -82,12 +135,20 @@ class Trainer(object):
         self.n_gpu = n_gpu
         self.gpu_rank = gpu_rank
         self.report_manager = report_manager
+        self.ddp = isinstance(model, DistributedDataParallel)
+        self.device = "cpu" if args.visible_gpus == '-1' else "cuda"
+        self.precision = args.precision
+        # bf16 keeps the fp32 exponent range, only fp16 needs dynamic loss scaling
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.precision == 'fp16')
 
         self.loss = torch.nn.BCELoss(reduction='none')
+        self.teacher = teacher
         assert grad_accum_count > 0
         # Set model in training mode.
         if model:
             self.model.train()
+        if teacher:
+            self.teacher.eval()
 
     def train(self, train_iter_fct, train_steps, valid_iter_fct=None, valid_steps=-1):
         """
@@ -97,8 +158,8 @@ class Trainer(object):
 
         Args:
             train_iter_fct(function): a function that returns the train
-                iterator. e.g. something like
-                train_iter_fct = lambda: generator(*args, **kwargs)
+                iterator of an epoch. e.g. something like
+                train_iter_fct = lambda epoch: generator(epoch, *args, **kwargs)
             valid_iter_fct(function): same as train_iter_fct, for valid data
             train_steps(int):
             valid_steps(int):
@@ -109,52 +170,70 @@ class Trainer(object):
         logger.info('Start training...')
 
         step = self.optim._step + 1
-        true_batchs = []
         accum = 0
-        normalization = 0
-        train_iter = train_iter_fct()
+        epoch = 0
 
         total_stats = Statistics()
         report_stats = Statistics()
         self._start_report_manager(start_time=total_stats.start_time)
+        profiler = ProfileWindow(self.args.profile_steps, os.path.join(self.args.tensorboard_log_path, 'profile'),
+                                 'train', self.device)
+        step_start = time.perf_counter()
 
         while step <= train_steps:
-
-            reduce_counter = 0
-            for i, batch in enumerate(train_iter):
-                if self.n_gpu == 0 or (i % self.n_gpu == self.gpu_rank):
-
-                    true_batchs.append(batch)
-                    normalization += batch.batch_size
+            train_iter = Prefetcher(train_iter_fct(epoch), self.args.prefetch)
+            next_epoch = epoch + 1
+
+            for i, batch in enumerate(timer.iterate(train_iter, 'data')):
+                # with ddp every rank iterates over its own shards
+                if self.n_gpu == 0 or self.ddp or (i % self.n_gpu == self.gpu_rank):
+                    # every batch is run as soon as it arrives, only its gradients are kept until the step
+                    if accum == 0:
+                        profiler.step(step)
+                        self.model.zero_grad()
                     accum += 1
+                    # with ddp the gradients are only all-reduced in the backward of the last accumulated batch
+                    sync = not self.ddp or accum == self.grad_accum_count
+                    with contextlib.ExitStack() as stack:
+                        if not sync:
+                            stack.enter_context(self.model.no_sync())
+                        self._forward_backward(batch, total_stats, report_stats)
+                    del batch
+
                     # it keeps accumulating the gradients until reach a limit
                     if accum == self.grad_accum_count:
-                        reduce_counter += 1
-                        if self.n_gpu > 1:
-                            normalization = sum(distributed
-                                                .all_gather_list
-                                                (normalization))
-
-                        self._gradient_accumulation( # this is the main function that calculates the loss
-                            true_batchs, normalization, total_stats,
-                            report_stats)
+                        self._optim_step()
+                        now = time.perf_counter()
+                        timer.record('step', now - step_start)
+                        step_start = now
 
                         report_stats = self._maybe_report_training(
                             step, train_steps,
                             self.optim.learning_rate,
                             report_stats)
+                        newest = epoch
+                        if step % self.args.report_every == 0:
+                            self._log_chunk_stats()
+                            if self.ddp:
+                                # the ranks run out of their shards at different steps: the first one to start the
+                                # next epoch takes the others along at the next report, where the ranks already
+                                # wait for each other to sum the statistics, so that every rank shuffles with the
+                                # same epoch
+                                newest = distributed.all_reduce_max(epoch)
 
-                        true_batchs = []
                         accum = 0
-                        normalization = 0
                         if step % self.save_checkpoint_steps == 0 and self.gpu_rank == 0:  # save in the master GPU only
                             self._save(step)
 
                         step += 1
                         if step > train_steps:
                             break
-            train_iter = train_iter_fct()
+                        if newest > epoch:
+                            next_epoch = newest
+                            break
+            epoch = next_epoch
 
+        profiler.close()
         return total_stats
 
     def validate(self, valid_iter, step=0):
@@ -178,13 +257,50 @@ class Trainer(object):
                 sections = batch.sections
                 token_sections = batch.token_sections
                 batch_size, sent_count = mask_cls.shape
-                sent_scores, mask = self.model(src, sections, token_sections, segs, clss, mask, mask_cls)
-                sent_scores = sent_scores[:, :sent_count]
+                with autocast(self.precision, self.device):
+                    sent_scores, mask = self.model(src, sections, token_sections, segs, clss, mask, mask_cls,
+                                           batch.chunk_plans)
+                sent_scores = sent_scores[:, :sent_count].float()
                 loss = self.loss(sent_scores, labels.float())
                 loss = (loss * mask_cls.float()).sum()
-                batch_stats = Statistics(float(loss.cpu().data.numpy()), len(labels))
-                stats.update(batch_stats)
+                stats.update(self._batch_stats(loss, batch))
             self._report_step(0, step, valid_stats=stats)
+            self._log_chunk_stats()
+            return stats
+
+    def validate_batches(self, batches, step=0, sent_vecs_cache=None):
+        """ Validate model on batches that are already in memory.
+            sent_vecs_cache: optional list with one entry per batch, None entries are filled with the
+                BERT sentence vectors of the batch and filled entries are used instead of running BERT.
+        Returns:
+            :obj:`nmt.Statistics`: validation loss statistics
+        """
+        self.model.eval()
+        stats = Statistics()
+
+        with torch.no_grad():
+            for i, batch in enumerate(batches):
+                labels = batch.src_sent_labels
+                mask_cls = batch.mask_cls
+                batch_size, sent_count = mask_cls.shape
+                with autocast(self.precision, self.device):
+                    if sent_vecs_cache is not None and sent_vecs_cache[i] is not None:
+                        sents_vec = sent_vecs_cache[i].to(mask_cls.device)
+                    else:
+                        sents_vec = self.model.sent_vectors(batch.src, batch.token_sections, batch.segs,
+                                                            batch.clss, batch.mask_src, batch.chunk_plans)
+                        if sent_vecs_cache is not None:
+                            sent_vecs_cache[i] = sents_vec.cpu()
+                    host_mask_cls = plan_sent_mask(batch.chunk_plans[0], sent_count) \
+                        if batch.chunk_plans is not None else None
+                    sent_scores, _ = self.model.score_sent_vectors(sents_vec, batch.sections, mask_cls,
+                                                                   host_mask_cls=host_mask_cls)
+                sent_scores = sent_scores[:, :sent_count].float()
+                loss = self.loss(sent_scores, labels.float())
+                loss = (loss * mask_cls.float()).sum()
+                stats.update(self._batch_stats(loss, batch))
+            self._report_step(0, step, valid_stats=stats)
+            self._log_chunk_stats()
             return stats
 
     def test(self, test_iter, step, cal_lead=False, cal_oracle=False):
@@ -214,13 +330,24 @@ class Trainer(object):
         if not cal_lead and not cal_oracle:
             self.model.eval()
         stats = Statistics()
-
-        can_path = '%s_step%d.candidate' % (self.args.result_path, step)
-        gold_path = '%s_step%d.gold' % (self.args.result_path, step)
+        cascade_stats = CascadeStats()
+
+        # in a sharded run every rank writes its documents prefixed with their doc id,
+        # merge_sharded_results restores the order and reports ROUGE once
+        sharded = self.n_gpu > 1
+        if sharded:
+            can_path = sharded_result_path(self.args.result_path, step, self.gpu_rank, 'candidate')
+            gold_path = sharded_result_path(self.args.result_path, step, self.gpu_rank, 'gold')
+        else:
+            can_path = '%s_step%d.candidate' % (self.args.result_path, step)
+            gold_path = '%s_step%d.gold' % (self.args.result_path, step)
+        profiler = ProfileWindow(self.args.profile_test_batches,
+                                 os.path.join(self.args.tensorboard_log_path, 'profile'), 'test', self.device)
         with open(can_path, 'w') as save_pred:
             with open(gold_path, 'w') as save_gold:
                 with torch.no_grad():
-                    for batch in test_iter: # each batch has one document
+                    for batch_index, batch in enumerate(test_iter): # each batch has one document
+                        profiler.step(batch_index)
                         src = batch.src
                         labels = batch.src_sent_labels
                         segs = batch.segs
@@ -232,6 +359,10 @@ class Trainer(object):
 
                         gold = []
                         pred = []
+                        doc_ids = []
+                        if batch.cascade_stats is not None:
+                            for stat in batch.cascade_stats:
+                                cascade_stats.update(stat)
 
                         if cal_lead:
                             selected_ids = [list(range(batch.clss.size(1)))] * batch.batch_size
@@ -240,12 +371,14 @@ class Trainer(object):
                                             range(batch.batch_size)]
                         else:
                             batch_size, sent_count = mask_cls.shape
-                            sent_scores, mask = self.model(src, sections, token_sections, segs, clss, mask, mask_cls)
-                            sent_scores = sent_scores[:, :sent_count]  # remove padded items from returned scores
+                            with autocast(self.precision, self.device):
+                                sent_scores, mask = self.model(src, sections, token_sections, segs, clss, mask,
+                                                               mask_cls, batch.chunk_plans)
+                            # remove padded items from returned scores
+                            sent_scores = sent_scores[:, :sent_count].float()
                             loss = self.loss(sent_scores, labels.float())
                             loss = (loss * mask_cls.float()).sum()
-                            batch_stats = Statistics(float(loss.cpu().data.numpy()), len(labels))
-                            stats.update(batch_stats)
+                            stats.update(self._batch_stats(loss, batch))
 
                             sent_scores = sent_scores.cpu().data.numpy()
                             selected_ids = np.argsort(-sent_scores, 1)
@@ -282,75 +415,109 @@ class Trainer(object):
 
                             pred.append(_pred)
                             gold.append(batch.tgt_str[i])
+                            doc_ids.append(batch.doc_ids[i])
+                        prefixes = ['%d\t' % doc_id if sharded else '' for doc_id in doc_ids]
                         for i in range(len(gold)):
-                            save_gold.write(gold[i].strip() + '\n')
+                            save_gold.write(prefixes[i] + gold[i].strip() + '\n')
                         for i in range(len(pred)):
-                            save_pred.write(pred[i].strip() + '\n')
+                            save_pred.write(prefixes[i] + pred[i].strip() + '\n')
 
-        if step != -1 and self.args.report_rouge:
-            rouges = test_rouge( can_path, gold_path)
-            logger.info('temp_dir is: {}'.format(self.args.temp_dir))
-            logger.info('Rouges at step %d \n%s' % (step, rouge_results_to_str(rouges)))
+        profiler.close()
+        if cascade_stats.n_sents > 0:
+            logger.info('Step %d %s' % (step, cascade_stats))
+        if not sharded:
+            report_rouge(self.args, can_path, gold_path, step)
         self._report_step(0, step, valid_stats=stats)
+        self._log_chunk_stats()
         return stats
 
-    def _gradient_accumulation(self, true_batchs, normalization, total_stats,
-                               report_stats):
+    def _optim_step(self):
+        """ Updates the parameters with the gradients accumulated since the last step """
+        # Multi GPU gradient gather, ddp already all-reduced them in the backward
+        if self.n_gpu > 1 and not self.ddp:
+            grads = [p.grad.data for p in self.model.parameters()
+                     if p.requires_grad
+                     and p.grad is not None]
+            with timer.span('all_reduce'):
+                distributed.all_reduce_and_rescale_tensors(grads, float(1))
+        with timer.span('optim'):
+            self.optim.step(self.scaler)
+
+    def _forward_backward(self, batch, total_stats, report_stats):
+        """ Forward and backward pass of one batch, the gradients are accumulated in the model """
+        # each batch is a 1024 tokens and the sentences that fit in the this length
+        src = batch.src
+        labels = batch.src_sent_labels
+        segs = batch.segs
+        clss = batch.clss
+        mask = batch.mask_src
+        mask_cls = batch.mask_cls
+        sections = batch.sections
+        token_sections = batch.token_sections
+        batch_size, sent_count = mask_cls.shape
+        with timer.span('forward'):
+            if self.teacher is not None:
+                loss = self._distill_loss(batch)
+            else:
+                with autocast(self.precision, self.device):
+                    sent_scores, mask = self.model(src, sections, token_sections, segs, clss, mask, mask_cls,
+                                                   batch.chunk_plans)
+
+                # remove padded items from returned scores, the loss is always computed in fp32
+                sent_scores = sent_scores[:, :sent_count].float()
+
+                loss = self.loss(sent_scores, labels.float())
+                loss = (loss * mask_cls.float()).sum()
+        # ddp averages the gradients of the ranks, the all-reduce of the legacy path sums them
+        world_scale = self.n_gpu if self.ddp else 1
+        with timer.span('backward'):
+            self.scaler.scale(loss / loss.numel() * world_scale).backward()
+
+        # the documents of the other ranks are summed when the stats are reported
+        batch_stats = self._batch_stats(loss, batch)
+        total_stats.update(batch_stats)
+        report_stats.update(batch_stats)
+
+    @staticmethod
+    def _batch_stats(loss, batch):
+        """ Statistics of a batch, the loss stays on the device until it is reported """
+        return Statistics(loss.detach().float(), batch.batch_size, n_tokens=batch.n_tokens,
+                          n_chunks=batch.n_chunks, n_positives=batch.n_positives)
+
+    def _distill_loss(self, batch):
         """
-        normalization: number of documents processed until grad_accumulate is reached
+        Summed loss of the student against the teacher on the sentences of the batch, by -distill_loss:
+        'vectors' the squared error of the BERT sentence vectors, 'scores' the cross entropy against the teacher
+        scores, 'both' the two weighted by -distill_alpha.
         """
-        if self.grad_accum_count > 1:
-            self.model.zero_grad()
-
-        for batch in true_batchs:
-            if self.grad_accum_count == 1:
-                self.model.zero_grad()
-            # each batch is a 1024 tokens and the sentences that fit in the this length
-            src = batch.src
-            labels = batch.src_sent_labels
-            segs = batch.segs
-            clss = batch.clss
-            mask = batch.mask_src
-            mask_cls = batch.mask_cls
-            sections = batch.sections
-            token_sections = batch.token_sections
-            batch_size, sent_count = mask_cls.shape
-            sent_scores, mask = self.model(src, sections, token_sections, segs, clss, mask, mask_cls)
-
-            sent_scores = sent_scores[:, :sent_count]  # remove padded items from returned scores
-
-            loss = self.loss(sent_scores, labels.float())
-            loss = (loss * mask_cls.float()).sum()
-            (loss / loss.numel()).backward()
-            # loss.div(float(normalization)).backward()
-
-            batch_stats = Statistics(float(loss.cpu().data.numpy()), normalization)
-            # print('----stats info', batch_stats.loss, batch_stats.n_docs)
-            total_stats.update(batch_stats)
-            report_stats.update(batch_stats)
-
-            # 4. Update the parameters and statistics.
-            if self.grad_accum_count == 1:
-                # Multi GPU gradient gather
-                if self.n_gpu > 1:
-                    grads = [p.grad.data for p in self.model.parameters()
-                             if p.requires_grad
-                             and p.grad is not None]
-                    distributed.all_reduce_and_rescale_tensors(grads, float(1))
-                self.optim.step()
-
-        # in case of multi step gradient accumulation,
-        # update only after accum batches
-        if self.grad_accum_count > 1:
-            if self.n_gpu > 1:
-                grads = [p.grad.data for p in self.model.parameters()
-                         if p.requires_grad
-                         and p.grad is not None]
-                distributed.all_reduce_and_rescale_tensors(grads, float(1))
-            self.optim.step()
+        mask_cls = batch.mask_cls
+        sent_count = mask_cls.shape[1]
+        inputs = (batch.src, batch.sections, batch.token_sections, batch.segs, batch.clss, batch.mask_src, mask_cls,
+                  batch.chunk_plans)
+        # the same random global attention for both models
+        rng_state = random.getstate()
+        with torch.no_grad():
+            with autocast(self.precision, self.device):
+                teacher_scores, _, teacher_vec = self.teacher(*inputs, return_vectors=True)
+        random.setstate(rng_state)
+        with autocast(self.precision, self.device):
+            sent_scores, _, sents_vec = self.model(*inputs, return_vectors=True)
+
+        mask = mask_cls.float()
+        vec_loss = ((sents_vec.float() - teacher_vec.float()) ** 2).mean(-1)
+        vec_loss = (vec_loss * mask).sum()
+        score_loss = self.loss(sent_scores[:, :sent_count].float(), teacher_scores[:, :sent_count].float())
+        score_loss = (score_loss * mask).sum()
+        if self.args.distill_loss == 'vectors':
+            return vec_loss
+        if self.args.distill_loss == 'scores':
+            return score_loss
+        return self.args.distill_alpha * vec_loss + (1 - self.args.distill_alpha) * score_loss
 
     def _save(self, step):
-        real_model = self.model
+        real_model = (self.model.module
+                      if isinstance(self.model, DistributedDataParallel)
+                      else self.model)
         # real_generator = (self.generator.module
         #                   if isinstance(self.generator, torch.nn.DataParallel)
         #                   else self.generator)
@@ -392,9 +559,16 @@ class Trainer(object):
             stat: the updated (or unchanged) stat object
         """
         if stat is not None and self.n_gpu > 1:
-            return Statistics.all_gather_stats(stat)
+            return Statistics.all_reduce_stats(stat)
         return stat
 
+    def _log_chunk_stats(self):
+        """ Logs how much of the BERT input was padding since the last call """
+        model = self.model.module if self.ddp else self.model
+        if model.chunk_stats.chunks > 0:
+            logger.info('BERT %s' % model.chunk_stats)
+        model.chunk_stats.reset()
+
     def _maybe_report_training(self, step, num_steps, learning_rate,
                                report_stats):
         """
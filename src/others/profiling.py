@@ -0,0 +1,116 @@
+"""
+    On-demand torch.profiler capture windows (-profile_steps, -profile_test_batches): the profiled steps are
+    written as Chrome / TensorBoard traces and summarized by module.
+"""
+import functools
+import os
+from collections import Counter, defaultdict
+
+from torch.profiler import ProfilerActivity, profile, record_function, tensorboard_trace_handler
+
+from others.log import logger
+
+# the modules the op table is split by, their forward is labeled with @labeled
+MODULES = ('Bert', 'LongformerSelfAttention', 'PositionwiseFeedForward')
+
+
+def labeled(name):
+    """ Decorator giving every call of a forward its own scope in the traces and the op table """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with record_function(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def parse_window(window):
+    """ '100:110' -> (100, 110), '' -> None """
+    if not window:
+        return None
+    start, end = (int(x) for x in window.split(':'))
+    if start > end:
+        raise ValueError('profile window %s ends before it starts' % window)
+    return start, end
+
+
+class ProfileWindow(object):
+    """
+    Profiles the steps `window` = (start, end), both included, of a loop that calls step(n) before step n and
+    close() after the last one. The trace is written to `trace_dir` when the window closes and the top-k ops of
+    every module of MODULES are logged.
+    """
+
+    def __init__(self, window, trace_dir, name, device='cpu', top_k=15):
+        self.window = parse_window(window) if isinstance(window, str) else window
+        self.trace_dir = trace_dir
+        self.name = name
+        self.device = device
+        self.top_k = top_k
+        self.prof = None
+
+    def step(self, n):
+        if self.window is None:
+            return
+        start, end = self.window
+        if self.prof is None and start <= n <= end:
+            self._start(n)
+        elif self.prof is not None and n > end:
+            self.close()
+
+    def _start(self, n):
+        activities = [ProfilerActivity.CPU]
+        if self.device == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        logger.info('Profiling %s steps %d:%d' % (self.name, n, self.window[1]))
+        worker_name = '%s_steps%d-%d' % (self.name, n, self.window[1])
+        self.prof = profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True,
+                            on_trace_ready=tensorboard_trace_handler(self.trace_dir, worker_name=worker_name))
+        self.prof.start()
+
+    def close(self):
+        if self.prof is None:
+            return
+        prof, self.prof = self.prof, None
+        # one window per run
+        self.window = None
+        prof.stop()
+        logger.info('Wrote the %s profile to %s' % (self.name, self.trace_dir))
+        sort_by = 'self_cuda_time_total' if self.device == 'cuda' else 'self_cpu_time_total'
+        logger.info('Top ops by stack\n%s' % prof.key_averages(group_by_stack_n=5).table(sort_by=sort_by,
+                                                                                         row_limit=self.top_k))
+        logger.info('Top ops by module\n%s' % module_op_table(prof.events(), self.top_k,
+                                                              use_cuda=self.device == 'cuda'))
+
+
+def module_op_table(events, top_k=15, use_cuda=False):
+    """
+    Self time of the ops of every module of MODULES (the innermost labeled scope an op runs in, 'other' outside
+    them) and its top_k ops.
+    """
+    times = defaultdict(Counter)
+    calls = defaultdict(Counter)
+    for evt in events:
+        if evt.name in MODULES:
+            continue
+        module, parent = 'other', evt.cpu_parent
+        while parent is not None:
+            if parent.name in MODULES:
+                module = parent.name
+                break
+            parent = parent.cpu_parent
+        times[module][evt.name] += evt.self_cuda_time_total if use_cuda else evt.self_cpu_time_total
+        calls[module][evt.name] += 1
+
+    total = max(sum(sum(t.values()) for t in times.values()), 1)
+    lines = []
+    for module in sorted(times, key=lambda m: -sum(times[m].values())):
+        module_time = sum(times[module].values())
+        lines.append('%s: %.2fms self %s time (%.1f%%)' % (
+            module, module_time / 1000., 'cuda' if use_cuda else 'cpu', 100. * module_time / total))
+        for name, t in times[module].most_common(top_k):
+            lines.append('    %-50s %8d calls %10.2fms %6.1f%%' % (name[:50], calls[module][name], t / 1000.,
+                                                                   100. * t / total))
+    return '\n'.join(lines)
@@ -0,0 +1,105 @@
+"""
+    Always-on step time instrumentation: the wall time of named stages (shard loading, batch building, BERT,
+    the Longformer encoder, backward, all-reduce, optimizer step) recorded into ring buffers and reported as
+    p50/p95 per stage with the training reports.
+    The spans do not synchronize with the device: on cuda a stage is charged for the kernels it waits for, so the
+    time of queued kernels shows up in the next stage that blocks (usually backward or the optimizer step).
+"""
+import functools
+import math
+import threading
+import time
+from collections import deque
+
+
+class _Span(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """
+    Keeps the last `size` durations of every stage. Recording a span costs about a microsecond, the stages take
+    milliseconds. Stages may nest: 'forward' includes 'bert' and 'encoder'.
+    The Prefetcher thread records 'shard_load' and 'batch' while the training loop reports, so the buffers are
+    guarded by a lock.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def span(self, name):
+        """ with timer.span('backward'): ... """
+        return _Span(self, name)
+
+    def timed(self, name):
+        """ Decorator recording every call of a function as a span """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with _Span(self, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, iterable, name):
+        """ Yields the items of `iterable`, recording how long every item took to produce """
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def record(self, name, seconds):
+        with self.lock:
+            spans = self.spans.get(name)
+            if spans is None:
+                spans = self.spans.setdefault(name, deque(maxlen=self.size))
+            spans.append(seconds)
+
+    def summary(self):
+        """ {stage: (count, p50, p95, total)} in seconds over the buffered spans """
+        with self.lock:
+            buffered = [(name, list(spans)) for name, spans in self.spans.items()]
+        summary = {}
+        for name, spans in buffered:
+            times = sorted(spans)
+            if not times:
+                continue
+            summary[name] = (len(times), _percentile(times, 50), _percentile(times, 95), sum(times))
+        return summary
+
+    def reset(self):
+        with self.lock:
+            for spans in self.spans.values():
+                spans.clear()
+
+    def __str__(self):
+        return '; '.join('%s p50 %.1fms p95 %.1fms (%d)' % (name, 1000 * p50, 1000 * p95, count)
+                         for name, (count, p50, p95, _) in sorted(self.summary().items()))
+
+
+def _percentile(times, q):
+    """ Nearest rank percentile of sorted times """
+    return times[min(len(times) - 1, max(0, int(math.ceil(q / 100. * len(times))) - 1))]
+
+
+# shared by the trainer, the data loader and the model
+timer = StageTimer()
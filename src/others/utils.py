@@ -2,6 +2,9 @@ import os
 import re
 import shutil
 import time
+from contextlib import contextmanager
+
+import torch
 from datasets import load_metric
 
 
@@ -27,6 +30,23 @@ def test_rouge(cand, ref):
     return rouge_scores
 
 
+@contextmanager
+def autocast(precision, device):
+    """
+    Runs the enclosed forward pass in reduced precision.
+    fp32 disables autocast, bf16 works on cpu and cuda, fp16 needs cuda (and a GradScaler for training).
+    Parameters stay in fp32, so the optimizer always updates fp32 master weights.
+    """
+    if precision == 'fp32':
+        yield
+        return
+    if precision == 'fp16' and device != 'cuda':
+        raise ValueError('-precision fp16 is only supported on cuda, use bf16 on cpu')
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    with torch.autocast(device_type=device, dtype=dtype):
+        yield
+
+
 def tile(x, count, dim=0):
     """
     Tiles x on dimension dim count times.
@@ -1,16 +1,21 @@
 import gc
 import glob
+import gzip
 import hashlib
 import json
 import os
+import pickle
 import re
 import shutil
 import subprocess
+import threading
+import time
 import xml.etree.ElementTree as ET
 from os.path import join as pjoin
 import torch
 from bs4 import BeautifulSoup as bs
 from multiprocess import Pool
+from models.manifest import DEFAULT_PLANS, Manifest, manifest_path, parse_plans, shard_columns
 from others.log import logger
 from others.tokenization import BertTokenizer
 from others.utils import clean
@@ -18,12 +23,34 @@ from prepro.utils import _get_word_ngrams
 from glob import glob
 from bs4 import BeautifulSoup
 
+# optional faster json parsers for the intermediate shards and the CoreNLP outputs
+try:
+    import orjson
+
+    def _loads(s):
+        return orjson.loads(s)
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    _loads, _dumps = json.loads, json.dumps
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 nyt_remove_words = ["photo", "graph", "chart", "map", "table", "drawing"]
 
 
 def read_pdf_sections(paper, ignore_acknowledgement=False):
     pdfxml = open(paper, 'rb')
     contents = pdfxml.read()
+    pdfxml.close()
+    return read_tei_sections(contents, ignore_acknowledgement)
+
+
+def read_tei_sections(contents, ignore_acknowledgement=False):
+    """ Yields the abstract and the section texts of a GROBID TEI XML document """
     soup = BeautifulSoup(contents, 'html.parser')
     abstracts = soup.find_all('abstract')
     for abstract in abstracts:
@@ -120,31 +147,44 @@ def load_xml(p):
         return None, None
 
 
+CORENLP_COMMAND = ['java', 'edu.stanford.nlp.pipeline.StanfordCoreNLP', '-annotators', 'tokenize,ssplit',
+                   'always', '-filelist', 'mapping_for_corenlp.txt', '-outputFormat', 'json']
+
+
 def tokenize(args):
     temp_dir = os.path.abspath(args.save_path)
-    papers = []
-    with open("mapping_for_corenlp.txt", "w") as f:
-        for paper in glob('../raw_data/*/*.sections.txt'):
-            papers.append(paper)
-            f.write("%s\n" % paper)
-    _tokenize(papers, temp_dir)
-    os.remove("mapping_for_corenlp.txt")
+    cache = _cache(args, 'tokenize', (), ' '.join(CORENLP_COMMAND))
+    _tokenize(glob('../raw_data/*/*.sections.txt'), temp_dir, cache)
+    _tokenize(glob('../raw_data/*/*.clean_tika.txt'), temp_dir, cache)
+    if cache is not None:
+        logger.info('tokenize cache: %d papers reused, %d tokenized' % (cache.hits, cache.misses))
+
+
+def _tokenize(papers, temp_dir, cache=None):
+    keys = {}
+    if cache is not None:
+        # the cached CoreNLP output of an unchanged file is copied instead of tokenizing it again
+        todo = []
+        for paper in papers:
+            key = cache.key(file_digest(paper))
+            directory = paper.split('/')[-2]
+            if os.path.exists(cache.path(key, '.json')):
+                cache.hits += 1
+                shutil.copyfile(cache.path(key, '.json'),
+                                '/'.join(['..', 'raw_data', directory, os.path.basename(paper) + '.json']))
+            else:
+                cache.misses += 1
+                keys[os.path.basename(paper) + '.json'] = key
+                todo.append(paper)
+        papers = todo
+    if not papers:
+        return
 
-    slides = []
     with open("mapping_for_corenlp.txt", "w") as f:
-        for slide in glob('../raw_data/*/*.clean_tika.txt'):
-            slides.append(slide)
-            f.write("%s\n" % slide)
-    _tokenize(slides, temp_dir)
+        for paper in papers:
+            f.write("%s\n" % paper)
+    subprocess.call(CORENLP_COMMAND + ['-outputDirectory', temp_dir])
     os.remove("mapping_for_corenlp.txt")
-
-
-def _tokenize(papers, temp_dir):
-    command = ['java', 'edu.stanford.nlp.pipeline.StanfordCoreNLP', '-annotators', 'tokenize,ssplit',
-               'always', '-filelist', 'mapping_for_corenlp.txt', '-outputFormat',
-               'json', '-outputDirectory', temp_dir]
-
-    subprocess.call(command)
     # Check that the tokenized stories directory contains the same number of files as the original directory
     assert len(os.listdir(temp_dir)) == len(papers),\
         f"There are %i papers to tokenize, but destination directory contains  %i files." % (
@@ -152,6 +192,8 @@ def _tokenize(papers, temp_dir):
     # transfer the tokenize to the raw_data
     for file in os.listdir(temp_dir):
         directory, _, _, _ = file.split('.')
+        if file in keys:
+            cache.put_file(keys[file], '/'.join([temp_dir, file]))
         shutil.move('/'.join([temp_dir, file]), '/'.join(['..', 'raw_data', directory]))
 
 
@@ -226,10 +268,78 @@ def hashhex(s):
     return h.hexdigest()
 
 
+# the flags the format_to_bert records depend on, they are part of their cache keys
+BERT_ARGS = ('min_src_nsents', 'max_src_nsents', 'min_src_ntokens_per_sent', 'max_src_ntokens_per_sent',
+             'min_tgt_ntokens', 'max_tgt_ntokens', 'lower', 'use_bert_basic_tokenizer', 'chunk_plans',
+             'chunk_packing', 'chunk_context', 'chunk_buckets')
+
+
+class PreproCache(object):
+    """
+    Per-paper outputs of a preprocessing stage in <cache_dir>/<stage>, named by the hashhex of the inputs of the
+    paper and of the stage flags, so that a rerun only recomputes the papers (or flags) that changed.
+    """
+
+    def __init__(self, cache_dir, stage, args, arg_names, version=''):
+        self.dir = pjoin(cache_dir, stage)
+        self.args_key = '%s|%s' % (version, ','.join('%s=%s' % (name, getattr(args, name)) for name in arg_names))
+        self.hits = self.misses = 0
+
+    def key(self, *contents):
+        return hashhex('\0'.join((self.args_key,) + contents))
+
+    def path(self, key, ext='.pkl'):
+        return pjoin(self.dir, key[:2], key + ext)
+
+    def get(self, key):
+        """ (True, output) for a cached key, (False, None) otherwise """
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed so that an interrupted run never leaves a truncated entry
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def put_file(self, key, src, ext='.json'):
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(src, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+
+def file_digest(path):
+    """ SHA1 of a file, read by blocks """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _cache(args, stage, arg_names, version=''):
+    """ The cache of a stage, None without -cache_dir """
+    if not getattr(args, 'cache_dir', ''):
+        return None
+    return PreproCache(args.cache_dir, stage, args, arg_names, version)
+
+
 class BertData:
-    def __init__(self, args):
+    def __init__(self, args, tokenizer=None):
         self.args = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+        if tokenizer is None:
+            tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+        self.tokenizer = tokenizer
 
         self.sep_token = '[SEP]'
         self.cls_token = '[CLS]'
@@ -330,15 +440,34 @@ def get_text_clean_tika(args):
     pool.join()
 
 
+def corenlp_sentences(path):
+    """
+    Yields the words and the `after` whitespace of every sentence of a CoreNLP json output. With ijson installed
+    the file is streamed and only these two fields are kept, otherwise it is loaded whole.
+    """
+    with open(path, 'rb') as f:
+        if ijson is None:
+            for sent in json.load(f)['sentences']:
+                yield [t['word'] for t in sent['tokens']], [t['after'] for t in sent['tokens']]
+            return
+        words, afters = [], []
+        for prefix, event, value in ijson.parse(f):
+            if prefix == 'sentences.item.tokens.item.word':
+                words.append(value)
+            elif prefix == 'sentences.item.tokens.item.after':
+                afters.append(value)
+            elif prefix == 'sentences.item' and event == 'end_map':
+                yield words, afters
+                words, afters = [], []
+
+
 def load_pdf_ppt_jsons(pdf_ppt_jsons, lower=True, extractive=True):
     pdf_json, ppt_json = pdf_ppt_jsons
     source = []
     tgt = []
     sections = []
     section = 1
-    for sent in json.load(open(pdf_json))['sentences']:
-        tokens = [t['word'] for t in sent['tokens']]
-        after_tokens = [t['after'] for t in sent['tokens']]
+    for tokens, after_tokens in corenlp_sentences(pdf_json):
         if lower:
             tokens = [t.lower() for t in tokens]
         source.append(tokens)
@@ -346,8 +475,7 @@ def load_pdf_ppt_jsons(pdf_ppt_jsons, lower=True, extractive=True):
         if len(after_tokens) > 0 and after_tokens[-1] == '\n':
             section += 1
 
-    for sent in json.load(open(ppt_json))['sentences']:
-        tokens = [t['word'] for t in sent['tokens']]
+    for tokens, _ in corenlp_sentences(ppt_json):
         if lower:
             tokens = [t.lower() for t in tokens]
         tgt.append(tokens)
@@ -375,86 +503,288 @@ def clean_paper_jsons(args):
             test_set.append((pdf_path, ppt_path))
     print('train, val, test set sizes are: ', len(train_set), len(val_set), len(test_set))
     corpora = {'train': train_set, 'valid': val_set, 'test': test_set}
+    cache = _cache(args, 'clean_paper_jsons', (), 'lower=True,extractive=True')
     for corpus_type in ['train', 'valid', 'test']:
         pool = Pool(30)
-        dataset = []
+        save = None
+        shard_docs = 0
         p_ct = 0
         size = 0
-        for d in pool.imap(load_pdf_ppt_jsons, corpora[corpus_type]):
-            dataset.append(d)
-            if len(dataset) > args.shard_size:
-                pt_file = "{:s}/{:s}.{:d}.json".format(args.save_path, corpus_type, p_ct)
-
-                with open(pt_file, 'w') as save:
-                    save.write(json.dumps(dataset))
-                    size += len(dataset)
-                    p_ct += 1
-                    dataset = []
+        hits = 0
+        # every paper is written as one line as soon as it is loaded, no shard is held in memory
+        for d, hit in pool.imap(_load_pdf_ppt_jsons, [(paper, cache) for paper in corpora[corpus_type]]):
+            hits += hit
+            if save is None:
+                pt_file = "{:s}/{:s}.{:d}.jsonl.gz".format(args.save_path, corpus_type, p_ct)
+                save = gzip.open(pt_file, 'wt', encoding='utf-8', compresslevel=6)
+            save.write(_dumps(d) + '\n')
+            size += 1
+            shard_docs += 1
+            if shard_docs > args.shard_size:
+                save.close()
+                save = None
+                shard_docs = 0
+                p_ct += 1
 
         pool.close()
         pool.join()
 
-        if len(dataset) > 0:
-            pt_file = "{:s}/{:s}.{:d}.json".format(args.save_path, corpus_type, p_ct)
-            size += len(dataset)
-            with open(pt_file, 'w') as save:
-                save.write(json.dumps(dataset))
+        if save is not None:
+            save.close()
         print('length of ', corpus_type, ' is ', size)
+        if cache is not None:
+            logger.info('clean_paper_jsons cache: %d/%d %s papers reused' % (hits, size, corpus_type))
+
+
+def _load_pdf_ppt_jsons(params):
+    """ load_pdf_ppt_jsons through the cache, keyed by the digests of the two CoreNLP files """
+    pdf_ppt_jsons, cache = params
+    if cache is None:
+        return load_pdf_ppt_jsons(pdf_ppt_jsons), False
+    key = cache.key(*[file_digest(path) for path in pdf_ppt_jsons])
+    hit, d = cache.get(key)
+    if not hit:
+        d = load_pdf_ppt_jsons(pdf_ppt_jsons)
+        cache.put(key, d)
+    return d, hit
 
 
 def format_to_bert(args):
+    if args.imap_chunksize < 1:
+        raise ValueError('-imap_chunksize is the number of papers per format_to_bert task, it must be at least 1')
     if args.dataset != '':
         datasets = [args.dataset]
     else:
         datasets = ['train', 'valid', 'test']
     for corpus_type in datasets:
-        a_lst = []
-        for json_f in glob(pjoin(args.raw_path, '*' + corpus_type + '.*.json')):
-            real_name = json_f.split('/')[-1]
-            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', 'bert.pt'))))
-        print('document for corpus type:', corpus_type, a_lst)
-        pool = Pool(args.n_cpus)
-        for d in pool.imap(_format_to_bert, a_lst):
-            pass
+        existing = glob(pjoin(args.save_path, corpus_type + '.[0-9]*.bert.pt'))
+        if existing and not args.cache_dir:
+            logger.info('Ignore %s, BERT shards already exist in %s' % (corpus_type, args.save_path))
+            continue
+        # with the cache the shards are reassembled from the cached records of the unchanged papers, the existing
+        # ones are only replaced once all the new ones are written
+        # the former .json shards only when clean_paper_jsons has not written .jsonl.gz ones: they hold the same papers
+        json_files = sorted(glob(pjoin(args.raw_path, '*' + corpus_type + '.*.jsonl.gz')) or
+                            glob(pjoin(args.raw_path, '*' + corpus_type + '.*.json')))
+        print('document for corpus type:', corpus_type, json_files)
+        # a few papers per task: the tokenizer is loaded once per worker and the long papers do not hold up a shard
+        chunksize = args.imap_chunksize
+        # the papers are read as the workers need them, at most `pending` at a time
+        pending = threading.Semaphore(4 * args.n_cpus * chunksize)
+        docs = _bounded(((corpus_type, line) for json_f in json_files for line in read_paper_lines(json_f)), pending)
+        pool = Pool(args.n_cpus, initializer=_init_format_to_bert, initargs=(args,))
+        writer = _ShardWriter(args, corpus_type)
+        progress = _Progress(corpus_type)
+        for b_data_dict, hit, key in pool.imap(_format_to_bert, docs, chunksize=chunksize):
+            pending.release()
+            if b_data_dict is not None:
+                writer.add(b_data_dict, key)
+            progress.update(b_data_dict, hit)
+        writer.close()
+        writer.commit()
+        progress.log()
 
         pool.close()
         pool.join()
+        _save_manifest(args, corpus_type, writer.shards)
 
 
-def _format_to_bert(params):
-    corpus_type, json_file, args, save_file = params
-    is_test = corpus_type == 'test'
-    if os.path.exists(save_file):
-        logger.info('Ignore %s, Already exists' % save_file)
+def read_paper_lines(path):
+    """ The papers of a clean_paper_jsons shard as json lines, from .jsonl.gz or from the former .json lists """
+    if path.endswith('.jsonl.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield line
+    else:
+        with open(path) as f:
+            for d in json.load(f):
+                yield _dumps(d)
+
+
+def _bounded(items, semaphore):
+    """ Takes `semaphore` before producing every item, the consumer releases it """
+    for item in items:
+        semaphore.acquire()
+        yield item
+
+
+class _ShardWriter(object):
+    """
+    Saves the documents in <corpus_type>.<i>.bert.pt shards of about -shard_tokens source word pieces. The shards
+    are written to .tmp files and only replace the former ones in commit, after the last one was saved.
+    With the cache, a shard is named in the manifest by the digest of the cache keys of its papers, and a shard
+    whose papers are the same as in the previous run is left as it is.
+    """
+
+    def __init__(self, args, corpus_type):
+        self.args = args
+        self.corpus_type = corpus_type
+        self.planners = _manifest_planners(args)
+        self.dataset = []
+        self.keys = []
+        self.n_tokens = 0
+        self.shards = []
+        self.unchanged = set()
+        self.previous = _shard_digests(args.save_path, corpus_type)
+
+    def add(self, b_data_dict, key=None):
+        self.dataset.append(b_data_dict)
+        self.keys.append(key)
+        self.n_tokens += len(b_data_dict['src'])
+        if self.n_tokens >= self.args.shard_tokens:
+            self.close()
+
+    def close(self):
+        if not self.dataset:
+            return
+        name = '%s.%d.bert.pt' % (self.corpus_type, len(self.shards))
+        save_file = pjoin(self.args.save_path, name)
+        columns = shard_columns(self.dataset, self.planners, self.args.max_src_nsents, self.args.max_tgt_ntokens)
+        columns['digest'] = '' if None in self.keys else hashhex('\n'.join(self.keys))
+        if columns['digest'] and self.previous.get(name) == columns['digest'] and os.path.exists(save_file):
+            logger.info('Keeping %s, its %d instances are unchanged' % (save_file, len(self.dataset)))
+            self.unchanged.add(name)
+        else:
+            logger.info('Saving %d instances, %d tokens to %s' % (len(self.dataset), self.n_tokens, save_file))
+            torch.save(self.dataset, save_file + '.tmp')
+        self.shards.append((name, columns))
+        self.dataset = []
+        self.keys = []
+        self.n_tokens = 0
+        gc.collect()
+
+    def commit(self):
+        """ Moves the new shards into place and removes the former shards past the last new one """
+        # the previous manifest stops describing the shards here, _save_manifest writes the new one after
+        path = manifest_path(self.args.save_path, self.corpus_type)
+        if os.path.exists(path):
+            os.remove(path)
+        for name, _ in self.shards:
+            if name not in self.unchanged:
+                os.replace(pjoin(self.args.save_path, name + '.tmp'), pjoin(self.args.save_path, name))
+        for pt in glob(pjoin(self.args.save_path, self.corpus_type + '.[0-9]*.bert.pt')):
+            if int(os.path.basename(pt).split('.')[-3]) >= len(self.shards):
+                os.remove(pt)
+
+
+def _shard_digests(save_path, corpus_type):
+    """ shard name -> digest of its papers from the manifest of the previous run, {} without one """
+    path = manifest_path(save_path, corpus_type)
+    if not os.path.exists(path):
+        return {}
+    manifest = Manifest.load(path)
+    if 'shard_digests' not in manifest.columns:
+        return {}
+    return dict(zip(manifest['shards'].tolist(), manifest['shard_digests'].tolist()))
+
+
+class _Progress(object):
+    """ Logs the papers done, dropped and the throughput of format_to_bert every `every` seconds """
+
+    def __init__(self, corpus_type, every=30):
+        self.corpus_type = corpus_type
+        self.every = every
+        self.start = self.last = time.time()
+        self.done = self.dropped = self.cached = self.n_tokens = 0
+
+    def update(self, b_data_dict, cached=False):
+        self.done += 1
+        self.cached += cached
+        if b_data_dict is None:
+            self.dropped += 1
+        else:
+            self.n_tokens += len(b_data_dict['src'])
+        if time.time() - self.last >= self.every:
+            self.log()
+
+    def log(self):
+        self.last = time.time()
+        elapsed = max(self.last - self.start, 1e-6)
+        logger.info('%s: %d papers (%d dropped, %d from the cache), %.1f papers/s, %.0f tokens/s' % (
+            self.corpus_type, self.done, self.dropped, self.cached, self.done / elapsed,
+            self.n_tokens / elapsed))
+
+
+def build_manifest(args):
+    """ Writes the manifests of shards that format_to_bert already saved in -save_path """
+    datasets = [args.dataset] if args.dataset != '' else ['train', 'valid', 'test']
+    planners = _manifest_planners(args)
+    for corpus_type in datasets:
+        shards = []
+        for pt in glob(pjoin(args.save_path, corpus_type + '.[0-9]*.bert.pt')):
+            shards.append((os.path.basename(pt), shard_columns(torch.load(pt), planners, args.max_src_nsents,
+                                                               args.max_tgt_ntokens)))
+        _save_manifest(args, corpus_type, shards)
+
+
+def _manifest_planners(args):
+    return parse_plans(args.chunk_plans or DEFAULT_PLANS, args.chunk_packing, args.chunk_context, args.chunk_buckets)
+
+
+def _save_manifest(args, corpus_type, shards):
+    path = manifest_path(args.save_path, corpus_type)
+    if not shards:
+        # the shards it described are gone
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info('Removed %s, %s has no BERT shards' % (path, corpus_type))
         return
+    manifest = Manifest.build(shards, _manifest_planners(args))
+    manifest.save(path)
+    logger.info('Saved the manifest of %d %s documents to %s' % (len(manifest), corpus_type, path))
 
-    bert = BertData(args)
-
-    logger.info('Processing %s' % json_file)
-    jobs = json.load(open(json_file))
-    datasets = []
-    for ii, d in enumerate(jobs):
-        source, sections, tgt = d['src'], d['sections'], d['tgt']
-        # greedily selects the top 3 sentences and labels them as 1
-        summary_size = int(0.2 * len(source))
-
-        sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, summary_size)
-        # logger.info('Processing %s, %d with %d number of positive samples' % (json_file, ii, len(sent_labels)))
-        if args.lower:
-            source = [' '.join(s).lower().split() for s in source]
-            tgt = [' '.join(s).lower().split() for s in tgt]
-        b_data = bert.preprocess(source, sections, tgt, sent_labels,
-                                 use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
-                                 is_test=is_test)
-
-        if b_data is None:
-            continue
-        src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, sections, token_sections = b_data
-        b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
-                       "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
-                       'src_txt': src_txt, "tgt_txt": tgt_txt, "sections": sections, "token_sections": token_sections}
-        datasets.append(b_data_dict)
-    logger.info('Processed %d instances.' % len(datasets))
-    logger.info('Saving to %s' % save_file)
-    torch.save(datasets, save_file)
-    gc.collect()
+
+_worker = None
+
+
+def _init_format_to_bert(args):
+    """ Pool initializer: the tokenizer, the chunk planners and the cache of a format_to_bert worker """
+    global _worker
+    _worker = (args, BertData(args),
+               parse_plans(args.chunk_plans, args.chunk_packing, args.chunk_context, args.chunk_buckets),
+               _cache(args, 'format_to_bert', BERT_ARGS))
+
+
+def _format_to_bert(params):
+    """
+    The .bert.pt record of one paper, None when BertData drops it, whether it came from the cache and its cache
+    key (None without the cache)
+    """
+    corpus_type, line = params
+    cache = _worker[3]
+    if cache is None:
+        return _bert_record(corpus_type, _loads(line)), False, None
+    key = cache.key('is_test=%s' % (corpus_type == 'test'), line.strip())
+    hit, b_data_dict = cache.get(key)
+    if not hit:
+        b_data_dict = _bert_record(corpus_type, _loads(line))
+        cache.put(key, b_data_dict)
+    return b_data_dict, hit, key
+
+
+def _bert_record(corpus_type, d):
+    args, bert, planners, _ = _worker
+    is_test = corpus_type == 'test'
+    source, sections, tgt = d['src'], d['sections'], d['tgt']
+    # greedily selects the top 3 sentences and labels them as 1
+    summary_size = int(0.2 * len(source))
+
+    sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, summary_size)
+    if args.lower:
+        source = [' '.join(s).lower().split() for s in source]
+        tgt = [' '.join(s).lower().split() for s in tgt]
+    b_data = bert.preprocess(source, sections, tgt, sent_labels,
+                             use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
+                             is_test=is_test)
+
+    if b_data is None:
+        return None
+    src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, sections, token_sections = b_data
+    b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
+                   "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
+                   'src_txt': src_txt, "tgt_txt": tgt_txt, "sections": sections, "token_sections": token_sections}
+    if planners:
+        b_data_dict['chunk_plans'] = {planner.key(max_pos): planner.precompute(src_subtoken_idxs, cls_ids, max_pos)
+                                      for planner, max_pos in planners}
+    return b_data_dict
@@ -43,6 +43,12 @@ if __name__ == '__main__':
     parser.add_argument("-save_path", default='../data/')
 
     parser.add_argument("-shard_size", default=50, type=int)
+    # format_to_bert cuts its output shards by source word pieces instead of papers
+    parser.add_argument("-shard_tokens", default=500000, type=int)
+    # papers per format_to_bert task, at least 1
+    parser.add_argument("-imap_chunksize", default=4, type=int)
+    # per-paper outputs of tokenize, clean_paper_jsons and format_to_bert keyed by the hash of their inputs
+    parser.add_argument("-cache_dir", default='', type=str)
     parser.add_argument('-min_src_nsents', default=20, type=int)
     parser.add_argument('-max_src_nsents', default=500, type=int)
     parser.add_argument('-min_src_ntokens_per_sent', default=5, type=int)
@@ -53,6 +59,12 @@ if __name__ == '__main__':
     parser.add_argument("-lower", type=str2bool, nargs='?', const=True, default=True)
     parser.add_argument("-use_bert_basic_tokenizer", type=str2bool, nargs='?', const=True, default=False)
 
+    # chunk plans stored in the BERT shards, e.g. -chunk_plans 512:10240,512:20480 (chunk_size:max_pos)
+    parser.add_argument("-chunk_plans", default='', type=str)
+    parser.add_argument("-chunk_packing", default='greedy', type=str, choices=['greedy', 'balanced'])
+    parser.add_argument("-chunk_context", default=0, type=int)
+    parser.add_argument("-chunk_buckets", default='', type=str)
+
     parser.add_argument('-log_file', default='../logs/slide_gen.log')
 
     parser.add_argument('-dataset', default='')
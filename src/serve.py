@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+    Online summarization service: keeps an ExtSummarizer warm and scores raw text or GROBID TEI XML
+    sent over HTTP (tcp or unix socket).
+
+    POST /summarize  {"text": "..."} or {"tei": "<TEI ...>"}, optional "top_k"
+        -> {"sentences": [...], "scores": [...], "ranking": [...], "summary": [...]}
+        with "stream": true (and optional "window") the document is not truncated and the scores come back as
+        json lines {"ids": [...], "sentences": [...], "scores": [...]}, one per window of sentences
+    GET /health
+    GET /metrics     chunk scheduler queue depth, batch fill ratio and wait time
+"""
+from __future__ import division
+
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+import torch
+
+from models.chunk_scheduler import ChunkScheduler
+from models.data_loader import Batch, DataIterator
+from models.model_builder import ExtSummarizer
+from others.log import logger, init_logger
+from others.utils import autocast, clean
+from prepro.data_builder import BertData, read_tei_sections
+
+# a sentence ends with . ! or ? followed by a space and an upper case letter, a digit or a bracket
+SENT_SPLIT_RE = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9(\[])')
+# words (keeping inner hyphens and apostrophes) and single punctuation marks, like the CoreNLP tokenizer
+TOKEN_RE = re.compile(r"\w+(?:[-']\w+)*|[^\w\s]")
+
+
+def str2bool(v):
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def split_sections(text=None, tei=None):
+    """ Returns the sections of a document, paragraphs of raw text or the sections of a TEI XML """
+    if tei is not None:
+        return [section for section in read_tei_sections(tei) if section.strip()]
+    return [block for block in re.split(r'\n\s*\n', text) if block.strip()]
+
+
+def tokenize_sections(sections, max_section):
+    """ Splits the sections into lower cased token lists and numbers the sections from 1 as the CoreNLP step does """
+    source, sent_sections = [], []
+    for i, section in enumerate(sections):
+        for sent in SENT_SPLIT_RE.split(' '.join(section.split())):
+            tokens = TOKEN_RE.findall(sent.lower())
+            if tokens:
+                source.append(clean(' '.join(tokens)).split())
+                sent_sections.append(min(i + 1, max_section))
+    return source, sent_sections
+
+
+def positive_int(request, name, default=None):
+    """ request[name] as an int >= 1, `default` when the request has no such field """
+    if name not in request:
+        return default
+    value = request[name]
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError('"%s" must be an integer >= 1, got %s' % (name, json.dumps(value)))
+    return value
+
+
+class SummaryService(object):
+    """
+    Preprocesses documents the way `format_to_bert` and `DataIterator.preprocess` do and scores them.
+    """
+
+    def __init__(self, args, model, device):
+        self.args = args
+        self.model = model
+        self.device = device
+        self.bert_data = BertData(args)
+        # streamed documents keep all their sentences
+        self.stream_bert_data = BertData(argparse.Namespace(**dict(vars(args), max_src_nsents=sys.maxsize)))
+        self.data_iter = DataIterator(args, [], 1, device=device, is_test=True, shuffle=False)
+        self.max_section = model.config.section_size - 1
+        self.scheduler = None
+        if args.chunk_batch_size > 0:
+            self.scheduler = ChunkScheduler(model.bert, args.chunk_batch_size, args.chunk_wait_ms, model.chunk_size,
+                                            pack=args.chunk_pack, precision=args.precision, device=device)
+            model.chunk_encoder = self.scheduler
+
+    def preprocess(self, text=None, tei=None):
+        source, sections = tokenize_sections(split_sections(text, tei), self.max_section)
+        b_data = self.bert_data.preprocess(source, sections, [], [], is_test=True)
+        if b_data is None or len(b_data[4]) == 0:
+            return None
+        src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, sections, \
+            token_sections = b_data
+        ex = {"src": src_subtoken_idxs, "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
+              "sections": sections, "token_sections": token_sections}
+        return self.data_iter.preprocess(ex), src_txt
+
+    def stream(self, text=None, tei=None, window=256):
+        """
+        Returns a generator of (sentence ids, sentences, scores) per window, see ExtSummarizer.stream_scores.
+        It runs the model: advance it with next_window on the model thread.
+        """
+        source, sections = tokenize_sections(split_sections(text, tei), self.max_section)
+        b_data = self.stream_bert_data.preprocess(source, sections, [], [], is_test=True)
+        if b_data is None or len(b_data[4]) == 0:
+            return None
+        src, _, _, segs, clss, src_txt, _, sections, token_sections = b_data
+        if not self.args.use_interval:
+            segs = [0] * len(segs)
+
+        def _scores():
+            for ids, scores in self.model.stream_scores(src, token_sections, segs, clss, sections, window):
+                yield ids, [src_txt[i] for i in ids], scores.float().cpu().tolist()
+        return _scores()
+
+    def next_window(self, windows):
+        """ The next window of a stream generator, None after the last one """
+        # no_grad and autocast are thread local, they are entered on the thread that runs this window
+        with torch.no_grad():
+            with autocast(self.args.precision, self.device):
+                return next(windows, None)
+
+    def score(self, ex):
+        ex, src_txt = ex
+        batch = Batch([ex], self.device, chunk_planner=self.data_iter.chunk_planner,
+                      cascade=self.data_iter.cascade)
+        sent_count = batch.mask_cls.size(1)
+        with torch.no_grad():
+            with autocast(self.args.precision, self.device):
+                sent_scores, _ = self.model(batch.src, batch.sections, batch.token_sections, batch.segs,
+                                            batch.clss, batch.mask_src, batch.mask_cls, batch.chunk_plans)
+        sent_scores = sent_scores[0, :sent_count].float().cpu().numpy()
+        return src_txt[:sent_count], sent_scores
+
+
+class MicroBatcher(object):
+    """
+    Collects the requests of concurrent clients for up to `max_wait_ms` (or `max_batch` requests) and runs
+    them together, so the HTTP threads never run the model. A streamed document is one request per window.
+    ExtSummarizer scores one document per forward, so the documents of a batch run back to back on the model
+    thread, or on `max_batch` threads when a ChunkScheduler pools their BERT chunks: its own thread then runs
+    BERT and keeps the chunk statistics.
+    """
+
+    def __init__(self, service, max_batch, max_wait_ms):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = queue.Queue()
+        self.workers = ThreadPoolExecutor(max_batch) if service.scheduler is not None else None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, ex):
+        """ A future of service.score(ex) """
+        return self._submit(self.service.score, ex)
+
+    def submit_window(self, windows):
+        """ A future of the next window of a service.stream generator """
+        return self._submit(self.service.next_window, windows)
+
+    def _submit(self, fn, arg):
+        future = Future()
+        self.requests.put((fn, arg, future))
+        return future
+
+    def _loop(self):
+        while True:
+            pending = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if self.workers is not None:
+                list(self.workers.map(self._run, pending))
+            else:
+                for request in pending:
+                    self._run(request)
+
+    def _run(self, request):
+        fn, arg, future = request
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(arg))
+        except Exception as e:
+            future.set_exception(e)
+
+
+class SummarizeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            scheduler = self.server.service.scheduler
+            self._send(200, scheduler.metrics() if scheduler is not None else {})
+        else:
+            self._send(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/summarize':
+            self._send(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as e:
+            self._send(400, {'error': 'invalid json: %s' % e})
+            return
+        if not isinstance(request, dict) or ('text' not in request and 'tei' not in request):
+            self._send(400, {'error': 'expected a json object with "text" or "tei"'})
+            return
+        try:
+            top_k = positive_int(request, 'top_k')
+            window = positive_int(request, 'window', 256)
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        if request.get('stream'):
+            self._stream(request, window)
+            return
+
+        ex = self.server.service.preprocess(text=request.get('text'), tei=request.get('tei'))
+        if ex is None:
+            self._send(400, {'error': 'no sentence left after preprocessing'})
+            return
+        try:
+            sentences, scores = self.server.batcher.submit(ex).result()
+        except Exception as e:
+            logger.exception('scoring failed')
+            self._send(500, {'error': str(e)})
+            return
+
+        ranking = np.argsort(-scores).tolist()
+        if top_k is None:
+            # same summary size as the test: the top 20% of the sentences
+            top_k = max(int(0.2 * len(sentences)), 1)
+        self._send(200, {'sentences': sentences,
+                         'scores': scores.tolist(),
+                         'ranking': ranking,
+                         'summary': [sentences[j] for j in sorted(ranking[:top_k])]})
+
+    def _stream(self, request, window):
+        windows = self.server.service.stream(text=request.get('text'), tei=request.get('tei'), window=window)
+        if windows is None:
+            self._send(400, {'error': 'no sentence left after preprocessing'})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        while True:
+            try:
+                window = self.server.batcher.submit_window(windows).result()
+            except Exception:
+                # the status line is sent, the client sees the stream end without its last chunk
+                logger.exception('streaming failed')
+                self.close_connection = True
+                return
+            if window is None:
+                break
+            ids, sentences, scores = window
+            line = (json.dumps({'ids': ids, 'sentences': sentences, 'scores': scores}) + '\n').encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def load_model(args, device):
+    logger.info('Loading checkpoint from %s' % args.test_from)
+    checkpoint = torch.load(args.test_from, map_location=lambda storage, loc: storage)
+    # the checkpoint keeps the full training options, the serving options override them
+    model_args = checkpoint['opt']
+    for k, v in vars(args).items():
+        setattr(model_args, k, v)
+    model = ExtSummarizer(model_args, device, checkpoint)
+    model.eval()
+    return model_args, model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-test_from", required=True)
+    parser.add_argument("-temp_dir", default='../temp')
+    parser.add_argument('-visible_gpus', default='-1', type=str)
+    parser.add_argument("-precision", default='fp32', type=str, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument("-host", default='localhost')
+    parser.add_argument("-port", default=8000, type=int)
+    parser.add_argument("-socket_path", default='', help="serve on this unix socket instead of tcp")
+    parser.add_argument("-max_batch", default=8, type=int, help="requests scored together")
+    parser.add_argument("-max_wait_ms", default=5, type=float, help="how long a request waits for a batch to fill")
+    parser.add_argument("-chunk_batch_size", default=0, type=int,
+                        help="pool the BERT chunks of concurrent requests into batches of this size, 0 to disable")
+    parser.add_argument("-chunk_wait_ms", default=5, type=float, help="how long a chunk waits for a batch to fill")
+    parser.add_argument("-chunk_pack", type=str2bool, nargs='?', const=True, default=False,
+                        help="bin-pack the pooled chunks into chunk_size rows instead of padding them")
+    parser.add_argument("-chunk_packing", default='greedy', type=str, choices=['greedy', 'balanced'])
+    parser.add_argument("-bert_batch_size", default=8, type=int)
+    parser.add_argument("-chunk_context", default=0, type=int)
+    parser.add_argument("-chunk_buckets", default='', type=str)
+    parser.add_argument("-cascade_ratio", default=0, type=float)
+    parser.add_argument("-debug", type=str2bool, nargs='?', const=True, default=False)
+
+    # same defaults as preprocess.py
+    parser.add_argument('-min_src_nsents', default=1, type=int)
+    parser.add_argument('-max_src_nsents', default=500, type=int)
+    parser.add_argument('-min_src_ntokens_per_sent', default=5, type=int)
+    parser.add_argument('-max_src_ntokens_per_sent', default=50, type=int)
+    parser.add_argument('-min_tgt_ntokens', default=0, type=int)
+    parser.add_argument('-max_tgt_ntokens', default=5000, type=int)
+    parser.add_argument('-log_file', default='../logs/serve.log')
+
+    args = parser.parse_args()
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.visible_gpus
+    init_logger(args.log_file)
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+
+    args, model = load_model(args, device)
+    service = SummaryService(args, model, device)
+    if args.socket_path:
+        server = UnixHTTPServer(args.socket_path, SummarizeHandler)
+        address = args.socket_path
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), SummarizeHandler)
+        address = 'http://%s:%d' % (args.host, args.port)
+    server.service = service
+    server.batcher = MicroBatcher(service, args.max_batch, args.max_wait_ms)
+    logger.info('Serving %s on %s' % (args.test_from, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if service.scheduler is not None:
+            logger.info('Chunk scheduler: %s' % service.scheduler.metrics())
+        server.server_close()
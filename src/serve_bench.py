@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+    Latency / throughput benchmark client for serve.py.
+    Sends synthetic (or given) documents from concurrent clients and reports the latency percentiles.
+"""
+from __future__ import division
+
+import argparse
+import http.client
+import json
+import random
+import socket
+import threading
+import time
+
+import numpy as np
+
+WORDS = ('the model attention document section sentence summary paper results method dataset we propose '
+         'long transformer extractive scientific slides experiments table figure baseline improves').split()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def synthetic_document(n_sections, sents_per_section, words_per_sent, rng):
+    sections = []
+    for _ in range(n_sections):
+        sents = []
+        for _ in range(sents_per_section):
+            sent = ' '.join(rng.choice(WORDS) for _ in range(words_per_sent))
+            sents.append(sent.capitalize() + '.')
+        sections.append(' '.join(sents))
+    return '\n\n'.join(sections)
+
+
+def connection(args):
+    if args.socket_path:
+        return UnixHTTPConnection(args.socket_path)
+    return http.client.HTTPConnection(args.host, args.port, timeout=60)
+
+
+def client(args, documents, latencies, errors):
+    conn = connection(args)
+    for doc in documents:
+        body = json.dumps({'text': doc})
+        start = time.time()
+        try:
+            conn.request('POST', '/summarize', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = connection(args)
+            continue
+        latencies.append(time.time() - start)
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", default='localhost')
+    parser.add_argument("-port", default=8000, type=int)
+    parser.add_argument("-socket_path", default='')
+    parser.add_argument("-clients", default=4, type=int, help="concurrent clients")
+    parser.add_argument("-requests", default=100, type=int, help="requests per client")
+    parser.add_argument("-warmup", default=5, type=int, help="requests sent before timing")
+    parser.add_argument("-text_file", default='', help="send this document instead of synthetic ones")
+    parser.add_argument("-sections", default=8, type=int)
+    parser.add_argument("-sents_per_section", default=10, type=int)
+    parser.add_argument("-words_per_sent", default=20, type=int)
+    parser.add_argument("-seed", default=666, type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.text_file:
+        with open(args.text_file) as f:
+            text = f.read()
+        make_doc = lambda: text
+    else:
+        make_doc = lambda: synthetic_document(args.sections, args.sents_per_section, args.words_per_sent, rng)
+
+    client(args, [make_doc() for _ in range(args.warmup)], [], [])
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client,
+                                args=(args, [make_doc() for _ in range(args.requests)], latencies, errors))
+               for _ in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    print('clients %d, requests %d, errors %d, %.1fs' % (args.clients, len(latencies), len(errors), elapsed))
+    if latencies:
+        latencies = np.array(latencies) * 1000
+        print('throughput %.2f docs/s' % (len(latencies) / elapsed))
+        print('latency ms: mean %.1f, p50 %.1f, p95 %.1f, p99 %.1f, max %.1f' % (
+            latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95),
+            np.percentile(latencies, 99), latencies.max()))
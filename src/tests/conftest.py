@@ -0,0 +1,47 @@
+"""
+    Shared fixtures of the tests: a small synthetic corpus (bench/synthetic.py), its word piece vocabulary and the
+    .bert.pt records BertData builds from it. Run from src: python -m pytest tests
+"""
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.synthetic import SyntheticCorpus, bert_documents  # noqa: E402
+from others.tokenization import BertTokenizer  # noqa: E402
+from prepro.data_builder import BertData  # noqa: E402
+
+# the preprocess.py options BertData, _ShardWriter and format_to_bert read
+PREPRO_ARGS = dict(
+    min_src_nsents=1, max_src_nsents=500, min_src_ntokens_per_sent=5, max_src_ntokens_per_sent=50,
+    min_tgt_ntokens=0, max_tgt_ntokens=5000, lower=True, use_bert_basic_tokenizer=False, chunk_plans='',
+    chunk_packing='greedy', chunk_context=0, chunk_buckets='', shard_tokens=2000, imap_chunksize=4, n_cpus=1,
+    cache_dir='', dataset='', raw_path='', save_path='')
+
+
+def prepro_args(**kwargs):
+    return argparse.Namespace(**dict(PREPRO_ARGS, **kwargs))
+
+
+@pytest.fixture(scope='session')
+def corpus():
+    return SyntheticCorpus(sections=4, sents_per_section='3:10', words_per_sent='6:30', n_stems=500, seed=1)
+
+
+@pytest.fixture(scope='session')
+def bert_data(corpus, tmp_path_factory):
+    vocab = corpus.write_vocab(str(tmp_path_factory.mktemp('vocab')))
+    return BertData(prepro_args(), BertTokenizer(vocab, do_lower_case=True))
+
+
+@pytest.fixture(scope='session')
+def papers(corpus):
+    return corpus.papers(12)
+
+
+@pytest.fixture(scope='session')
+def docs(bert_data, papers):
+    return bert_documents(bert_data, papers, seed=1)
@@ -0,0 +1,31 @@
+from models.cascade import CONTENT_ID, Cascade, prefilter_scores
+from models.chunking import plan_chunks
+
+
+def test_prefilter_boosts_the_section_leads():
+    # three sentences of the same common word pieces: only the position differs
+    src = [101, 2000, 2001, 102] * 3
+    scores = prefilter_scores(src, [0, 4, 8], [1, 1, 2])
+    assert scores[0] == scores[2] > scores[1]
+
+
+def test_prefilter_prefers_the_repeated_rare_words():
+    rare, other = CONTENT_ID + 5000, CONTENT_ID + 4000
+    src = [101, rare, rare, 102, 101, other, 102, 101, rare, 102]
+    scores = prefilter_scores(src, [0, 4, 7], [1, 1, 1])
+    assert scores[2] > scores[1]
+
+
+def test_cascade_keeps_the_chunks_of_the_candidates(docs):
+    for doc in docs:
+        clss, labels = doc['clss'], doc['src_sent_labels']
+        spans = plan_chunks(clss, len(doc['src']), 128)
+        (bucket, kept), sent_mask, stats = Cascade(0.1)(doc['src'], clss, doc['sections'], labels, (None, spans))
+        assert bucket is None and 0 < len(kept) <= len(spans) and set(kept) <= set(spans)
+        assert sent_mask == [int(any(s <= i < e for _, _, s, e in kept)) for i in range(len(clss))]
+        assert stats.n_encoded == len(kept) and stats.n_scored == sum(sent_mask)
+        assert stats.n_oracle_kept == sum(l for l, m in zip(labels, sent_mask) if m) <= stats.n_oracle
+    # with every sentence a candidate nothing is pruned
+    doc = docs[0]
+    spans = plan_chunks(doc['clss'], len(doc['src']), 128)
+    assert Cascade(1)(doc['src'], doc['clss'], doc['sections'], doc['src_sent_labels'], (None, spans))[0][1] == spans
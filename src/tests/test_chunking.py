@@ -0,0 +1,143 @@
+import pytest
+import torch
+
+from models.chunking import SEP_ID, ChunkPlanner, ChunkStats, bert_cost, choose_bucket, pack_chunks, pad_chunks, \
+    padded_width, plan_chunks, slice_chunks
+
+
+def check_plan(spans, clss, n_tokens, chunk_size):
+    """ The chunks follow each other, give every sentence once and hold whole sentences under chunk_size """
+    assert spans[0][0] == 0 and spans[0][2] == 0
+    assert spans[-1][3] == len(clss) and spans[-1][1] <= n_tokens
+    for (_, end_index, _, end_sent_id), (start_index, _, start_sent_id, _) in zip(spans, spans[1:]):
+        assert end_index == start_index and end_sent_id == start_sent_id
+    for start_index, end_index, start_sent_id, end_sent_id in spans:
+        assert start_index < end_index < start_index + chunk_size
+        assert start_sent_id < end_sent_id
+        # as in the original chunking, a sentence starting right at the cut of the last chunk gets the [SEP]
+        last = end_index + 1 if end_index == spans[-1][1] < n_tokens else end_index
+        assert all(start_index <= clss[i] < last for i in range(start_sent_id, end_sent_id))
+
+
+@pytest.mark.parametrize('packing', ['greedy', 'balanced'])
+@pytest.mark.parametrize('chunk_size', [128, 256, 512])
+def test_plans_cover_the_sentences(docs, packing, chunk_size):
+    for doc in docs:
+        check_plan(plan_chunks(doc['clss'], len(doc['src']), chunk_size, packing), doc['clss'], len(doc['src']),
+                   chunk_size)
+
+
+def test_balanced_plan_keeps_every_token(docs):
+    for doc in docs:
+        spans = plan_chunks(doc['clss'], len(doc['src']), 256, 'balanced')
+        greedy = plan_chunks(doc['clss'], len(doc['src']), 256, 'greedy')
+        assert spans[-1][1] == len(doc['src'])
+        assert max(end - start for start, end, _, _ in spans) <= max(end - start for start, end, _, _ in greedy)
+
+
+def test_greedy_plan_cuts_the_last_chunk():
+    # 5 sentences of 100 tokens in 256 token chunks: 2 sentences, then the last 3 cut at 255 tokens
+    assert plan_chunks([0, 100, 200, 300, 400], 500, 256) == [(0, 200, 0, 2), (200, 455, 2, 5)]
+    assert plan_chunks([0, 100], 400, 256) == [(0, 255, 0, 2)]
+
+
+@pytest.mark.parametrize('packing', ['greedy', 'balanced'])
+def test_context_chunks_emit_the_same_sentences(docs, packing):
+    context = 32
+    for doc in docs:
+        clss, n_tokens = doc['clss'], len(doc['src'])
+        inner = plan_chunks(clss, n_tokens, 256 - 2 * context, packing)
+        spans = plan_chunks(clss, n_tokens, 256, packing, context)
+        # every chunk gives the sentences of the plan without context and encodes whole sentences around them
+        assert [span[2:] for span in spans] == [span[2:] for span in inner]
+        bounds = set(clss[1:]) | {0}
+        for (start_index, end_index, _, _), (inner_start, inner_end, _, _) in zip(spans, inner):
+            assert start_index in bounds and inner_start - context <= start_index <= inner_start
+            assert end_index >= inner_end and end_index - start_index < 256
+
+
+def test_stored_plans_match_the_planner(docs):
+    planner = ChunkPlanner(256, 'balanced', 32)
+    assert planner.key(10240) != ChunkPlanner(256, 'balanced').key(10240)
+    for doc in docs:
+        plan = planner.precompute(doc['src'], doc['clss'], 10240)
+        assert planner.load(plan) == planner(doc['clss'], len(doc['src']))
+
+
+def test_greedy_plan_never_emits_an_empty_chunk():
+    # two sentences longer than the chunk: each gets a chunk of its own
+    assert plan_chunks([0, 300, 600], 700, 256) == [(0, 300, 0, 1), (300, 600, 1, 2), (600, 700, 2, 3)]
+
+
+def test_choose_bucket_by_bert_cost():
+    # 6 sentences of 100 tokens: 512 cuts the document, 3 x 200 tokens costs less than 6 x 100 (padded to 104)
+    clss = list(range(0, 600, 100))
+    assert bert_cost(3, 200, 768) < bert_cost(6, padded_width(100, 128), 768)
+    bucket, spans = choose_bucket(clss, 600, [128, 256, 512])
+    assert bucket == 256 and spans == plan_chunks(clss, 600, 256) and len(spans) == 3
+
+
+def test_choose_bucket_skips_the_buckets_a_sentence_does_not_fit():
+    # a 300 token sentence does not fit in 128 or 256 token chunks
+    clss = [0, 100, 400, 500]
+    assert choose_bucket(clss, 600, [128, 256, 512])[0] == 512
+    # the largest bucket when none fits
+    bucket, spans = choose_bucket([0, 600], 700, [128, 256])
+    assert bucket == 256 and all(end > start for start, end, _, _ in spans)
+
+
+def test_buckets_keep_the_most_tokens(docs):
+    planner = ChunkPlanner(512, 'greedy', 0, '128,256,384,512')
+    for doc in docs:
+        bucket, spans = planner(doc['clss'], len(doc['src']))
+        assert bucket in planner.buckets
+        assert spans[-1][1] == max(plan_chunks(doc['clss'], len(doc['src']), b)[-1][1] for b in planner.buckets)
+        check_plan(spans, doc['clss'], len(doc['src']), 512)
+
+
+def test_slice_chunks_leaves_the_document_unchanged(docs):
+    doc = max(docs, key=lambda doc: len(doc['src']))
+    src = torch.tensor(doc['src'])
+    original = src.clone()
+    ones = torch.ones_like(src)
+    spans = plan_chunks(doc['clss'], len(doc['src']), 128)
+    chunks = slice_chunks(src, ones, ones, ones, spans)
+    assert torch.equal(src, original)
+    assert [chunk[0].shape[0] for chunk in chunks] == [end - start for start, end, _, _ in spans]
+    if spans[-1][1] < len(doc['src']):
+        # the cut last chunk ends with [SEP] in its own copy
+        assert chunks[-1][0][-1].item() == SEP_ID
+
+
+def test_pad_chunks_pads_to_the_longest_chunk():
+    chunks = [tuple(torch.ones(n, dtype=torch.long) for _ in range(4)) for n in (30, 61, 17)]
+    (src, token_sections, segs, mask_src), width = pad_chunks(chunks, 512)
+    assert width == 64
+    assert src.shape == mask_src.shape == (3, 64)
+    assert mask_src.sum(1).tolist() == [30, 61, 17]
+    # never wider than the bucket, unless a chunk already is
+    assert pad_chunks(chunks, 62)[1] == 62
+    assert pad_chunks(chunks, 40)[1] == 61
+
+
+def test_pack_chunks_keeps_the_chunks_apart():
+    lengths = [50, 40, 30, 20, 10]
+    chunks = [(torch.full((n,), i + 1000), torch.zeros(n, dtype=torch.long), torch.zeros(n, dtype=torch.long),
+               torch.ones(n, dtype=torch.long)) for i, n in enumerate(lengths)]
+    (src, _, _), mask, position_ids, places = pack_chunks(chunks, 64)
+    assert src.shape[0] == 3
+    for i, (n, (row, offset)) in enumerate(zip(lengths, places)):
+        assert offset + n <= 64
+        assert (src[row, offset:offset + n] == i + 1000).all()
+        assert position_ids[row, offset:offset + n].tolist() == list(range(n))
+        # a chunk attends to its own tokens only
+        assert mask[row, offset:offset + n].sum().item() == n * n
+    assert mask.sum().item() == sum(n * n for n in lengths)
+
+
+def test_chunk_stats_padding_ratio():
+    stats = ChunkStats(768, 512)
+    stats.update(2, 96, 2, 64, 128)
+    assert stats.padding_ratio() == pytest.approx(1 - 96 / 128)
+    assert stats.cost_ratio() < 1
+    assert stats.buckets[128] == 2
@@ -0,0 +1,11 @@
+from distributed import resolve_init_method
+
+
+def test_resolve_init_method():
+    assert resolve_init_method('tcp://localhost:10000') == 'tcp://localhost:10000'
+    assert resolve_init_method('tcp://10.0.0.1:10000', 12345) == 'tcp://10.0.0.1:12345'
+    assert resolve_init_method('env://', 0) == 'env://'
+    assert resolve_init_method('file:///tmp/rendezvous', 12345) == 'file:///tmp/rendezvous'
+    # port 0 picks a free local port
+    host, port = resolve_init_method('tcp://localhost:10000', 0)[len('tcp://'):].rsplit(':', 1)
+    assert host == 'localhost' and 0 < int(port) < 65536
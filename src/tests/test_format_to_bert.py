@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+import threading
+
+import pytest
+import torch
+
+from conftest import prepro_args
+from models.manifest import Manifest, manifest_path
+from prepro.data_builder import BERT_ARGS, PreproCache, _bounded, _save_manifest, _ShardWriter, format_to_bert, \
+    read_paper_lines
+
+
+def write_shards(docs, save_path, **kwargs):
+    writer = _ShardWriter(prepro_args(save_path=save_path, **kwargs), 'train')
+    for doc in docs:
+        writer.add(doc)
+    writer.close()
+    writer.commit()
+    return writer
+
+
+def test_shards_are_cut_by_tokens(docs, tmp_path):
+    writer = write_shards(docs, str(tmp_path), shard_tokens=2000)
+    shards = [torch.load(str(tmp_path / name)) for name, _ in writer.shards]
+    assert len(shards) > 1
+    # every shard but the last one stops at the first document reaching -shard_tokens
+    for shard in shards[:-1]:
+        n_tokens = [len(doc['src']) for doc in shard]
+        assert sum(n_tokens) >= 2000 > sum(n_tokens[:-1])
+    assert [doc['src'] for shard in shards for doc in shard] == [doc['src'] for doc in docs]
+    assert sorted(os.listdir(str(tmp_path))) == sorted(name for name, _ in writer.shards)
+
+
+def test_imap_chunksize_must_be_positive():
+    with pytest.raises(ValueError):
+        format_to_bert(prepro_args(imap_chunksize=0))
+
+
+def test_read_paper_lines(papers, tmp_path):
+    gz_path = str(tmp_path / 'train.0.jsonl.gz')
+    with gzip.open(gz_path, 'wt', encoding='utf-8') as f:
+        for paper in papers[:3]:
+            f.write(json.dumps(paper) + '\n')
+    json_path = str(tmp_path / 'train.1.json')
+    with open(json_path, 'w') as f:
+        json.dump(papers[3:5], f)
+    assert [json.loads(line) for line in read_paper_lines(gz_path)] == papers[:3]
+    assert [json.loads(line) for line in read_paper_lines(json_path)] == papers[3:5]
+
+
+def test_bounded_reads_ahead_at_most_the_semaphore():
+    read = []
+    pending = threading.Semaphore(3)
+    items = _bounded((read.append(i) or i for i in range(10)), pending)
+    assert [next(items) for _ in range(3)] == [0, 1, 2]
+    # the fourth item waits until the consumer releases one
+    assert not pending.acquire(blocking=False)
+    assert len(read) == 3
+    pending.release()
+    assert next(items) == 3 and len(read) == 4
+
+
+def test_cache_round_trip(tmp_path):
+    cache = PreproCache(str(tmp_path), 'format_to_bert', prepro_args(), BERT_ARGS)
+    key = cache.key('is_test=False', '{"src": []}')
+    assert cache.get(key) == (False, None)
+    cache.put(key, {'src': [101, 102]})
+    assert cache.get(key) == (True, {'src': [101, 102]})
+    assert (cache.hits, cache.misses) == (1, 1)
+    # the flags of the stage are part of the key
+    other = PreproCache(str(tmp_path), 'format_to_bert', prepro_args(max_src_nsents=100), BERT_ARGS)
+    assert other.key('is_test=False', '{"src": []}') != key
+    # a truncated entry is a miss
+    with open(cache.path(key), 'wb') as f:
+        f.write(b'\x80')
+    assert cache.get(key) == (False, None)
+
+
+def test_shards_replace_the_former_ones_on_commit(docs, tmp_path):
+    for i in range(20):
+        torch.save(['former'], str(tmp_path / ('train.%d.bert.pt' % i)))
+    writer = _ShardWriter(prepro_args(save_path=str(tmp_path), shard_tokens=2000), 'train')
+    for doc in docs:
+        writer.add(doc)
+    writer.close()
+    # nothing is replaced until all the shards are written
+    assert all(torch.load(str(tmp_path / name)) == ['former'] for name, _ in writer.shards)
+    writer.commit()
+    names = sorted(name for name, _ in writer.shards)
+    assert sorted(os.listdir(str(tmp_path))) == names
+    assert sum(len(torch.load(str(tmp_path / name))) for name in names) == len(docs)
+
+
+def test_unchanged_shards_are_kept(docs, tmp_path):
+    args = prepro_args(save_path=str(tmp_path), shard_tokens=2000, cache_dir=str(tmp_path / 'cache'))
+    keys = ['paper%d' % i for i in range(len(docs))]
+
+    def rebuild(keys):
+        writer = _ShardWriter(args, 'train')
+        for doc, key in zip(docs, keys):
+            writer.add(doc, key)
+        writer.close()
+        writer.commit()
+        _save_manifest(args, 'train', writer.shards)
+        return writer
+
+    first = rebuild(keys)
+    assert not first.unchanged
+    mtimes = {name: os.stat(str(tmp_path / name)).st_mtime_ns for name, _ in first.shards}
+    assert rebuild(keys).unchanged == set(mtimes)
+    # a modified paper only rewrites its shard
+    writer = rebuild(keys[:-1] + ['modified'])
+    last = first.shards[-1][0]
+    assert writer.unchanged == set(mtimes) - {last}
+    assert all(os.stat(str(tmp_path / name)).st_mtime_ns == mtime for name, mtime in mtimes.items() if name != last)
+    assert Manifest.load(manifest_path(str(tmp_path), 'train'))['shard_digests'].tolist() == \
+        [columns['digest'] for _, columns in sorted(writer.shards)]
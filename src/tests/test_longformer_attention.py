@@ -0,0 +1,25 @@
+import argparse
+
+import torch
+
+from models.longExtractiveFormerAttention import LongformerSelfAttention
+
+
+def test_global_attention_backward():
+    torch.manual_seed(0)
+    config = argparse.Namespace(hidden_size=16, num_attention_heads=2, attention_probs_dropout_prob=0.1,
+                                attention_window=[4])
+    attention = LongformerSelfAttention(config, 0)
+    attention.train()
+    # one document, as in training: the global attention probs are then a view of the local ones
+    hidden_states = torch.randn(1, 8, 16, requires_grad=True)
+    # -10000 masked, 0 local, +10000 global attention
+    attention_mask = torch.zeros(1, 8)
+    attention_mask[0, [0, 3]] = 10000
+    attention_mask[0, 7] = -10000
+    outputs = attention(hidden_states, attention_mask=attention_mask, is_index_masked=attention_mask < 0,
+                        is_index_global_attn=attention_mask > 0, is_global_attn=True, output_attentions=True)
+    outputs[0].sum().backward()
+    assert attention.value.weight.grad is not None and hidden_states.grad.abs().sum() > 0
+    # the local attention weights of the global tokens are only fillers
+    assert (outputs[1][0, [0, 3]] == 0).all()
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from conftest import prepro_args
+from models.chunking import truncated_size
+from models.manifest import Manifest, manifest_path, parse_plans, shard_columns
+from prepro.data_builder import _save_manifest
+
+
+def build(docs, plans='512:10240,256:300'):
+    planners = parse_plans(plans)
+    # given out of order, numbered as load_dataset sorts the shard names
+    shards = [('train.1.bert.pt', shard_columns(docs[5:], planners, 500, 5000)),
+              ('train.0.bert.pt', shard_columns(docs[:5], planners, 500, 5000))]
+    return Manifest.build(shards, planners), planners
+
+
+def test_manifest_columns(docs):
+    manifest, planners = build(docs)
+    assert len(manifest) == len(docs)
+    assert manifest['shards'].tolist() == ['train.0.bert.pt', 'train.1.bert.pt']
+    assert manifest['doc_id'].tolist() == list(range(len(docs)))
+    assert manifest['shard'].tolist() == [0] * 5 + [1] * (len(docs) - 5)
+    assert manifest['offset'].tolist() == list(range(5)) + list(range(len(docs) - 5))
+    assert manifest['n_tokens'].tolist() == [len(doc['src']) for doc in docs]
+    assert manifest['n_sents'].tolist() == [len(doc['clss']) for doc in docs]
+    assert manifest['n_positives'].tolist() == [sum(doc['src_sent_labels']) for doc in docs]
+    assert manifest['n_sections'].tolist() == [len(set(doc['sections'])) for doc in docs]
+
+    # the sentence lengths of document i start at sent_offsets[i] and add up to its tokens
+    offsets = manifest.sent_offsets
+    for i, doc in enumerate(docs):
+        assert manifest['sent_tokens'][offsets[i]:offsets[i] + len(doc['clss'])].sum() == len(doc['src'])
+
+
+def test_manifest_chunk_columns(docs):
+    manifest, planners = build(docs)
+    assert manifest['n_chunks'].shape == manifest['pos_truncated'].shape == (len(docs), 2)
+    for i, doc in enumerate(docs):
+        for j, (planner, max_pos) in enumerate(planners):
+            n_tokens, n_sents = truncated_size(doc['src'], doc['clss'], max_pos)
+            assert manifest['n_chunks'][i, j] == len(planner(doc['clss'][:n_sents], n_tokens)[1])
+            assert manifest['pos_truncated'][i, j] == (n_tokens < len(doc['src']))
+    # the synthetic papers are longer than 300 tokens
+    assert manifest['pos_truncated'][:, 1].all() and not manifest['pos_truncated'][:, 0].any()
+
+
+def test_manifest_round_trip(docs, tmp_path):
+    manifest, _ = build(docs)
+    path = str(tmp_path / 'train.manifest.npz')
+    manifest.save(path)
+    loaded = Manifest.load(path)
+    assert sorted(loaded.columns) == sorted(manifest.columns)
+    for name in manifest.columns:
+        assert np.array_equal(loaded[name], manifest[name])
+    assert str(loaded).startswith('%d documents in 2 shards' % len(docs))
+
+
+def test_stale_manifest_is_removed(docs, tmp_path):
+    args = prepro_args(save_path=str(tmp_path), chunk_plans='512:10240')
+    _save_manifest(args, 'train', [('train.0.bert.pt', shard_columns(docs, parse_plans('512:10240'), 500, 5000))])
+    path = manifest_path(str(tmp_path), 'train')
+    assert len(Manifest.load(path)) == len(docs)
+    # a rebuild without documents leaves no manifest behind
+    _save_manifest(args, 'train', [])
+    assert not os.path.exists(path)
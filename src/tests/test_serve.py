@@ -0,0 +1,81 @@
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from serve import MicroBatcher, SummarizeHandler, positive_int, split_sections, tokenize_sections
+
+
+class FakeService(object):
+    """ Scores the sentences of a text by their position, in place of SummaryService and its model """
+    scheduler = None
+
+    def preprocess(self, text=None, tei=None):
+        sentences = [' '.join(sent) for sent in tokenize_sections(split_sections(text, tei), 5)[0]]
+        return (sentences, None) if sentences else None
+
+    def score(self, ex):
+        sentences, _ = ex
+        return sentences, np.linspace(1, 0, len(sentences))
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('localhost', 0), SummarizeHandler)
+    server.service = FakeService()
+    server.batcher = MicroBatcher(server.service, 4, 1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body):
+    connection = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+    connection.request('POST', '/summarize', body=body if isinstance(body, bytes) else json.dumps(body))
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())
+    connection.close()
+    return result
+
+
+TEXT = 'The first sentence is here. The second one follows it.\n\nA new section starts. It ends now.'
+
+
+def test_positive_int():
+    assert positive_int({}, 'top_k') is None
+    assert positive_int({}, 'window', 256) == 256
+    assert positive_int({'top_k': 3}, 'top_k') == 3
+    for value in (0, -1, 2.5, '3', None, True, [3]):
+        with pytest.raises(ValueError):
+            positive_int({'top_k': value}, 'top_k')
+
+
+def test_tokenize_sections():
+    source, sections = tokenize_sections(split_sections(TEXT), 5)
+    assert [' '.join(sent) for sent in source] == ['the first sentence is here .', 'the second one follows it .',
+                                                   'a new section starts .', 'it ends now .']
+    assert sections == [1, 1, 2, 2]
+    # the sections past max_section share the last id
+    assert tokenize_sections(split_sections(TEXT), 1)[1] == [1, 1, 1, 1]
+
+
+def test_summarize(server):
+    status, result = post(server, {'text': TEXT, 'top_k': 2})
+    assert status == 200
+    assert result['ranking'] == [0, 1, 2, 3]
+    assert result['summary'] == result['sentences'][:2]
+    # 20% of the sentences, at least one, by default
+    assert len(post(server, {'text': TEXT})[1]['summary']) == 1
+
+
+@pytest.mark.parametrize('body', [
+    b'not json', [1, 2], {'top_k': 2}, {'text': TEXT, 'top_k': None}, {'text': TEXT, 'top_k': 'ten'},
+    {'text': TEXT, 'top_k': 0}, {'text': TEXT, 'top_k': -3}, {'text': TEXT, 'stream': True, 'window': 0},
+    {'text': '   '}])
+def test_bad_requests_get_400(server, body):
+    status, result = post(server, body)
+    assert status == 400 and 'error' in result
@@ -3,8 +3,9 @@ from __future__ import division
 import argparse
 import os
 
+import distributed
 from others.log import init_logger
-from train_extractive import train_ext, validate_ext, test_ext
+from train_extractive import train_ext, validate_ext, test_ext, compare_precision, compare_distill
 
 model_flags = ['hidden_size', 'ff_size', 'heads', 'emb_size', 'enc_layers', 'enc_hidden_size', 'enc_ff_size',
                'encoder', 'ff_actv', 'use_interval']
@@ -22,7 +23,8 @@ def str2bool(v):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-encoder", default='bert', type=str, choices=['bert', 'baseline'])
-    parser.add_argument("-mode", default='train', type=str, choices=['train', 'validate', 'test'])
+    parser.add_argument("-mode", default='train', type=str,
+                        choices=['train', 'validate', 'test', 'compare_precision', 'distill', 'compare_distill'])
     parser.add_argument("-bert_data_path", default='../bert_data')
     # parser.add_argument("-model_path", default='../models/') #fix
     # parser.add_argument("-tensorboard_log_path", default='../tensorboard_log/')# fix
@@ -38,10 +40,24 @@ if __name__ == '__main__':
     # parser.add_argument("-chunk_size", default=3072, type=int) # fix
     parser.add_argument("-max_pos", default=10240, type=int) #fix
     parser.add_argument("-chunk_size", default=512, type=int) # fix
+    parser.add_argument("-chunk_packing", default='greedy', type=str, choices=['greedy', 'balanced'],
+                        help="greedy: fill every BERT chunk as the original chunking, balanced: same number of chunks "
+                             "with even lengths, so less padding when chunks are batched")
+    parser.add_argument("-bert_batch_size", default=8, type=int, help="chunks of a document encoded in one BERT batch")
+    parser.add_argument("-chunk_context", default=0, type=int,
+                        help="tokens of whole sentences encoded on each side of a BERT chunk for context only")
+    parser.add_argument("-chunk_buckets", default='', type=str,
+                        help="comma separated BERT chunk lengths, e.g. 128,256,384,512, picked per document")
+    parser.add_argument("-cascade_ratio", default=0, type=float,
+                        help="at test time only encode the BERT chunks holding this fraction of the sentences, "
+                             "ranked by a lexical/positional prefilter. 0 scores every sentence")
     parser.add_argument("-use_interval", type=str2bool, nargs='?', const=True, default=True)
     parser.add_argument("-large", type=str2bool, nargs='?', const=True, default=False)
 
     parser.add_argument("-sep_optim", type=str2bool, nargs='?', const=True, default=True)
+    parser.add_argument("-precision", default='fp32', type=str, choices=['fp32', 'bf16', 'fp16'],
+                        help="autocast precision of the BERT chunks and the Longformer encoder. bf16 runs on cpu and "
+                             "cuda, fp16 is cuda only and uses dynamic loss scaling. Weights stay in fp32.")
 
     parser.add_argument("-finetune_bert", type=str2bool, nargs='?', const=True, default=False)
     parser.add_argument("-enc_hidden_size", default=512, type=int)
@@ -49,6 +65,17 @@ if __name__ == '__main__':
     parser.add_argument("-enc_dropout", default=0.2, type=float)
     parser.add_argument("-enc_layers", default=6, type=int)
 
+    # distillation of a smaller chunk encoder (-mode distill), the student options are stored in its checkpoint
+    parser.add_argument("-distill_from", default='', help="checkpoint of the teacher")
+    parser.add_argument("-distill_loss", default='both', type=str, choices=['vectors', 'scores', 'both'],
+                        help="match the BERT sentence vectors, the sentence scores or both of the teacher")
+    parser.add_argument("-distill_alpha", default=0.5, type=float, help="weight of the vector loss with 'both'")
+    parser.add_argument("-student_layers", default=0, type=int, help="layers of the student, 0 uses BERT itself")
+    parser.add_argument("-student_hidden_size", default=0, type=int,
+                        help="hidden size of the student, 0 keeps the BERT size and starts from its layers")
+    parser.add_argument("-student_heads", default=0, type=int, help="0 keeps the BERT number of heads")
+    parser.add_argument("-student_ff_size", default=0, type=int, help="0 uses 4 * student_hidden_size")
+
     # global attention params
     parser.add_argument('-global_attention', default=1, type=int, choices=[0,1,2], help=" global attention types:0,1,2. 0: no global attention, 1: global attention at random indices, 2: global attention at the beginning and end of the sections  ")
     parser.add_argument('-global_attention_ratio', default=0.2, type=float, help="ratio of global attention indices chosen at random")
@@ -78,16 +105,45 @@ if __name__ == '__main__':
 
     parser.add_argument("-save_checkpoint_steps", default=5, type=int)
     parser.add_argument("-accum_count", default=1, type=int)
+    parser.add_argument("-prefetch", default=2, type=int,
+                        help="training batches loaded and copied to the device ahead in a background thread, 0 to "
+                             "load them in the training loop")
     parser.add_argument("-report_every", default=1, type=int)
     parser.add_argument("-train_steps", default=1000, type=int)
     parser.add_argument("-recall_eval", type=str2bool, nargs='?', const=True, default=False)
 
     parser.add_argument('-visible_gpus', default='2', type=str)
     parser.add_argument('-gpu_ranks', default='0', type=str)
+    parser.add_argument('-cpu_procs', default=1, type=int, help="number of processes when -visible_gpus is -1")
+    parser.add_argument('-dist_backend', default='', type=str, choices=['', 'nccl', 'gloo'],
+                        help="torch.distributed backend, by default nccl on gpus and gloo on cpu")
+    parser.add_argument('-dist_init_method', default='tcp://localhost:10000', type=str,
+                        help="rendezvous: tcp://host:port, env:// (MASTER_ADDR/MASTER_PORT) or file:///shared/path "
+                             "(the file must not be left over from a previous run)")
+    parser.add_argument('-dist_port', default=-1, type=int,
+                        help="overrides the port of a tcp:// init method, 0 picks a free port (single node only)")
+    parser.add_argument('-nnodes', default=1, type=int, help="number of nodes, each runs train.py with its -node_rank")
+    parser.add_argument('-node_rank', default=0, type=int)
+    parser.add_argument('-cpu_threads', default=0, type=int,
+                        help="intra-op threads of each cpu process, 0 splits the cores of the node evenly")
+    parser.add_argument("-ddp", type=str2bool, nargs='?', const=True, default=False,
+                        help="train with DistributedDataParallel instead of the hand-rolled gradient all-reduce")
+    parser.add_argument("-bucket_cap_mb", default=25, type=int, help="DDP gradient bucket size")
     parser.add_argument('-log_file', default='../logs/slide_gen.log')
     parser.add_argument('-seed', default=666, type=int)
+    parser.add_argument("-debug", type=str2bool, nargs='?', const=True, default=False,
+                        help="check the BERT chunks and enable autograd anomaly detection, both sync with the device")
+    parser.add_argument("-profile_steps", default='', type=str,
+                        help="START:END, run these training steps under torch.profiler, traces go to "
+                             "tensorboard_log_path/profile")
+    parser.add_argument("-profile_test_batches", default='', type=str,
+                        help="START:END, the same for the test batches (0 is the first document)")
 
     parser.add_argument("-test_all", type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument("-valid_sweep", type=str2bool, nargs='?', const=True, default=False,
+                        help="with -test_all, read the validation set once and score all checkpoints against it")
+    parser.add_argument("-cache_sent_vecs", type=str2bool, nargs='?', const=True, default=True,
+                        help="with -valid_sweep and a frozen BERT, compute the BERT sentence vectors only once")
     parser.add_argument("-test_from", default='')
     parser.add_argument("-test_start_from", default=-1, type=int)
 
@@ -96,17 +152,28 @@ if __name__ == '__main__':
     parser.add_argument("-block_trigram", type=str2bool, nargs='?', const=True, default=True)
 
     args = parser.parse_args()
-    args.gpu_ranks = [int(i) for i in range(len(args.visible_gpus.split(',')))]
-    args.world_size = len(args.gpu_ranks)
+    # gpu_ranks holds the global ranks of the processes of this node
+    n_local_procs = args.cpu_procs if args.visible_gpus == '-1' else len(args.visible_gpus.split(','))
+    args.gpu_ranks = [args.node_rank * n_local_procs + i for i in range(n_local_procs)]
+    args.world_size = args.nnodes * n_local_procs
+    if args.dist_backend == '':
+        args.dist_backend = 'gloo' if args.visible_gpus == '-1' else 'nccl'
+    if args.dist_port == 0 and args.nnodes > 1:
+        raise ValueError('-dist_port 0 picks a local port, give a fixed port when training on several nodes')
+    args.dist_init_method = distributed.resolve_init_method(args.dist_init_method, args.dist_port)
     os.environ["CUDA_VISIBLE_DEVICES"] = args.visible_gpus
 
     init_logger(args.log_file)
     device = "cpu" if args.visible_gpus == '-1' else "cuda"
     device_id = 0 if device == "cuda" else -1
-    if args.mode == 'train':
+    if args.mode in ('train', 'distill'):
         train_ext(args, device_id)
     elif args.mode == 'validate':
         validate_ext(args, device_id)
+    elif args.mode == 'compare_precision':
+        compare_precision(args, device_id)
+    elif args.mode == 'compare_distill':
+        compare_distill(args, device_id)
     if args.mode == 'test':
         cp = args.test_from
         try:
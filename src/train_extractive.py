@@ -4,6 +4,7 @@
 """
 from __future__ import division
 
+import copy
 import glob
 import os
 import random
@@ -11,17 +12,20 @@ import signal
 import time
 
 import torch
+from torch.nn.parallel import DistributedDataParallel
 
 import distributed
 from models import data_loader, model_builder
-from models.data_loader import load_dataset
+from models.data_loader import TEST_FIELDS, TRAIN_FIELDS, load_dataset
+from models.manifest import Manifest, manifest_path
 from models.model_builder import ExtSummarizer
-from models.trainer_ext import build_trainer
+from models.trainer_ext import build_trainer, merge_sharded_results
 from others.log import logger, init_logger
+from others.utils import autocast, test_rouge, rouge_results_to_str
 
-model_flags = ['hidden_size', 'ff_size', 'heads', 'inter_layers', 'encoder', 'ff_actv', 'use_interval', 'rnn_size']
+model_flags = ['hidden_size', 'ff_size', 'heads', 'inter_layers', 'encoder', 'ff_actv', 'use_interval', 'rnn_size',
+               'student_layers', 'student_hidden_size', 'student_heads', 'student_ff_size']
 
-torch.autograd.set_detect_anomaly(True) # fix
 class ErrorHandler(object):
     """A class that listens for exceptions in children processes and propagates
     the tracebacks to the parent process."""
@@ -68,7 +72,8 @@ def train_multi_ext(args):
     """ Spawns 1 process per GPU """
     init_logger()
 
-    nb_gpu = args.world_size
+    # one process per local device, the other nodes start their own
+    nb_gpu = len(args.gpu_ranks)
     mp = torch.multiprocessing.get_context('spawn')
 
     # Create a thread to listen for errors in the child processes.
@@ -93,7 +98,10 @@ def run(args, device_id, error_queue):
 
     try:
         # what does multi init do???
-        gpu_rank = distributed.multi_init(device_id, args.world_size, args.gpu_ranks)
+        if args.visible_gpus == '-1':
+            distributed.set_cpu_threads(len(args.gpu_ranks), args.cpu_threads)
+        gpu_rank = distributed.multi_init(device_id, args.world_size, args.gpu_ranks, args.dist_backend,
+                                          args.dist_init_method)
         print('gpu_rank %d' % gpu_rank)
         if gpu_rank != args.gpu_ranks[device_id]:
             raise AssertionError("An error occurred in Distributed initialization")
@@ -110,6 +118,8 @@ def run(args, device_id, error_queue):
 
 def train_single_ext(args, device_id):
     init_logger(args.log_file)
+    # slow, only to find where a nan or inf gradient comes from
+    torch.autograd.set_detect_anomaly(args.debug)
 
     device = "cpu" if args.visible_gpus == '-1' else "cuda"
     logger.info('Device ID %d' % device_id)
@@ -117,7 +127,7 @@ def train_single_ext(args, device_id):
     torch.manual_seed(args.seed)
     random.seed(args.seed)
     torch.backends.cudnn.deterministic = True
-    if device_id >= 0:
+    if device_id >= 0 and device == "cuda":
         torch.cuda.set_device(device_id)
         torch.cuda.manual_seed(args.seed)
 
@@ -136,19 +146,62 @@ def train_single_ext(args, device_id):
     else:
         checkpoint = None
 
-    def train_iter_fct():
-        return data_loader.Dataloader(args, load_dataset(args, 'train', shuffle=True), args.batch_size, device,
-                                      shuffle=True, is_test=False)
+    teacher = load_teacher(args, device) if args.mode == 'distill' else None
+
+    manifest = manifest_path(args.bert_data_path, 'train')
+    if os.path.exists(manifest):
+        logger.info('Training data:\n%s' % Manifest.load(manifest))
+
+    use_ddp = args.ddp and args.world_size > 1
+    # shuffles the training data in the prefetch thread, apart from the global random state of the model
+    data_rng = random.Random(args.seed)
+
+    def train_iter_fct(epoch):
+        if use_ddp:
+            # every rank reads its own shards instead of skipping the batches of the other ranks
+            datasets = load_dataset(args, 'train', shuffle=True, num_replicas=args.world_size,
+                                    rank=torch.distributed.get_rank(), epoch=epoch, fields=TRAIN_FIELDS,
+                                    rng=data_rng)
+        else:
+            datasets = load_dataset(args, 'train', shuffle=True, fields=TRAIN_FIELDS, rng=data_rng)
+        return data_loader.Dataloader(args, datasets, args.batch_size, device, shuffle=True, is_test=False,
+                                      rng=data_rng)
 
     model = ExtSummarizer(args, device, checkpoint)
+    if teacher is not None and checkpoint is None:
+        model.init_from_teacher(teacher)
     optim = model_builder.build_optim(args, model, checkpoint)
 
     logger.info(model)
+    if use_ddp:
+        # the frozen BERT and the padding embeddings of short documents do not get gradients
+        model = DistributedDataParallel(model, device_ids=[device_id] if device == "cuda" else None,
+                                        bucket_cap_mb=args.bucket_cap_mb, find_unused_parameters=True,
+                                        broadcast_buffers=False)
 
-    trainer = build_trainer(args, device_id, model, optim)
+    trainer = build_trainer(args, device_id, model, optim, teacher)
     trainer.train(train_iter_fct, args.train_steps)
 
 
+def load_teacher(args, device):
+    """ The frozen -distill_from model of -mode distill, built with the model options of its checkpoint """
+    if args.student_layers == 0:
+        raise ValueError('-mode distill needs a student, give -student_layers')
+    logger.info('Loading teacher from %s' % args.distill_from)
+    checkpoint = torch.load(args.distill_from, map_location=lambda storage, loc: storage)
+    teacher_args = copy.copy(args)
+    teacher_args.student_layers = 0
+    opt = vars(checkpoint['opt'])
+    for k in opt.keys():
+        if k in model_flags:
+            setattr(teacher_args, k, opt[k])
+    teacher = ExtSummarizer(teacher_args, device, checkpoint)
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+    return teacher
+
+
 
 # ######################################### validate #########################################
 def validate_ext(args, device_id):
@@ -159,14 +212,17 @@ def validate_ext(args, device_id):
         """
         cp_files = sorted(glob.glob(os.path.join(args.model_path, 'model_step_*.pt')))
         cp_files.sort(key=os.path.getmtime)
-        xent_lst = []
-        for i, cp in enumerate(cp_files):
-            step = int(cp.split('.')[-2].split('_')[-1])
-            xent = validate(args, device_id, cp, step)
-            xent_lst.append((xent, cp))
-            max_step = xent_lst.index(min(xent_lst))
-            if i - max_step > 10: # if the results have not been improved for 10 checkpoints, break
-                break
+        if args.valid_sweep:
+            xent_lst = validate_sweep(args, device_id, cp_files)
+        else:
+            xent_lst = []
+            for i, cp in enumerate(cp_files):
+                step = int(cp.split('.')[-2].split('_')[-1])
+                xent = validate(args, device_id, cp, step)
+                xent_lst.append((xent, cp))
+                max_step = xent_lst.index(min(xent_lst))
+                if i - max_step > 10: # if the results have not been improved for 10 checkpoints, break
+                    break
         xent_lst = sorted(xent_lst, key=lambda x: x[0])[:3]
         logger.info('PPL %s' % str(xent_lst))
         for xent, cp in xent_lst:
@@ -216,7 +272,7 @@ def validate(args, device_id, pt, step):
     model = ExtSummarizer(args, device, checkpoint)
     model.eval()
 
-    valid_iter = data_loader.Dataloader(args, load_dataset(args, 'valid', shuffle=False),
+    valid_iter = data_loader.Dataloader(args, load_dataset(args, 'valid', shuffle=False, fields=TRAIN_FIELDS),
                                         args.batch_size, device,
                                         shuffle=False, is_test=False)
     trainer = build_trainer(args, device_id, model, None)
@@ -224,6 +280,59 @@ def validate(args, device_id, pt, step):
     return stats.xent()
 
 
+def validate_sweep(args, device_id, cp_files):
+    """
+    Validates the checkpoints of `cp_files` against one in-memory copy of the validation set, reusing a single
+    model whose weights are swapped per checkpoint. With a frozen BERT (-finetune_bert false) the BERT sentence
+    vectors are identical for all checkpoints, so with -cache_sent_vecs they are computed once and only the
+    extractive encoder runs per checkpoint. The cache is only reused after checking that the BERT weights match.
+    Returns:
+        list of (xent, checkpoint path)
+    """
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+    model, trainer, valid_batches = None, None, None
+    sent_vecs_cache, cached_bert = None, None
+    xent_lst = []
+    for i, cp in enumerate(cp_files):
+        step = int(cp.split('.')[-2].split('_')[-1])
+        logger.info('Loading checkpoint from %s' % cp)
+        checkpoint = torch.load(cp, map_location=lambda storage, loc: storage)
+        opt = vars(checkpoint['opt'])
+        for k in opt.keys():
+            if k in model_flags:
+                setattr(args, k, opt[k])
+        if model is None:
+            model = ExtSummarizer(args, device, checkpoint)
+            trainer = build_trainer(args, device_id, model, None)
+            # the validation shards are read once for all checkpoints
+            valid_batches = list(data_loader.Dataloader(args, load_dataset(args, 'valid', shuffle=False,
+                                                                           fields=TRAIN_FIELDS),
+                                                        args.batch_size, device, shuffle=False, is_test=False))
+        else:
+            model.load_state_dict(checkpoint['model'], strict=True)
+
+        cache = None
+        if args.cache_sent_vecs and not opt.get('finetune_bert', False):
+            bert_state = {k: v for k, v in checkpoint['model'].items() if k.startswith('bert.')}
+            if cached_bert is None or any(not torch.equal(v, cached_bert[k]) for k, v in bert_state.items()):
+                if cached_bert is not None:
+                    logger.info('BERT weights of %s differ from the cached ones, recomputing the sentence vectors'
+                                % cp)
+                cached_bert = bert_state
+                sent_vecs_cache = [None] * len(valid_batches)
+            cache = sent_vecs_cache
+
+        # same global attention indices for every checkpoint
+        torch.manual_seed(args.seed)
+        random.seed(args.seed)
+        stats = trainer.validate_batches(valid_batches, step, sent_vecs_cache=cache)
+        xent_lst.append((stats.xent(), cp))
+        max_step = xent_lst.index(min(xent_lst))
+        if i - max_step > 10:  # if the results have not been improved for 10 checkpoints, break
+            break
+    return xent_lst
+
+
 # ########################################## test ############################################
 def test_ext(args, device_id, cp, step):
     if args.world_size > 1:
@@ -236,7 +345,8 @@ def test_multi_ext(args, device_id, cp, step):
     """ Spawns 1 process per GPU """
     init_logger()
 
-    nb_gpu = args.world_size
+    # one process per local device, the other nodes start their own
+    nb_gpu = len(args.gpu_ranks)
     mp = torch.multiprocessing.get_context('spawn')
 
     # Create a thread to listen for errors in the child processes.
@@ -254,6 +364,11 @@ def test_multi_ext(args, device_id, cp, step):
     for p in procs:
         p.join()
 
+    # every rank tested a disjoint slice of the documents, the first node merges them
+    # (the other nodes write their outputs to the same shared -result_path)
+    if args.node_rank == 0:
+        merge_sharded_results(args, step, args.world_size)
+
 
 def run_test(args, device_id, error_queue, cp, step):
     """ run process """
@@ -261,12 +376,17 @@ def run_test(args, device_id, error_queue, cp, step):
 
     try:
         # what does multi init do???
-        gpu_rank = distributed.multi_init(device_id, args.world_size, args.gpu_ranks)
+        if args.visible_gpus == '-1':
+            distributed.set_cpu_threads(len(args.gpu_ranks), args.cpu_threads)
+        gpu_rank = distributed.multi_init(device_id, args.world_size, args.gpu_ranks, args.dist_backend,
+                                          args.dist_init_method)
         print('gpu_rank %d' % gpu_rank)
         if gpu_rank != args.gpu_ranks[device_id]:
             raise AssertionError("An error occurred in Distributed initialization")
 
         test_single_ext(args, device_id, cp, step)
+        # the partial outputs of all ranks must be written before node 0 merges them
+        torch.distributed.barrier()
 
     except KeyboardInterrupt:
         pass  # killed by parent, do nothing
@@ -286,7 +406,7 @@ def test_single_ext(args, device_id, pt, step):
     random.seed(args.seed)
     torch.backends.cudnn.deterministic = True
     print('device_id is ', device_id)
-    if device_id >= 0:
+    if device_id >= 0 and device == "cuda":
         torch.cuda.set_device(device_id)
         torch.cuda.manual_seed(args.seed)
 
@@ -310,8 +430,129 @@ def test_single_ext(args, device_id, pt, step):
     model = ExtSummarizer(args, device, checkpoint)
     model.eval()
 
-    test_iter = data_loader.Dataloader(args, load_dataset(args, 'test', shuffle=False),
+    if args.world_size > 1:
+        num_shards, shard_rank = args.world_size, args.gpu_ranks[device_id]
+    else:
+        num_shards, shard_rank = 1, 0
+    test_iter = data_loader.Dataloader(args, load_dataset(args, 'test', shuffle=False, fields=TEST_FIELDS),
                                        args.test_batch_size, device,
-                                       shuffle=False, is_test=True)
+                                       shuffle=False, is_test=True, num_shards=num_shards, shard_rank=shard_rank)
     trainer = build_trainer(args, device_id, model, None)
     trainer.test(test_iter, step)
+
+
+# ################################### precision comparison ####################################
+def compare_precision(args, device_id):
+    """
+    Scores the validation set with the `-test_from` checkpoint in fp32 and in `-precision` (bf16 if fp32 is given)
+    and logs the xent, the throughput and how far the reduced precision sentence scores move from fp32.
+    """
+    init_logger(args.log_file)
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+    if device_id >= 0:
+        torch.cuda.set_device(device_id)
+    reduced = args.precision if args.precision != 'fp32' else 'bf16'
+
+    logger.info('Loading checkpoint from %s' % args.test_from)
+    checkpoint = torch.load(args.test_from, map_location=lambda storage, loc: storage)
+    opt = vars(checkpoint['opt'])
+    for k in opt.keys():
+        if k in model_flags:
+            setattr(args, k, opt[k])
+    model = ExtSummarizer(args, device, checkpoint)
+    model.eval()
+
+    def _score(precision):
+        # same seed for both runs, the global attention indices are sampled
+        torch.manual_seed(args.seed)
+        random.seed(args.seed)
+        valid_iter = data_loader.Dataloader(args, load_dataset(args, 'valid', shuffle=False, fields=TRAIN_FIELDS),
+                                            args.batch_size, device, shuffle=False, is_test=False)
+        doc_scores = []
+        xent, n_docs = 0., 0
+        start = time.time()
+        with torch.no_grad():
+            for batch in valid_iter:
+                sent_count = batch.mask_cls.size(1)
+                with autocast(precision, device):
+                    sent_scores, _ = model(batch.src, batch.sections, batch.token_sections, batch.segs, batch.clss,
+                                           batch.mask_src, batch.mask_cls, batch.chunk_plans)
+                sent_scores = sent_scores[:, :sent_count].float()
+                loss = torch.nn.functional.binary_cross_entropy(sent_scores, batch.src_sent_labels.float(),
+                                                                reduction='none')
+                xent += float((loss * batch.mask_cls.float()).sum())
+                n_docs += batch.batch_size
+                for i in range(batch.batch_size):
+                    doc_scores.append(sent_scores[i][batch.mask_cls[i]].cpu())
+        elapsed = time.time() - start
+        return doc_scores, xent / max(n_docs, 1), n_docs / max(elapsed, 1e-5)
+
+    base_scores, base_xent, base_speed = _score('fp32')
+    scores, xent, speed = _score(reduced)
+
+    max_diff, overlap = 0., 0.
+    for base, other in zip(base_scores, scores):
+        max_diff = max(max_diff, float((base - other).abs().max())) if base.numel() else max_diff
+        # agreement of the selected summaries, the test selects the top 20% of the sentences
+        k = max(int(0.2 * base.numel()), 1)
+        top_base = set(base.topk(min(k, base.numel())).indices.tolist())
+        top_other = set(other.topk(min(k, other.numel())).indices.tolist())
+        overlap += len(top_base & top_other) / max(len(top_base), 1)
+    overlap /= max(len(base_scores), 1)
+
+    logger.info('fp32: xent %.4f; %.2f docs/s' % (base_xent, base_speed))
+    logger.info('%s: xent %.4f; %.2f docs/s' % (reduced, xent, speed))
+    logger.info('%s vs fp32: xent diff %.4f; max |score diff| %.4f; top-20%% overlap %.2f%%; speedup %.2fx'
+                % (reduced, xent - base_xent, max_diff, overlap * 100, speed / max(base_speed, 1e-5)))
+
+
+# ################################## distillation comparison ##################################
+def compare_distill(args, device_id):
+    """
+    Tests the distilled `-test_from` student and its `-distill_from` teacher on the test set and logs the
+    parameters, the throughput and the ROUGE of both.
+    """
+    init_logger(args.log_file)
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+    if device_id >= 0:
+        torch.cuda.set_device(device_id)
+    # both models are tested in this process, ROUGE is computed here
+    report_rouge, args.report_rouge = args.report_rouge, False
+    result_path = args.result_path
+
+    results = []
+    for name, cp in [('teacher', args.distill_from), ('student', args.test_from)]:
+        logger.info('Loading %s from %s' % (name, cp))
+        checkpoint = torch.load(cp, map_location=lambda storage, loc: storage)
+        model_args = copy.copy(args)
+        model_args.student_layers = 0
+        opt = vars(checkpoint['opt'])
+        for k in opt.keys():
+            if k in model_flags:
+                setattr(model_args, k, opt[k])
+        model_args.result_path = '%s.%s' % (result_path, name)
+        model = ExtSummarizer(model_args, device, checkpoint)
+        model.eval()
+
+        torch.manual_seed(args.seed)
+        random.seed(args.seed)
+        test_iter = data_loader.Dataloader(model_args, load_dataset(model_args, 'test', shuffle=False,
+                                                                    fields=TEST_FIELDS),
+                                           args.test_batch_size, device, shuffle=False, is_test=True)
+        trainer = build_trainer(model_args, device_id, model, None)
+        start = time.time()
+        stats = trainer.test(test_iter, 0)
+        speed = stats.n_docs / max(time.time() - start, 1e-5)
+        n_params = sum(p.nelement() for p in model.bert.parameters())
+        rouges = None
+        if report_rouge:
+            rouges = test_rouge('%s_step0.candidate' % model_args.result_path, '%s_step0.gold' % model_args.result_path)
+        results.append((name, n_params, speed, rouges))
+        del model
+
+    for name, n_params, speed, rouges in results:
+        logger.info('%s: %d chunk encoder parameters; %.2f docs/s' % (name, n_params, speed))
+        if rouges is not None:
+            logger.info('%s %s' % (name, rouge_results_to_str(rouges)))
+    logger.info('student vs teacher: %.2fx docs/s with %.1f%% of the chunk encoder parameters'
+                % (results[1][2] / max(results[0][2], 1e-5), 100 * results[1][1] / max(results[0][1], 1)))